@@ -0,0 +1,203 @@
+import argparse
+import csv
+import mmap
+import os
+import sys
+import time
+from collections import deque
+from itertools import chain, islice
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from corpus import MessageRef, iter_message_refs
+from keep_list import KeepListMatcher
+from message_parser import DEFAULT_MAX_BODY_BYTES, parse_message
+from spam_detector import DEFAULT_BATCH_SIZE, DEFAULT_KEEP_DATA_PATH, DEFAULT_MODEL_PATH, EXIT_CONFIG, EXIT_OK, \
+    classify_batch, load_model
+
+# Messages a worker process reads, parses and classifies per task
+DEFAULT_CHUNK_SIZE = 512
+# Tasks handed out per worker process ahead of the results being written; bounds memory on any archive size
+TASKS_PER_PROCESS = 2
+# Rows per Parquet row group
+PARQUET_ROW_GROUP_SIZE = 65_536
+
+COLUMNS = ('path', 'offset', 'sender', 'subject', 'is_spam', 'score')
+
+# (path, offset in an mbox file or None, sender, subject, is_spam, score)
+Row = Tuple[str, Optional[int], str, str, bool, float]
+
+# State of a worker process, set up once by _init_worker
+_worker: Dict[str, object] = {}
+_mapped_files: Dict[str, mmap.mmap] = {}
+
+
+def _init_worker(model_path: str, keep_data_path: str, max_body_bytes: Optional[int], batch_size: int) -> None:
+    # The parent process loaded the model first, so workers find its compact export and map it in
+    _worker['model'] = load_model(model_path, lambda message: None)
+    _worker['keep_matcher'] = KeepListMatcher.from_csv(keep_data_path)
+    _worker['max_body_bytes'] = max_body_bytes
+    _worker['batch_size'] = batch_size
+
+
+def _mapped(path: str) -> mmap.mmap:
+    """A memory map of an mbox file, opened once per worker process."""
+    mapped = _mapped_files.get(path)
+    if mapped is None:
+        with open(path, 'rb') as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        _mapped_files[path] = mapped
+    return mapped
+
+
+def read_message(ref: MessageRef, max_body_bytes: Optional[int] = DEFAULT_MAX_BODY_BYTES) -> Tuple[str, str, str]:
+    """
+    Returns (sender, subject, body) of an archived message. Messages of an mbox file are parsed directly on
+    its memory map, so only their header block and text part are ever copied.
+    """
+    if ref.end is None:
+        return parse_message(Path(ref.path).read_bytes(), max_body_bytes)
+    return parse_message(_mapped(ref.path), max_body_bytes, ref.start, ref.end)
+
+
+def _classify_refs(refs: List[MessageRef]) -> List[Row]:
+    messages = [read_message(ref, _worker['max_body_bytes']) for ref in refs]
+    labels, scores = classify_batch(messages, _worker['model'], _worker['keep_matcher'], _worker['batch_size'])
+    return [(ref.path, ref.start if ref.end is not None else None, sender, subject, label, score)
+            for ref, (sender, subject, _), label, score in zip(refs, messages, labels, scores)]
+
+
+class CsvVerdictWriter:
+    """Writes verdict rows to a CSV file with a header line."""
+
+    def __init__(self, path: Union[str, Path]):
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(COLUMNS)
+
+    def write(self, rows: Sequence[Row]) -> None:
+        self.writer.writerows((path, '' if offset is None else offset, sender, subject, int(spam), f"{score:.6f}")
+                              for path, offset, sender, subject, spam, score in rows)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class ParquetVerdictWriter:
+    """Writes verdict rows to a Parquet file, one row group per PARQUET_ROW_GROUP_SIZE rows. Needs pyarrow."""
+
+    def __init__(self, path: Union[str, Path]):
+        import pyarrow as pa  # Optional; only Parquet output needs it
+        import pyarrow.parquet as pq
+
+        self._pa = pa
+        self.schema = pa.schema([('path', pa.string()), ('offset', pa.int64()), ('sender', pa.string()),
+                                 ('subject', pa.string()), ('is_spam', pa.bool_()), ('score', pa.float64())])
+        self.writer = pq.ParquetWriter(str(path), self.schema)
+        self._pending: List[Row] = []
+
+    def write(self, rows: Sequence[Row]) -> None:
+        self._pending.extend(rows)
+        if len(self._pending) >= PARQUET_ROW_GROUP_SIZE:
+            self._flush()
+
+    def close(self) -> None:
+        self._flush()
+        self.writer.close()
+
+    def _flush(self) -> None:
+        if not self._pending:
+            return
+        columns = list(zip(*self._pending))
+        self.writer.write_table(self._pa.Table.from_arrays(
+            [self._pa.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+            schema=self.schema))
+        self._pending = []
+
+
+def open_verdict_writer(path: Union[str, Path], output_format: Optional[str] = None):
+    """Opens a CsvVerdictWriter or ParquetVerdictWriter, chosen by `output_format` or else the file suffix."""
+    output_format = output_format or ('parquet' if Path(path).suffix.lower() == '.parquet' else 'csv')
+    return ParquetVerdictWriter(path) if output_format == 'parquet' else CsvVerdictWriter(path)
+
+
+def classify_archives(archives: Iterable[Union[str, Path]], write: Callable[[Sequence[Row]], None],
+                      model_path: Union[str, Path] = DEFAULT_MODEL_PATH,
+                      keep_data_path: Union[str, Path] = DEFAULT_KEEP_DATA_PATH, processes: Optional[int] = None,
+                      chunk_size: int = DEFAULT_CHUNK_SIZE, max_body_bytes: Optional[int] = DEFAULT_MAX_BODY_BYTES,
+                      batch_size: int = DEFAULT_BATCH_SIZE,
+                      log_func: Callable[[str], None] = print) -> Dict[str, int]:
+    """
+    Classifies every message of local mail archives (mbox files, Maildirs, .eml files or directories of them)
+    without a mail server, and hands the verdict rows to `write` in archive order.
+    This process only finds where the messages are (see iter_message_refs); worker processes read, parse and
+    classify chunks of `chunk_size` of them with the same model input and keep rules as a scan (see
+    classify_batch). Only TASKS_PER_PROCESS chunks per worker are in flight at a time, so multi-GB archives
+    are streamed.
+    Returns the number of messages and of spam found.
+    """
+    load_model(str(model_path), log_func)  # Trains or exports the compact model once, before the workers start
+    processes = processes or os.cpu_count() or 1
+    refs = chain.from_iterable(iter_message_refs(archive) for archive in archives)
+    chunks = iter(lambda: list(islice(refs, chunk_size)), [])
+    counts = {'messages': 0, 'spam': 0}
+    start = time.monotonic()
+    with Pool(processes, _init_worker, (str(model_path), str(keep_data_path), max_body_bytes, batch_size)) as pool:
+        pending = deque()
+
+        def write_next() -> None:
+            rows = pending.popleft().get()
+            write(rows)
+            counts['messages'] += len(rows)
+            counts['spam'] += sum(row[4] for row in rows)
+
+        for chunk in chunks:
+            pending.append(pool.apply_async(_classify_refs, (chunk,)))
+            if len(pending) >= processes * TASKS_PER_PROCESS:
+                write_next()
+        while pending:
+            write_next()
+    seconds = time.monotonic() - start
+    log_func(f"Classified {counts['messages']} messages in {seconds:.1f}s "
+             f"({counts['messages'] / max(seconds, 1e-9):.0f}/s); {counts['spam']} spam.")
+    return counts
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Classify local mail archives (mbox, Maildir, .eml) without the mail server and write one "
+                    "verdict per message.")
+    parser.add_argument('archives', nargs='+', type=Path, help="mbox files, Maildirs, .eml files or directories")
+    parser.add_argument('--output', type=Path, required=True, help="CSV file, or Parquet with a .parquet suffix")
+    parser.add_argument('--format', choices=('csv', 'parquet'), default=None,
+                        help="Output format (default: from the --output suffix)")
+    parser.add_argument('--model', type=Path, default=DEFAULT_MODEL_PATH)
+    parser.add_argument('--keep-data', type=Path, default=DEFAULT_KEEP_DATA_PATH)
+    parser.add_argument('--processes', type=int, default=None, help="Worker processes (default: one per CPU)")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument('--max-body-bytes', type=int, default=DEFAULT_MAX_BODY_BYTES)
+    args = parser.parse_args(argv)
+
+    def log(message: str) -> None:
+        print(message, file=sys.stderr, flush=True)
+
+    missing = [str(archive) for archive in args.archives if not archive.exists()]
+    if missing:
+        log(f"No mail archive at {', '.join(missing)}")
+        return EXIT_CONFIG
+    try:
+        writer = open_verdict_writer(args.output, args.format)
+    except ImportError:
+        log("Parquet output needs pyarrow (pip install pyarrow); write CSV instead.")
+        return EXIT_CONFIG
+    try:
+        classify_archives(args.archives, writer.write, args.model, args.keep_data, args.processes, args.chunk_size,
+                          args.max_body_bytes, log_func=log)
+    finally:
+        writer.close()
+    return EXIT_OK
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,405 @@
+import argparse
+import imaplib
+import json
+import platform
+import subprocess
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import Executor, ProcessPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional
+
+import joblib
+import pandas as pd
+
+from campaigns import CampaignIndex
+from header_model import create_header_model, header_input_from_raw
+from imap_fetch import fetch_emails, search_uids
+from imap_standin import StandInIMAPServer
+from keep_list import compile_keep_list
+from metrics import METRICS
+from scan_state import ScanStateStore
+from spam_detector import DEFAULT_BATCH_SIZE, build_model_input, chunked, classify_batch, create_spam_folder, \
+    filter_folder, is_spam, load_model, move_email_to_spam, move_emails_to_spam, scan_uids
+from synthetic_corpus import generate_corpus
+from verdict_cache import VerdictCache
+from watcher import MailboxWatcher
+
+DEFAULT_SIZES = (1_000, 10_000, 100_000)
+DEFAULT_OUTPUT_DIR = Path("../benchmarks")
+# Emails classified one at a time with is_spam, and moved one at a time with move_email_to_spam
+SINGLE_CALL_SAMPLE = 1_000
+SINGLE_MOVE_SAMPLE = 20
+# Synthetic emails the header model is trained on when no --header-model is given
+HEADER_TRAINING_SIZE = 2_000
+USER, PASSWORD = "bench@example.com", "bench"
+# Emails delivered one at a time to a running MailboxWatcher, and the seconds each may take to be classified
+WATCH_DELIVERIES = 20
+WATCH_TIMEOUT = 10.0
+
+
+class _TimedIMAP4(imaplib.IMAP4):
+    """An IMAP4 connection that adds the duration of every UID command to `timings`, by command name."""
+
+    def __init__(self, host: str, port: int):
+        self.timings: Dict[str, float] = defaultdict(float)
+        self.calls: Dict[str, int] = defaultdict(int)
+        super().__init__(host, port)
+
+    def uid(self, command, *args):
+        start = time.perf_counter()
+        try:
+            return super().uid(command, *args)
+        finally:
+            name = f"imap_{command.lower()}"
+            self.timings[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+
+class _DeliveringIMAP4(imaplib.IMAP4):
+    """An IMAP4 connection that calls `deliver` once, right after its first UID SEARCH."""
+
+    def __init__(self, host: str, port: int, deliver: Callable[[], None]):
+        self.deliver: Optional[Callable[[], None]] = deliver
+        super().__init__(host, port)
+
+    def uid(self, command, *args):
+        result = super().uid(command, *args)
+        if command.upper() == 'SEARCH' and self.deliver is not None:
+            deliver, self.deliver = self.deliver, None
+            deliver()
+        return result
+
+
+class StageTimer:
+    """Accumulates wall-clock seconds and item counts per named stage."""
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = defaultdict(float)
+        self.items: Dict[str, int] = defaultdict(int)
+
+    @contextmanager
+    def stage(self, name: str, items: int = 0) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, items)
+
+    def add(self, name: str, seconds: float, items: int = 0) -> None:
+        self.seconds[name] += seconds
+        self.items[name] += items
+
+    def report(self) -> Dict[str, Dict[str, float]]:
+        report = {}
+        for name, seconds in self.seconds.items():
+            items = self.items[name]
+            report[name] = {'seconds': round(seconds, 6), 'items': items}
+            if items:
+                report[name]['ms_per_item'] = round(seconds * 1000 / items, 6)
+                report[name]['items_per_second'] = round(items / seconds, 2) if seconds else None
+        return report
+
+
+def git_commit() -> Optional[str]:
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return result.stdout.strip()
+
+
+def benchmark_size(count: int, model, keep_df: pd.DataFrame, latency: float, batch_size: int,
+                   options: dict, parse_pool: Optional[Executor] = None, cached_model=None,
+                   header_model=None, log_func=print) -> Dict[str, object]:
+    """
+    Loads `count` synthetic emails into a stand-in server and times every stage of a scan: search, fetch,
+    parse, keep-list check, vectorize, predict, whole-scan throughput, per-email is_spam calls and moves.
+    With a `cached_model` (one returned by load_model), classification through a cold and a warm verdict cache
+    is timed as well. Classification with campaign grouping is always timed. With a `header_model`, filter_folder
+    runs once with the header cascade and once downloading every body, and their accuracy, bytes fetched and
+    escalation rate are compared.
+    """
+    timer = StageTimer()
+    expected = {}
+    with StandInIMAPServer({USER: PASSWORD}, latency=latency) as server:
+        with timer.stage('generate', count):
+            for raw, spam in generate_corpus(count, **options):
+                expected[server.add_message(raw)] = spam
+        log_func(f"  {count} emails generated")
+
+        mail = _TimedIMAP4(*server.address)
+        mail.login(USER, PASSWORD)
+        mail.select('inbox')
+        create_spam_folder(mail, lambda message: None)
+        keep_matcher = compile_keep_list(keep_df)
+
+        # The whole scan path, as filter_folder runs it, without the 100 email limit
+        with timer.stage('search', count):
+            uids = search_uids(mail)
+        spam_uids = []
+        METRICS.reset()
+        with timer.stage('scan', count):
+            for verdicts in scan_uids(mail, uids, model, keep_matcher, lambda message: None,
+                                      lambda *email: None, batch_size, parse_pool=parse_pool):
+                spam_uids.extend(uid for uid, spam, _ in verdicts if spam)
+        scan_metrics = METRICS.to_dict()  # What the scan path itself recorded
+        log_func(f"  scan: {timer.seconds['scan']:.2f}s")
+
+        # The same path again, stage by stage
+        fetch_before = mail.timings['imap_fetch']
+        messages = []
+        for chunk in chunked(uids, batch_size):
+            with timer.stage('fetch_and_parse', len(chunk)):
+                messages.extend(fetch_emails(mail, chunk))
+        fetch_seconds = mail.timings['imap_fetch'] - fetch_before
+        timer.add('fetch', fetch_seconds, len(uids))
+        timer.add('parse', timer.seconds['fetch_and_parse'] - fetch_seconds, len(uids))
+
+        with timer.stage('keep_list', len(messages)):
+            pending = [message for message in messages
+                       if not keep_matcher.matches(message.sender, message.subject, message.body)]
+        texts = [build_model_input(message.sender, message.subject, message.body) for message in pending]
+        steps = [step for _, step in getattr(model, 'steps', [])]
+        if len(steps) == 2:
+            vectorizer, classifier = steps
+            for chunk in chunked(texts, batch_size):
+                with timer.stage('vectorize', len(chunk)):
+                    features = vectorizer.transform(chunk)
+                with timer.stage('predict', len(chunk)):
+                    classifier.predict_proba(features)
+        with timer.stage('classify_batch', len(messages)):
+            classify_batch([(message.sender, message.subject, message.body) for message in messages], model,
+                           keep_matcher, batch_size)
+
+        campaigns = CampaignIndex()
+        with timer.stage('classify_campaigns', len(messages)):
+            classify_batch([(message.sender, message.subject, message.body) for message in messages], model,
+                           keep_matcher, batch_size, campaigns=campaigns)
+        campaign_stats = {'campaigns': len(campaigns.sizes), 'largest': max(campaigns.sizes, default=0)}
+
+        cache_stats = None
+        if cached_model is not None:
+            cache = VerdictCache()
+            triples = [(message.sender, message.subject, message.body) for message in messages]
+            for stage in ('classify_cache_cold', 'classify_cache_warm'):
+                with timer.stage(stage, len(messages)):
+                    classify_batch(triples, cached_model, keep_matcher, batch_size, cache)
+            cache_stats = cache.stats()
+
+        cascade_stats = None
+        if header_model is not None:
+            cascade_stats = {}
+            found_by_mode = {}
+            for mode, cascade_model in (('body_always', None), ('cascade', header_model)):
+                found = set()
+                METRICS.reset()
+                with timer.stage(f"filter_{mode}", count):
+                    filter_folder(mail, USER, keep_matcher, model, lambda message: None,
+                                  lambda uid, *email: found.add(int(uid)), batch_size, limit=None,
+                                  parse_pool=parse_pool, header_model=cascade_model)
+                cascade_stats[mode] = {
+                    'accuracy': round(sum(expected[uid] == (uid in found) for uid in expected) / count, 4),
+                    'fetched_bytes': METRICS.counter('imap_fetched_bytes_total'),
+                    'spam_found': len(found),
+                }
+                if mode == 'cascade':
+                    decided = METRICS.counter('cascade_emails_total', tier='header')
+                    escalated = METRICS.counter('cascade_emails_total', tier='body')
+                    cascade_stats[mode]['escalation_rate'] = \
+                        round(escalated / (decided + escalated), 4) if decided + escalated else None
+                found_by_mode[mode] = found
+            cascade_stats['agreement'] = round(sum((uid in found_by_mode['cascade'])
+                                                   == (uid in found_by_mode['body_always']) for uid in expected)
+                                               / count, 4)
+            cascade_stats['accuracy_difference'] = round(cascade_stats['cascade']['accuracy']
+                                                         - cascade_stats['body_always']['accuracy'], 4)
+            log_func(f"  cascade: {cascade_stats['cascade']['escalation_rate']:.0%} escalated, accuracy "
+                     f"{cascade_stats['accuracy_difference']:+.4f} against downloading every body")
+
+        sample = messages[:SINGLE_CALL_SAMPLE]
+        with timer.stage('is_spam', len(sample)):
+            for message in sample:
+                is_spam(message.sender, message.subject, message.body, model, keep_matcher)
+
+        single = spam_uids[:SINGLE_MOVE_SAMPLE]
+        with timer.stage('move_single', len(single)):
+            for uid in single:
+                move_email_to_spam(mail, str(uid), lambda message: None)
+        bulk = spam_uids[SINGLE_MOVE_SAMPLE:]
+        with timer.stage('move_bulk', len(bulk)):
+            move_emails_to_spam(mail, bulk, lambda message: None)
+        log_func(f"  moved {len(spam_uids)} spam emails")
+
+        imap_calls = dict(mail.calls)
+        mail.logout()
+
+    correct = sum(expected[uid] == (uid in set(spam_uids)) for uid in expected)
+    return {
+        'emails': count,
+        'spam_detected': len(spam_uids),
+        'spam_expected': sum(expected.values()),
+        'accuracy': round(correct / count, 4) if count else None,
+        'imap_calls': imap_calls,
+        'stages': timer.report(),
+        'scan_metrics': scan_metrics,
+        'verdict_cache': cache_stats,
+        'campaigns': campaign_stats,
+        'cascade': cascade_stats,
+    }
+
+
+def _wait_for_checkpoint(state_store: ScanStateStore, uidvalidity: int, uid: int, since: float) -> Optional[float]:
+    """Seconds from `since` until the watcher recorded a verdict for `uid`, or None after WATCH_TIMEOUT."""
+    while state_store.get_checkpoint(USER, 'inbox', uidvalidity) < uid:
+        if time.perf_counter() - since > WATCH_TIMEOUT:
+            return None
+        time.sleep(0.005)
+    return time.perf_counter() - since
+
+
+def benchmark_watch(model, keep_df: pd.DataFrame, latency: float, deliveries: int = WATCH_DELIVERIES,
+                    log_func=print) -> Dict[str, object]:
+    """
+    Times how long a MailboxWatcher idling on a stand-in server takes to classify newly delivered emails.
+    The first email arrives between the watcher's catch-up search and its IDLE, so the server announces it
+    together with IDLE's continuation; the others arrive one at a time while the watcher idles.
+    An email not classified within WATCH_TIMEOUT seconds counts as missed.
+    """
+    corpus = [raw for raw, _ in generate_corpus(deliveries + 1, seed=1)]
+    latencies, missed = [], 0
+    delivered = {}
+    with StandInIMAPServer({USER: PASSWORD}, latency=latency) as server, \
+            tempfile.TemporaryDirectory() as directory:
+        def deliver_first() -> None:
+            delivered['start'] = time.perf_counter()
+            delivered['uid'] = server.add_message(corpus[0])
+
+        state_path = Path(directory) / "watch_state.sqlite3"
+        watcher = MailboxWatcher(lambda: _DeliveringIMAP4(*server.address, deliver_first), USER, PASSWORD, model,
+                                 keep_df, lambda message: None, lambda *email: None, state_path=state_path)
+        watcher.start()
+        state_store = ScanStateStore(state_path)
+        try:
+            uidvalidity = server.get_folder('inbox').uidvalidity
+            while 'uid' not in delivered and watcher.running:
+                time.sleep(0.005)
+            first = _wait_for_checkpoint(state_store, uidvalidity, delivered.get('uid', 1), delivered.get('start', 0))
+            if first is None:
+                missed += 1
+            for raw in corpus[1:]:
+                start = time.perf_counter()
+                seconds = _wait_for_checkpoint(state_store, uidvalidity, server.add_message(raw), start)
+                if seconds is None:
+                    missed += 1
+                else:
+                    latencies.append(seconds)
+        finally:
+            watcher.stop(WATCH_TIMEOUT)
+            state_store.close()
+    result = {
+        'deliveries': deliveries + 1,
+        'missed': missed,
+        'announced_with_idle_ms': round(first * 1000, 3) if first is not None else None,
+        'median_ms': round(statistics.median(latencies) * 1000, 3) if latencies else None,
+        'max_ms': round(max(latencies) * 1000, 3) if latencies else None,
+    }
+    log_func(f"  watch: median {result['median_ms']} ms, max {result['max_ms']} ms from delivery to verdict; "
+             f"{missed} missed")
+    return result
+
+
+def compare(current: dict, baseline: dict, log_func=print) -> None:
+    """Prints how much slower (>1) or faster (<1) every stage got compared to an earlier result file."""
+    log_func(f"Compared to {baseline.get('commit') or 'baseline'} (ratio of seconds, >1 is slower):")
+    for size, result in current['results'].items():
+        old = baseline.get('results', {}).get(size)
+        if not old:
+            continue
+        log_func(f"  {size} emails:")
+        for stage, numbers in result['stages'].items():
+            old_numbers = old['stages'].get(stage)
+            if old_numbers and old_numbers['seconds']:
+                log_func(f"    {stage:<16} {numbers['seconds'] / old_numbers['seconds']:6.2f}x")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Time every stage of a scan against a local stand-in server.")
+    parser.add_argument('--sizes', type=lambda value: [int(size) for size in value.split(',')],
+                        default=list(DEFAULT_SIZES), help="Comma-separated corpus sizes (default: 1000,10000,100000)")
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds the server waits before each response")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument('--spam-ratio', type=float, default=0.3)
+    parser.add_argument('--multipart-ratio', type=float, default=0.4)
+    parser.add_argument('--attachment-ratio', type=float, default=0.1)
+    parser.add_argument('--campaign-ratio', type=float, default=0.0,
+                        help="Share of spam sent as near-identical copies of a few campaigns")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--parse-processes', type=int, default=None,
+                        help="Decode fetched emails on a process pool of this size during the scan")
+    parser.add_argument('--model', default='../models/spam_classifier.joblib')
+    parser.add_argument('--header-model', default=None,
+                        help="Header model for the cascade comparison (default: one trained on other synthetic "
+                             "emails)")
+    parser.add_argument('--output', type=Path, default=None,
+                        help="Result file (default: ../benchmarks/<commit>.json)")
+    parser.add_argument('--compare', type=Path, default=None, help="Earlier result file to compare against")
+    args = parser.parse_args()
+
+    load_timer = StageTimer()
+    with load_timer.stage('model_load'):
+        cached_model = load_model(args.model, lambda message: None)
+    # The scikit-learn pipeline itself, so vectorize and predict can be timed separately
+    model = joblib.load(args.model)
+    if args.header_model:
+        header_model = load_model(args.header_model, lambda message: None)
+    else:
+        corpus = list(generate_corpus(HEADER_TRAINING_SIZE, spam_ratio=args.spam_ratio, seed=args.seed + 1))
+        header_model = create_header_model([header_input_from_raw(raw) for raw, _ in corpus],
+                                           [int(spam) for _, spam in corpus])
+    keep_df = pd.DataFrame({"Keywords": ["unsubscribe-never-matches"], "Sender": ["news.example.net"],
+                            "Subject": [None]})
+    options = {'spam_ratio': args.spam_ratio, 'multipart_ratio': args.multipart_ratio,
+               'attachment_ratio': args.attachment_ratio, 'campaign_ratio': args.campaign_ratio, 'seed': args.seed}
+
+    commit = git_commit()
+    report = {
+        'commit': commit,
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'parameters': {'latency': args.latency, 'batch_size': args.batch_size,
+                       'parse_processes': args.parse_processes, **options},
+        'model_load_seconds': round(load_timer.seconds['model_load'], 6),
+        'results': {},
+    }
+    parse_pool = ProcessPoolExecutor(args.parse_processes) if args.parse_processes else None
+    try:
+        for size in args.sizes:
+            print(f"Benchmarking {size} emails...")
+            report['results'][str(size)] = benchmark_size(size, model, keep_df, args.latency, args.batch_size,
+                                                          options, parse_pool, cached_model, header_model)
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown()
+
+    print("Benchmarking the watcher...")
+    report['watch'] = benchmark_watch(model, keep_df, args.latency)
+
+    output = args.output or DEFAULT_OUTPUT_DIR / f"{commit or 'results'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2))
+    print(f"Results written to {output}")
+    if args.compare:
+        compare(report, json.loads(args.compare.read_text()))
+    if report['watch']['missed']:
+        sys.exit(f"The watcher missed {report['watch']['missed']} of {report['watch']['deliveries']} deliveries.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import os
+import sqlite3
+import tempfile
+import threading
+import zlib
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Tuple, Union
+
+from metrics import METRICS
+
+# Compressed bytes of email bodies kept on disk; the oldest are evicted beyond this
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+# Characters of a body kept in memory, for the list and for bodies that were evicted
+PREVIEW_CHARS = 300
+
+Key = Tuple[Optional[str], str]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS bodies (
+    key TEXT PRIMARY KEY,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL
+);
+"""
+
+
+def make_preview(body: str, chars: int = PREVIEW_CHARS) -> str:
+    """The opening of a body with runs of whitespace collapsed, cut to `chars` characters."""
+    text = ' '.join(body[:chars * 4].split())
+    return text if len(text) <= chars else text[:chars - 3] + '...'
+
+
+def _key_text(key: Key) -> str:
+    account, uid = key
+    return f"{account or ''}\x00{uid}"
+
+
+class BodyStore:
+    """
+    Keeps the full bodies of the emails in the spam list on disk, compressed, so the list itself only holds
+    their metadata and a preview (see SpamEmail) however many emails a scan flags. Bodies are keyed like
+    SpamEmail.key. Once the stored bodies exceed `max_bytes`, the oldest are evicted and get returns None
+    for them.
+
+    Args:
+        path (Optional[Path]): SQLite database; None uses a temporary file that close deletes.
+        max_bytes (int): Compressed bytes kept before the oldest bodies are evicted.
+    """
+
+    def __init__(self, path: Optional[Union[str, Path]] = None, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.evicted = 0
+        self._lock = threading.Lock()
+        self._temporary = path is None
+        if path is None:
+            handle, path = tempfile.mkstemp(prefix='spam_bodies_', suffix='.sqlite3')
+            os.close(handle)
+        self.path = Path(path)
+        # Scan threads add bodies while the main loop reads them; _lock serializes access
+        self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.connection.executescript(_SCHEMA)
+        self._bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM bodies").fetchone()[0]
+
+    def close(self) -> None:
+        with self._lock:
+            if self.connection is None:
+                return
+            self.connection.close()
+            self.connection = None
+            if self._temporary:
+                self.path.unlink(missing_ok=True)
+
+    def __enter__(self) -> "BodyStore":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def put(self, key: Key, body: str) -> None:
+        """Stores the body of an email, replacing any stored before under the same key."""
+        if not body:
+            return
+        data = zlib.compress(body.encode('utf-8', 'surrogatepass'))
+        with self._lock:
+            with self.connection:
+                previous = self.connection.execute("SELECT size FROM bodies WHERE key = ?",
+                                                   (_key_text(key),)).fetchone()
+                # Replacing a row gives it a new rowid, so it counts as the newest
+                self.connection.execute("INSERT OR REPLACE INTO bodies (key, body, size) VALUES (?, ?, ?)",
+                                        (_key_text(key), data, len(data)))
+            self._bytes += len(data) - (previous[0] if previous else 0)
+            if self._bytes > self.max_bytes:
+                self._evict()
+        METRICS.inc('body_store_bytes_written_total', len(data))
+
+    def get(self, key: Key) -> Optional[str]:
+        """The body of an email, or None if it was never stored or has been evicted."""
+        with self._lock:
+            row = self.connection.execute("SELECT body FROM bodies WHERE key = ?", (_key_text(key),)).fetchone()
+        return zlib.decompress(row[0]).decode('utf-8', 'surrogatepass') if row else None
+
+    def discard(self, keys: Iterable[Key]) -> None:
+        """Forgets the bodies of emails that left the list."""
+        texts = [(_key_text(key),) for key in keys]
+        if not texts:
+            return
+        with self._lock:
+            with self.connection:
+                self.connection.executemany("DELETE FROM bodies WHERE key = ?", texts)
+            self._bytes = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM bodies").fetchone()[0]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            count = self.connection.execute("SELECT COUNT(*) FROM bodies").fetchone()[0]
+            return {'bodies': count, 'bytes': self._bytes, 'evicted': self.evicted}
+
+    def _evict(self) -> None:
+        """Deletes the oldest bodies until a tenth of max_bytes is free. Call with _lock held."""
+        target = self.max_bytes * 9 // 10
+        freed, last_rowid, count = 0, None, 0
+        for rowid, size in self.connection.execute("SELECT rowid, size FROM bodies ORDER BY rowid"):
+            if self._bytes - freed <= target:
+                break
+            freed += size
+            last_rowid = rowid
+            count += 1
+        if last_rowid is None:
+            return
+        with self.connection:
+            self.connection.execute("DELETE FROM bodies WHERE rowid <= ?", (last_rowid,))
+        self._bytes -= freed
+        self.evicted += count
+        METRICS.inc('body_store_evicted_total', count)
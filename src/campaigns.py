@@ -0,0 +1,163 @@
+import re
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# 64 hash functions in 16 bands of 4 rows: pairs of emails sharing 70% of their shingles end up in a common bucket
+# 99% of the time, pairs sharing 30% about 12% of the time
+DEFAULT_NUM_PERM = 64
+DEFAULT_BANDS = 16
+# Estimated Jaccard similarity of the shingles above which an email joins a campaign
+DEFAULT_THRESHOLD = 0.7
+# Words per shingle
+SHINGLE_SIZE = 3
+# Emails with fewer distinct shingles are too short to tell a campaign copy from a chance resemblance
+MIN_SHINGLES = 10
+# Campaigns remembered by one index; it starts over when there are more
+MAX_CAMPAIGNS = 100_000
+
+# Characters of an email's text that are shingled; the opening of a campaign email identifies it
+MAX_TEXT_CHARS = 4000
+# Tokens longer than this are taken to be tracking codes or other per-recipient noise
+MAX_WORD_LENGTH = 20
+
+_URL = re.compile(r'https?://\S+|www\.\S+', re.IGNORECASE)
+_WORD = re.compile(r'\w+')
+_NOISE_HASH = hash('0')
+_MASK_32 = np.uint64(0xFFFFFFFF)
+
+Verdict = Tuple[bool, float]
+
+
+def shingle_hashes(text: str) -> np.ndarray:
+    """
+    Hashes of the overlapping word triples of a text. Links, numbers and very long tokens are replaced by
+    placeholders first, so the copies of a campaign that differ only in those produce the same shingles.
+    Python's string hash is used for words, so hashes are only comparable within one process.
+    """
+    words = _WORD.findall(_URL.sub(' httplink ', text[:MAX_TEXT_CHARS].lower()))
+    if not words:
+        return np.empty(0, dtype=np.uint64)
+    # Tokens with digits (numbers, codes) or that are too long all hash alike
+    hashes = np.array([hash(word) if word.isalpha() and len(word) <= MAX_WORD_LENGTH else _NOISE_HASH
+                       for word in words], dtype=np.int64).view(np.uint64) & _MASK_32
+    if len(hashes) < SHINGLE_SIZE:
+        return np.unique(hashes)
+    # Combine the word hashes of each window into one 32-bit shingle hash
+    windows = len(hashes) - SHINGLE_SIZE + 1
+    shingles = hashes[:windows].copy()
+    for offset in range(1, SHINGLE_SIZE):
+        shingles = (shingles * np.uint64(0x01000193) ^ hashes[offset:windows + offset]) & _MASK_32
+    return np.unique(shingles)
+
+
+class CampaignIndex:
+    """
+    Groups near-identical emails into campaigns with MinHash signatures and an LSH index, so the model only
+    needs to see one representative per campaign. The first email of a campaign is its representative; later
+    emails join the campaign whose representative is most similar, if that similarity reaches `threshold`.
+    Campaign numbers are never reused, not even after the index starts over, so callers may keep them.
+
+    Args:
+        num_perm (int): Hash functions per signature.
+        bands (int): LSH bands; num_perm must be a multiple of it.
+        threshold (float): Estimated Jaccard similarity required to join a campaign.
+        seed (int): Seed of the hash functions.
+        max_campaigns (int): Campaigns remembered before the index starts over.
+    """
+
+    def __init__(self, num_perm: int = DEFAULT_NUM_PERM, bands: int = DEFAULT_BANDS,
+                 threshold: float = DEFAULT_THRESHOLD, seed: int = 1, max_campaigns: int = MAX_CAMPAIGNS):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.max_campaigns = max_campaigns
+        rng = np.random.RandomState(seed)
+        # Multiply-shift hashing: the high 32 bits of a * x + b, computed modulo 2**64, with a odd
+        self._a = rng.randint(0, 1 << 62, size=(num_perm, 1), dtype=np.int64).astype(np.uint64) * np.uint64(2) \
+            + np.uint64(1)
+        self._b = rng.randint(0, 1 << 62, size=(num_perm, 1), dtype=np.int64).astype(np.uint64)
+        # Folds the rows of a band into a single bucket key
+        self._band_weights = rng.randint(0, 1 << 62, size=self.rows, dtype=np.int64).astype(np.uint64) \
+            * np.uint64(2) + np.uint64(1)
+        self._lock = threading.Lock()
+        # Number of the first campaign in `signatures` and `sizes`; those before it were cleared
+        self._first_campaign = 0
+        self.signatures = []
+        self.clear()
+
+    def clear(self) -> None:
+        """Forgets every campaign. Campaigns found afterwards get numbers not given out before."""
+        self._first_campaign += len(self.signatures)
+        self._buckets: List[Dict[int, List[int]]] = [{} for _ in range(self.bands)]
+        self.signatures: List[np.ndarray] = []
+        self.sizes: List[int] = []
+        self._verdicts: Dict[int, Tuple[Optional[str], Verdict]] = {}
+
+    def signature(self, text: str) -> Optional[np.ndarray]:
+        """The MinHash signature of a text, or None for a text too short to be grouped."""
+        shingles = shingle_hashes(text)
+        if len(shingles) < MIN_SHINGLES:
+            return None
+        return ((self._a * shingles + self._b) >> np.uint64(32)).min(axis=1)
+
+    def find(self, signature: Optional[np.ndarray]) -> Optional[int]:
+        """Returns the campaign a signature belongs to, without adding it, or None."""
+        if signature is None:
+            return None
+        with self._lock:
+            return self._find(signature)
+
+    def assign(self, texts: Sequence[str]) -> List[Optional[int]]:
+        """
+        Returns the campaign of each text, starting a new campaign for every text that belongs to none.
+        Texts too short to be grouped get None.
+        """
+        signatures = [self.signature(text) for text in texts]
+        campaigns: List[Optional[int]] = []
+        with self._lock:
+            if len(self.signatures) + len(texts) > self.max_campaigns:
+                self.clear()
+            for signature in signatures:
+                if signature is None:
+                    campaigns.append(None)
+                    continue
+                campaign = self._find(signature)
+                if campaign is None:
+                    campaign = self._first_campaign + len(self.signatures)
+                    self.signatures.append(signature)
+                    self.sizes.append(0)
+                    for band, key in enumerate(self._band_keys(signature)):
+                        self._buckets[band].setdefault(key, []).append(campaign)
+                self.sizes[campaign - self._first_campaign] += 1
+                campaigns.append(campaign)
+        return campaigns
+
+    def verdict(self, campaign: int, version: Optional[str]) -> Optional[Verdict]:
+        """The verdict of a campaign's representative, if it was made by this model version."""
+        with self._lock:
+            found = self._verdicts.get(campaign)
+        return found[1] if found is not None and found[0] == version else None
+
+    def set_verdict(self, campaign: int, version: Optional[str], verdict: Verdict) -> None:
+        with self._lock:
+            self._verdicts[campaign] = (version, verdict)
+
+    def _band_keys(self, signature: np.ndarray) -> List[int]:
+        return (signature.reshape(self.bands, self.rows) * self._band_weights).sum(axis=1).tolist()
+
+    def _find(self, signature: np.ndarray) -> Optional[int]:
+        candidates = set()
+        for band, key in enumerate(self._band_keys(signature)):
+            candidates.update(self._buckets[band].get(key, ()))
+        best, best_similarity = None, self.threshold
+        for campaign in sorted(candidates):
+            # The share of equal MinHash values estimates the Jaccard similarity of the shingle sets
+            similarity = float(np.mean(self.signatures[campaign - self._first_campaign] == signature))
+            if similarity >= best_similarity:
+                best, best_similarity = campaign, similarity
+        return best
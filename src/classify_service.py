@@ -0,0 +1,357 @@
+import argparse
+import http.client
+import json
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence
+from urllib.parse import urlsplit
+
+import numpy as np
+
+from metrics import METRICS, SIZE_BUCKETS
+from verdict_cache import model_version
+
+DEFAULT_SERVICE_HOST = '127.0.0.1'
+DEFAULT_SERVICE_PORT = 8765
+# Emails classified together at most, and how long the first request of a batch waits for others to join it
+DEFAULT_MAX_BATCH_SIZE = 256
+DEFAULT_MAX_DELAY = 0.005
+# Seconds a client waits for the service, and how long it classifies in-process after the service failed
+DEFAULT_CLIENT_TIMEOUT = 30.0
+DEFAULT_RETRY_AFTER = 30.0
+
+
+class _Request:
+    """Texts of one client request, waiting in the queue for their probabilities."""
+
+    def __init__(self, texts: Sequence[str]):
+        self.texts = texts
+        self.enqueued = time.perf_counter()
+        self.done = threading.Event()
+        self.probabilities: Optional[np.ndarray] = None
+        self.error: Optional[BaseException] = None
+
+
+class MicroBatcher:
+    """
+    Collects the texts of concurrent requests into micro-batches for one model, so many small requests share
+    one vectorizer transform and predict_proba call. A batch is run as soon as it holds `max_batch_size`
+    texts, or `max_delay` seconds after its first request arrived.
+
+    Args:
+        model: The pre-trained spam detection model.
+        max_batch_size (int): Texts handed to the model per call.
+        max_delay (float): Seconds the first request of a batch waits for others.
+    """
+
+    def __init__(self, model, max_batch_size: int = DEFAULT_MAX_BATCH_SIZE, max_delay: float = DEFAULT_MAX_DELAY):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.started = time.monotonic()
+        self.requests = 0
+        self.texts = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+        self._queue: "queue.Queue[Optional[_Request]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+        self._thread.start()
+
+    def predict_proba(self, texts: Sequence[str]) -> np.ndarray:
+        """Queues texts for the next batch and waits for their class probabilities."""
+        request = _Request(list(texts))
+        if not request.texts:
+            return np.empty((0, len(self.model.classes_)))
+        with self._lock:
+            self.requests += 1
+            self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize() + 1)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.probabilities
+
+    def close(self) -> None:
+        """Stops the batching thread once the requests already queued are answered."""
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self) -> Dict[str, object]:
+        """Requests, texts and batches served, the mean batch size, throughput and queue depth."""
+        with self._lock:
+            uptime = time.monotonic() - self.started
+            return {'model_version': model_version(self.model), 'requests': self.requests, 'texts': self.texts,
+                    'batches': self.batches,
+                    'mean_batch_size': round(self.texts / self.batches, 2) if self.batches else None,
+                    'texts_per_second': round(self.texts / uptime, 2) if uptime else None,
+                    'queue_depth': self._queue.qsize(), 'max_queue_depth': self.max_queue_depth,
+                    'uptime_seconds': round(uptime, 3)}
+
+    def _run(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch, size = [first], len(first.texts)
+            deadline = time.perf_counter() + self.max_delay
+            stopping = False
+            while size < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if request is None:
+                    stopping = True
+                    break
+                batch.append(request)
+                size += len(request.texts)
+            self._predict(batch)
+            if stopping:
+                return
+
+    def _predict(self, batch: List[_Request]) -> None:
+        texts = [text for request in batch for text in request.texts]
+        now = time.perf_counter()
+        for request in batch:
+            METRICS.observe('service_queue_wait_seconds', now - request.enqueued)
+        try:
+            # A request larger than a batch is still classified in calls of max_batch_size texts
+            with METRICS.time('model_inference_seconds'):
+                probabilities = np.vstack([self.model.predict_proba(texts[start:start + self.max_batch_size])
+                                           for start in range(0, len(texts), self.max_batch_size)])
+        except Exception as e:  # Handed to the waiting requests; the service keeps running
+            for request in batch:
+                request.error = e
+                request.done.set()
+            return
+        METRICS.observe('model_batch_size', len(texts), SIZE_BUCKETS)
+        with self._lock:
+            self.texts += len(texts)
+            self.batches += 1
+        start = 0
+        for request in batch:
+            request.probabilities = probabilities[start:start + len(request.texts)]
+            start += len(request.texts)
+            request.done.set()
+
+
+def serve(batcher: MicroBatcher, port: int = DEFAULT_SERVICE_PORT,
+          host: str = DEFAULT_SERVICE_HOST) -> ThreadingHTTPServer:
+    """
+    Serves a MicroBatcher over HTTP on a background thread and returns the server:
+    POST /classify with {"texts": [...]} answers {"probabilities": [[...], ...]}, GET /info the model's classes
+    and version, GET /stats the batcher's stats and GET /metrics the Prometheus text format.
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # Keep-alive, so clients reuse their connection
+        # Headers and body are written separately; without this, delayed ACKs add 40 ms to every response
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            path = self.path.split('?')[0]
+            if path == '/info':
+                self._reply({'classes': [_plain(label) for label in batcher.model.classes_],
+                             'model_version': model_version(batcher.model)})
+            elif path == '/stats':
+                self._reply(batcher.stats())
+            elif path == '/metrics':
+                self._reply(METRICS.to_prometheus(), 'text/plain; version=0.0.4')
+            else:
+                self.send_error(404)
+
+        def do_POST(self):
+            if self.path.split('?')[0] != '/classify':
+                self.send_error(404)
+                return
+            try:
+                texts = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))['texts']
+                if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+                    raise ValueError("texts must be a list of strings")
+            except (ValueError, KeyError, TypeError) as e:
+                self.send_error(400, str(e))
+                return
+            try:
+                probabilities = batcher.predict_proba(texts)
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+            self._reply({'probabilities': probabilities.tolist()})
+
+        def _reply(self, payload, content_type: str = 'application/json') -> None:
+            body = (payload if isinstance(payload, str) else json.dumps(payload)).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _plain(label):
+    """Class labels as JSON can carry them; numpy integers become ints."""
+    return label.item() if isinstance(label, np.generic) else label
+
+
+class ServiceClient:
+    """
+    Stands in for a model (classes_, predict_proba and predict), sending the texts to a classification service.
+    When the service cannot be reached, the texts are classified in-process with the model returned by
+    `fallback`, which is only loaded the first time it is needed; the service is tried again after
+    `retry_after` seconds. Safe to use from several threads; each one keeps its own connection.
+
+    Args:
+        url (str): Address of the service, e.g. http://127.0.0.1:8765.
+        fallback (Callable[[], object]): Loads the model for in-process inference, e.g. with load_model.
+        log_func (Callable[[str], None]): Receives a message whenever the client switches over.
+        timeout (float): Seconds to wait for the service.
+        retry_after (float): Seconds to classify in-process before trying the service again.
+    """
+
+    def __init__(self, url: str, fallback: Callable[[], object], log_func: Callable[[str], None] = print,
+                 timeout: float = DEFAULT_CLIENT_TIMEOUT, retry_after: float = DEFAULT_RETRY_AFTER):
+        parts = urlsplit(url if '//' in url else f"http://{url}")
+        self.host = parts.hostname or DEFAULT_SERVICE_HOST
+        self.port = parts.port or DEFAULT_SERVICE_PORT
+        self.fallback = fallback
+        self.log_func = log_func
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._fallback_model = None
+        self._failed_at: Optional[float] = None
+        self._info: Optional[dict] = None
+
+    @property
+    def classes_(self) -> np.ndarray:
+        info = self._service_info()
+        return np.array(info['classes']) if info is not None else self._local_model().classes_
+
+    @property
+    def verdict_cache_version(self) -> Optional[str]:
+        """The version of whichever model answers, for the VerdictCache (see verdict_cache.model_version)."""
+        info = self._service_info()
+        return info['model_version'] if info is not None else model_version(self._local_model())
+
+    def predict_proba(self, texts: Sequence[str]) -> np.ndarray:
+        texts = list(texts)
+        if self._service_info() is not None:
+            try:
+                with METRICS.time('service_request_seconds'):
+                    response = self._request('POST', '/classify', {'texts': texts})
+                return np.array(response['probabilities'], dtype=float).reshape(len(texts), -1)
+            except (OSError, http.client.HTTPException, ValueError, KeyError) as e:
+                self._fail(e)
+        METRICS.inc('service_fallback_texts_total', len(texts))
+        return self._local_model().predict_proba(texts)
+
+    def predict(self, texts: Sequence[str]) -> np.ndarray:
+        classes = self.classes_
+        return classes[self.predict_proba(texts).argmax(axis=1)]
+
+    def stats(self) -> Optional[dict]:
+        """The service's stats, or None if it cannot be reached."""
+        try:
+            return self._request('GET', '/stats')
+        except (OSError, http.client.HTTPException, ValueError):
+            return None
+
+    def _service_info(self) -> Optional[dict]:
+        """Classes and model version of the service, or None while classifying in-process."""
+        with self._lock:
+            if self._failed_at is not None and time.monotonic() - self._failed_at < self.retry_after:
+                return None
+            info = self._info
+        if info is not None:
+            return info
+        try:
+            info = self._request('GET', '/info')
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            self._fail(e)
+            return None
+        with self._lock:
+            if self._failed_at is not None:
+                self.log_func(f"Classification service at {self.host}:{self.port} is back.")
+            self._info, self._failed_at = info, None
+        return info
+
+    def _local_model(self):
+        with self._lock:
+            if self._fallback_model is None:
+                self._fallback_model = self.fallback()
+            return self._fallback_model
+
+    def _fail(self, error: Exception) -> None:
+        with self._lock:
+            if self._failed_at is None:
+                self.log_func(f"Classification service at {self.host}:{self.port} not available ({error}). "
+                              "Classifying in this process.")
+            self._failed_at = time.monotonic()
+            self._info = None
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self._local.connection = None
+
+    def _request(self, method: str, path: str, payload: Optional[dict] = None) -> dict:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout)
+        body = json.dumps(payload).encode() if payload is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        try:
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self._local.connection = None
+            raise
+        if response.status != 200:
+            raise ValueError(f"HTTP {response.status} {response.reason}")
+        return json.loads(data)
+
+
+def main() -> None:
+    from spam_detector import DEFAULT_MODEL_PATH, load_model  # Only the service itself loads the model
+
+    parser = argparse.ArgumentParser(description="Share one loaded model between scanners on this computer.")
+    parser.add_argument('--model', default=str(DEFAULT_MODEL_PATH))
+    parser.add_argument('--host', default=DEFAULT_SERVICE_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_SERVICE_PORT)
+    parser.add_argument('--max-batch-size', type=int, default=DEFAULT_MAX_BATCH_SIZE)
+    parser.add_argument('--max-delay-ms', type=float, default=DEFAULT_MAX_DELAY * 1000,
+                        help="How long a request may wait for others to share its batch")
+    args = parser.parse_args()
+
+    batcher = MicroBatcher(load_model(args.model, print), args.max_batch_size, args.max_delay_ms / 1000)
+    server = serve(batcher, args.port, args.host)
+    print(f"Classifying at http://{args.host}:{args.port}; stats at /stats. Press Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(60)
+            stats = batcher.stats()
+            print(f"{stats['texts']} emails in {stats['batches']} batches, mean batch {stats['mean_batch_size']}, "
+                  f"queue {stats['queue_depth']}")
+    except KeyboardInterrupt:
+        server.shutdown()
+        batcher.close()
+
+
+if __name__ == "__main__":
+    main()
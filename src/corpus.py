@@ -0,0 +1,144 @@
+import mmap
+import os
+import re
+from itertools import islice
+from multiprocessing import Pool
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple, Optional, Tuple, Union
+
+from message_parser import parse_message
+
+# Raw messages handed to the process pool per round; bounds how much of an archive is in memory at once
+DEFAULT_WINDOW = 4096
+
+_ESCAPED_FROM = re.compile(rb'^>+From ')
+
+
+class MessageRef(NamedTuple):
+    """Where a message of an archive is stored: a whole file, or the bytes start:end of an mbox file."""
+    path: str
+    start: int = 0
+    end: Optional[int] = None
+
+
+def iter_mbox(path: Union[str, Path]) -> Iterator[bytes]:
+    """
+    Yields the raw messages of an mbox file one at a time, reading it line by line. Lines quoted as ">From "
+    are unquoted (mboxrd).
+    """
+    lines = []
+    with open(path, 'rb') as file:
+        for line in file:
+            if line.startswith(b'From '):
+                if lines:
+                    yield b''.join(lines)
+                lines = []
+                continue
+            if _ESCAPED_FROM.match(line):
+                line = line[1:]
+            lines.append(line)
+    if lines:
+        yield b''.join(lines)
+
+
+def iter_mbox_spans(path: Union[str, Path]) -> Iterator[Tuple[int, int]]:
+    """
+    Yields (start, end) byte offsets of the messages of an mbox file, the same messages iter_mbox yields,
+    without reading them: the file is memory-mapped and only searched for "From " lines. Quoted ">From "
+    lines are left as they are.
+    """
+    with open(path, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            size = len(mapped)
+            start = 0
+            while start < size:
+                if mapped[start:start + 5] == b'From ':
+                    line_end = mapped.find(b'\n', start)
+                    start = size if line_end < 0 else line_end + 1
+                    continue
+                separator = mapped.find(b'\nFrom ', start)
+                end = size if separator < 0 else separator + 1
+                yield start, end
+                start = end
+
+
+def maildir_paths(path: Union[str, Path]) -> Iterator[Path]:
+    """Yields the message files of a Maildir and of every Maildir++ subfolder (.Sent, .Junk, ...) inside it."""
+    path = Path(path)
+    for subdir in ('cur', 'new'):
+        if (path / subdir).is_dir():
+            for message_path in sorted((path / subdir).iterdir()):
+                if message_path.is_file():
+                    yield message_path
+    for child in sorted(path.iterdir()):
+        if child.is_dir() and child.name not in ('cur', 'new', 'tmp') and is_maildir(child):
+            yield from maildir_paths(child)
+
+
+def iter_maildir(path: Union[str, Path]) -> Iterator[bytes]:
+    """Yields the raw messages of a Maildir and of every Maildir++ subfolder (.Sent, .Junk, ...) inside it."""
+    for message_path in maildir_paths(path):
+        yield message_path.read_bytes()
+
+
+def iter_eml_dir(path: Union[str, Path]) -> Iterator[bytes]:
+    """Yields every .eml file below a directory."""
+    for message_path in sorted(Path(path).rglob('*.eml')):
+        yield message_path.read_bytes()
+
+
+def is_maildir(path: Path) -> bool:
+    return (path / 'cur').is_dir() or (path / 'new').is_dir()
+
+
+def iter_messages(path: Union[str, Path]) -> Iterator[bytes]:
+    """Yields the raw messages of an mbox file, a single .eml file, a Maildir or a directory of .eml files."""
+    path = Path(path)
+    if path.is_file():
+        if path.suffix.lower() == '.eml':
+            yield path.read_bytes()
+        else:
+            yield from iter_mbox(path)
+    elif is_maildir(path):
+        yield from iter_maildir(path)
+    elif path.is_dir():
+        yield from iter_eml_dir(path)
+    else:
+        raise FileNotFoundError(f"No mail archive at {path}")
+
+
+def iter_message_refs(path: Union[str, Path]) -> Iterator[MessageRef]:
+    """
+    Yields where each message of an archive is, in the order of iter_messages, without reading any of them,
+    so that other processes can read and parse the messages themselves.
+    """
+    path = Path(path)
+    if path.is_file():
+        if path.suffix.lower() == '.eml':
+            yield MessageRef(str(path))
+        else:
+            yield from (MessageRef(str(path), start, end) for start, end in iter_mbox_spans(path))
+    elif is_maildir(path):
+        yield from (MessageRef(str(message_path)) for message_path in maildir_paths(path))
+    elif path.is_dir():
+        yield from (MessageRef(str(message_path)) for message_path in sorted(path.rglob('*.eml')))
+    else:
+        raise FileNotFoundError(f"No mail archive at {path}")
+
+
+def parse_messages(raw_messages: Iterable[bytes], processes: Optional[int] = None,
+                   window: int = DEFAULT_WINDOW) -> Iterator[Tuple[str, str, str]]:
+    """
+    Parses raw messages on a process pool and yields (sender, subject, body) in input order. At most `window`
+    messages are read ahead, so arbitrarily large archives are streamed.
+    """
+    raw_messages = iter(raw_messages)
+    processes = processes or os.cpu_count() or 1
+    with Pool(processes) as pool:
+        while True:
+            batch = list(islice(raw_messages, window))
+            if not batch:
+                return
+            yield from pool.imap(parse_message, batch, chunksize=max(1, len(batch) // (4 * processes)))
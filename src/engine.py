@@ -0,0 +1,217 @@
+import imaplib
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, Optional, Union
+
+import pandas as pd
+
+from keep_list import KeepListMatcher, compile_keep_list
+from message_parser import DEFAULT_MAX_BODY_BYTES
+from scan_state import ScanStateStore
+from spam_detector import DEFAULT_BATCH_SIZE, DEFAULT_SCAN_LIMIT, filter_folder, get_mail_server
+from verdict_cache import VerdictCache
+
+# Accounts scanned at the same time
+DEFAULT_MAX_WORKERS = 4
+# Logged-in connections kept open per account
+DEFAULT_POOL_SIZE = 2
+
+
+def connect_ssl(usr: str) -> imaplib.IMAP4:
+    """Opens an SSL connection to the IMAP server of an email address."""
+    server = get_mail_server(usr or "")
+    if not server:
+        raise ValueError(f"Mail server for '{(usr or '').split('@')[-1]}' not supported.")
+    return imaplib.IMAP4_SSL(server)
+
+
+class ConnectionPool:
+    """
+    Hands out logged-in connections to one account, creating at most `size` of them and reusing them across
+    scans. Idle connections are checked with NOOP before being handed out again; broken ones are dropped.
+    """
+
+    def __init__(self, connect: Callable[[], imaplib.IMAP4], usr: str, pw: str, size: int = DEFAULT_POOL_SIZE):
+        self.connect = connect
+        self.usr = usr
+        self.pw = pw
+        self._idle: "queue.LifoQueue[imaplib.IMAP4]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self) -> Iterator[imaplib.IMAP4]:
+        """Borrows a connection for the duration of the with block, waiting if all of them are in use."""
+        with self._slots:
+            mail = self._checkout()
+            broken = False
+            try:
+                yield mail
+            except (OSError, imaplib.IMAP4.abort):
+                broken = True
+                raise
+            finally:
+                if broken:
+                    self._discard(mail)
+                else:
+                    self._idle.put(mail)
+
+    def _checkout(self) -> imaplib.IMAP4:
+        while True:
+            try:
+                mail = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                mail.noop()
+                return mail
+            except (OSError, imaplib.IMAP4.error):
+                self._discard(mail)
+        mail = self.connect()
+        mail.login(self.usr, self.pw)
+        return mail
+
+    @staticmethod
+    def _discard(mail: imaplib.IMAP4) -> None:
+        try:
+            mail.logout()
+        except (OSError, imaplib.IMAP4.error):
+            pass
+
+    def close(self) -> None:
+        """Logs out every idle connection."""
+        while True:
+            try:
+                self._discard(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+class ScanEngine:
+    """
+    Scans several accounts at the same time on a bounded thread pool. Every account gets its own connection
+    pool, kept for the lifetime of the engine, and all of them share one model and one compiled keep list.
+
+    Args:
+        accounts (Dict[str, Dict[str, str]]): Credential sets by name, as stored in email_data.json.
+        model: The pre-trained spam detection model.
+        keep_df: DataFrame housing any keyword arguments that force the model NOT to classify as spam
+        log_func (Callable[[str], None]): Receives progress messages, prefixed with the account name.
+        add_to_list_func (Callable[[str, str, str, str, str], None]): Receives (account name, uid, sender, subject,
+            body) of every spam email.
+        max_workers (int): Accounts scanned at the same time.
+        pool_size (int): Connections kept open per account.
+        state_path (Optional[Path]): ScanStateStore database for incremental scans.
+        connect (Callable[[str], imaplib.IMAP4]): Opens a connection for an email address.
+        batch_size (int): Emails fetched and classified per chunk.
+        max_body_bytes (Optional[int]): Bytes of each email's text part downloaded and classified.
+        parse_processes (Optional[int]): When given, fetched emails are decoded on a process pool of this size,
+            shared by all accounts, while the next chunk is being fetched.
+        cache (Optional[VerdictCache]): Verdicts shared by all accounts, so an email sent to several of them is
+            only classified once.
+        group_campaigns (bool): Whether near-identical emails of an account's scan share the verdict of the
+            first one (see CampaignIndex).
+        shards (int): Pooled connections each account's scan splits its emails among; at most pool_size.
+        limit (Optional[int]): Emails checked per account, newest first or from the checkpoint with a state
+            store, or None for all of them.
+    """
+
+    def __init__(self, accounts: Dict[str, Dict[str, str]], model, keep_df: Union[pd.DataFrame, KeepListMatcher],
+                 log_func: Callable[[str], None], add_to_list_func: Callable[[str, str, str, str, str], None],
+                 max_workers: int = DEFAULT_MAX_WORKERS, pool_size: int = DEFAULT_POOL_SIZE,
+                 state_path: Optional[Path] = None, connect: Callable[[str], imaplib.IMAP4] = connect_ssl,
+                 batch_size: int = DEFAULT_BATCH_SIZE, max_body_bytes: Optional[int] = DEFAULT_MAX_BODY_BYTES,
+                 parse_processes: Optional[int] = None, cache: Optional[VerdictCache] = None,
+                 group_campaigns: bool = False, shards: int = 1, limit: Optional[int] = DEFAULT_SCAN_LIMIT):
+        self.accounts = accounts
+        self.model = model
+        self.keep_matcher = compile_keep_list(keep_df)
+        self.log_func = log_func
+        self.add_to_list_func = add_to_list_func
+        self.pool_size = pool_size
+        self.state_path = state_path
+        self.connect = connect
+        self.batch_size = batch_size
+        self.max_body_bytes = max_body_bytes
+        self.parse_pool = ProcessPoolExecutor(parse_processes) if parse_processes else None
+        self.cache = cache
+        self.group_campaigns = group_campaigns
+        self.shards = max(1, min(shards, pool_size))
+        self.limit = limit
+
+        self.pools: Dict[str, ConnectionPool] = {}
+        self._pools_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="scan")
+
+    def configure(self, model, keep_df: Union[pd.DataFrame, KeepListMatcher], state_path: Optional[Path],
+                  limit: Optional[int], group_campaigns: bool) -> None:
+        """
+        Replaces the settings later scans run with, keeping the open connections. Scans already running finish
+        with the settings they started with.
+        """
+        self.model = model
+        self.keep_matcher = compile_keep_list(keep_df)
+        self.state_path = state_path
+        self.limit = limit
+        self.group_campaigns = group_campaigns
+
+    def pool(self, name: str) -> ConnectionPool:
+        """Returns the connection pool of an account, creating it on first use."""
+        with self._pools_lock:
+            if name not in self.pools:
+                credentials = self.accounts[name]
+                usr = credentials.get("user")
+                self.pools[name] = ConnectionPool(lambda: self.connect(usr), usr, credentials.get("pass"),
+                                                  self.pool_size)
+            return self.pools[name]
+
+    def scan(self, names: Optional[Iterable[str]] = None, folder: str = 'inbox',
+             cancel: Optional[threading.Event] = None) -> Dict[str, Optional[int]]:
+        """
+        Scans the named accounts (all of them by default) and waits for every scan to finish.
+        Returns the number of spam emails found per account, or None for accounts whose scan failed.
+        Setting `cancel` stops every scan after the chunks in progress.
+        """
+        names = list(self.accounts) if names is None else list(names)
+        futures = {name: self._executor.submit(self.scan_account, name, folder, cancel) for name in names}
+        return {name: future.result() for name, future in futures.items()}
+
+    def scan_account(self, name: str, folder: str = 'inbox', cancel: Optional[threading.Event] = None) -> Optional[int]:
+        """Scans a single account on the calling thread."""
+
+        def log(message: str) -> None:
+            self.log_func(f"[{name}] {message}")
+
+        def add_to_list(uid: str, from_: str, subject: str, body: str) -> None:
+            self.add_to_list_func(name, uid, from_, subject, body)
+
+        # Read once, so configure() does not change a scan that is already running
+        model, keep_matcher, state_path, limit, group_campaigns = \
+            self.model, self.keep_matcher, self.state_path, self.limit, self.group_campaigns
+        state_store = ScanStateStore(state_path) if state_path else None
+        try:
+            with ExitStack() as connections:
+                pool = self.pool(name)
+                mail, *extra = [connections.enter_context(pool.connection()) for _ in range(self.shards)]
+                spam_count = filter_folder(mail, pool.usr, keep_matcher, model, log, add_to_list,
+                                           self.batch_size, self.max_body_bytes, state_store, folder,
+                                           self.parse_pool, self.cache, group_campaigns, limit,
+                                           connections=extra, cancel=cancel)
+            log(f"Email filtering complete. {spam_count} spam email(s) found.")
+            return spam_count
+        except (OSError, ValueError, imaplib.IMAP4.error) as e:
+            log(f"Scan failed: {e}")
+            return None
+        finally:
+            if state_store is not None:
+                state_store.close()
+
+    def close(self) -> None:
+        """Waits for running scans, then logs out of every pooled connection."""
+        self._executor.shutdown(wait=True)
+        if self.parse_pool is not None:
+            self.parse_pool.shutdown()
+        for pool in self.pools.values():
+            pool.close()
@@ -0,0 +1,74 @@
+import re
+from email.message import Message
+from pathlib import Path
+from typing import Sequence, Tuple, Union
+
+from message_parser import decode_header_value, parse_headers
+
+DEFAULT_HEADER_MODEL_PATH = Path("../models/header_classifier.joblib")
+# Header fields the header model looks at, fetched instead of imap_fetch.HEADER_FIELDS
+CASCADE_HEADER_FIELDS = ('FROM', 'SUBJECT', 'DATE', 'MESSAGE-ID', 'LIST-UNSUBSCRIBE', 'LIST-ID', 'PRECEDENCE',
+                         'REPLY-TO', 'RECEIVED')
+# Spam probabilities of the header model between these bounds are too uncertain to decide without the body
+DEFAULT_UNCERTAINTY_BAND = (0.1, 0.9)
+# Received counts above this are all alike
+MAX_RECEIVED = 8
+
+_HEADER_END = re.compile(rb'\r?\n\r?\n')
+
+
+def _domain(address: str) -> str:
+    return address.strip().strip('<>').split('@')[-1].rstrip('>').lower()
+
+
+def build_header_input(headers: Message) -> str:
+    """
+    Builds the text the header model is trained on: the sender's domain and the subject, as in
+    build_model_input, followed by one made-up word per header signal (hdrlistunsubscribe, hdrreceived3, ...)
+    that the vectorizer treats like any other word.
+    """
+    sender = decode_header_value(headers['from'])
+    subject = decode_header_value(headers['subject'])
+    signals = [f"hdrreceived{min(len(headers.get_all('received') or ()), MAX_RECEIVED)}"]
+    if headers['list-unsubscribe']:
+        signals.append('hdrlistunsubscribe')
+    if headers['list-id']:
+        signals.append('hdrlistid')
+    if (headers['precedence'] or '').strip().lower() in ('bulk', 'list', 'junk'):
+        signals.append('hdrbulk')
+    if not headers['message-id']:
+        signals.append('hdrnomessageid')
+    if not headers['date']:
+        signals.append('hdrnodate')
+    reply_to = decode_header_value(headers['reply-to'])
+    if reply_to and _domain(reply_to) != _domain(sender):
+        signals.append('hdrreplytoelsewhere')
+    return f"{_domain(sender)} {subject} {' '.join(signals)}"
+
+
+def header_input_from_raw(raw: Union[bytes, str]) -> str:
+    """The header model's input for a raw message, or for just its header block."""
+    if isinstance(raw, str):
+        raw = raw.encode('utf-8', errors='replace')
+    # Only the header block is parsed; the body is never looked at
+    end = _HEADER_END.search(raw)
+    return build_header_input(parse_headers(raw[:end.end()] if end else raw))
+
+
+def create_header_model(texts: Sequence[str], labels: Sequence[int]):
+    """
+    Trains a TfidfVectorizer + MultinomialNB pipeline on header inputs (see build_header_input), the same kind
+    of model as the offline body model, so it loads through load_model and exports to the compact format.
+    """
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.naive_bayes import MultinomialNB
+    from sklearn.pipeline import make_pipeline
+
+    model = make_pipeline(TfidfVectorizer(), MultinomialNB())
+    model.fit(list(texts), list(labels))
+    return model
+
+
+def is_uncertain(score: float, band: Tuple[float, float] = DEFAULT_UNCERTAINTY_BAND) -> bool:
+    """Whether a header model's spam probability falls inside the uncertainty band."""
+    return band[0] < score < band[1]
@@ -0,0 +1,539 @@
+import imaplib
+import re
+import time
+from datetime import date
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+from message_parser import DEFAULT_MAX_BODY_BYTES, decode_body, decode_header_value, parse_headers
+from metrics import METRICS
+
+# Header fields requested for every message; the body is only fetched for the selected text part
+HEADER_FIELDS = ('FROM', 'SUBJECT', 'DATE', 'MESSAGE-ID')
+
+# Longest UID set put in a single command; servers commonly reject command lines beyond about 8 KB
+MAX_UID_SET_LENGTH = 4000
+# Longest search criteria put in a single SEARCH command, for the same reason
+MAX_SEARCH_LENGTH = 4000
+# UIDs covered by the first SEARCH of iter_uids; the window doubles while the UIDs found in it are sparse
+DEFAULT_SEARCH_WINDOW = 4096
+MAX_SEARCH_WINDOW = 1 << 20
+
+# SEARCH dates use English month names whatever the locale
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+_ESEARCH_TAG = re.compile(r'^\s*\([^)]*\)')
+
+_LITERAL_MARKER = re.compile(rb'\{(\d+)\}\s*$')
+
+
+class FetchedEmail(NamedTuple):
+    uid: int
+    sender: str
+    subject: str
+    body: str
+
+
+class RawEmail(NamedTuple):
+    """The undecoded header block and text part of an email, as fetched from the server."""
+    uid: int
+    header: bytes
+    payload: Optional[bytes]
+    encoding: str
+    charset: Optional[str]
+    subtype: str
+
+
+class _Token:
+    def __init__(self, name: str):
+        self.name = name
+
+    def __repr__(self) -> str:
+        return self.name
+
+
+_OPEN = _Token('(')
+_CLOSE = _Token(')')
+
+
+def format_uid_set(uids: Iterable[int]) -> str:
+    """
+    Compresses UIDs into an IMAP sequence set, e.g. [1, 2, 3, 7, 9, 10] -> '1:3,7,9:10'.
+    """
+    ranges = []
+    for uid in sorted(set(int(uid) for uid in uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(start) if start == end else f"{start}:{end}" for start, end in ranges)
+
+
+def uid_set_chunks(uids: Iterable[int], max_length: int = MAX_UID_SET_LENGTH) -> Iterator[Tuple[List[int], str]]:
+    """
+    Splits UIDs into compressed IMAP sequence sets no longer than `max_length` characters.
+    Yields (uids, sequence set) for each chunk.
+    """
+    chunk: List[int] = []
+    ranges: List[List[int]] = []
+    length = 0
+
+    def token(start: int, end: int) -> str:
+        return str(start) if start == end else f"{start}:{end}"
+
+    for uid in sorted(set(int(uid) for uid in uids)):
+        if ranges and uid == ranges[-1][1] + 1:
+            grown = length - len(token(*ranges[-1])) + len(token(ranges[-1][0], uid))
+            if grown <= max_length:
+                ranges[-1][1] = uid
+                chunk.append(uid)
+                length = grown
+                continue
+        elif ranges and length + 1 + len(str(uid)) <= max_length:
+            ranges.append([uid, uid])
+            chunk.append(uid)
+            length += 1 + len(str(uid))
+            continue
+        if chunk:
+            yield chunk, ','.join(token(start, end) for start, end in ranges)
+        chunk, ranges, length = [uid], [[uid, uid]], len(str(uid))
+    if chunk:
+        yield chunk, ','.join(token(start, end) for start, end in ranges)
+
+
+def _tokenize(data: Sequence) -> Iterator:
+    """
+    Splits the raw data returned by imaplib into tokens. Literals arrive as (prefix, literal) tuples and are
+    yielded as a single bytes token in place of their {size} marker.
+    """
+    for item in data:
+        literal = None
+        if isinstance(item, tuple):
+            text, literal = item
+            text = _LITERAL_MARKER.sub(b'', text)
+        else:
+            text = item
+        yield from _tokenize_text(text or b'')
+        if literal is not None:
+            yield literal
+
+
+def _tokenize_text(text: bytes) -> Iterator:
+    position, length = 0, len(text)
+    while position < length:
+        char = text[position:position + 1]
+        if char in (b' ', b'\r', b'\n', b'\t'):
+            position += 1
+        elif char == b'(':
+            position += 1
+            yield _OPEN
+        elif char == b')':
+            position += 1
+            yield _CLOSE
+        elif char == b'"':
+            position += 1
+            value = bytearray()
+            while position < length and text[position:position + 1] != b'"':
+                if text[position:position + 1] == b'\\':
+                    position += 1
+                value += text[position:position + 1]
+                position += 1
+            position += 1
+            yield bytes(value)
+        else:
+            # Atom; section specifiers such as BODY[HEADER.FIELDS (FROM)] may contain spaces and parentheses
+            start, depth = position, 0
+            while position < length:
+                char = text[position:position + 1]
+                if char == b'[':
+                    depth += 1
+                elif char == b']':
+                    depth -= 1
+                elif depth == 0 and char in (b' ', b'(', b')', b'\r', b'\n'):
+                    break
+                position += 1
+            atom = text[start:position]
+            yield None if atom.upper() == b'NIL' else atom
+
+
+def _parse(tokens: Iterator) -> list:
+    values = []
+    for token in tokens:
+        if token is _OPEN:
+            values.append(_parse(tokens))
+        elif token is _CLOSE:
+            return values
+        else:
+            values.append(token)
+    return values
+
+
+def parse_fetch_response(data: Sequence) -> Dict[int, Dict[bytes, object]]:
+    """
+    Parses the data of a UID FETCH response into {uid: {ITEM NAME: value}}.
+    """
+    values = _parse(_tokenize(data))
+    responses = {}
+    for attributes in values:
+        if not isinstance(attributes, list):
+            continue  # Message sequence number preceding the attribute list
+        items = {}
+        for key, value in zip(attributes[::2], attributes[1::2]):
+            if isinstance(key, bytes):
+                items[key.upper()] = value
+        if b'UID' in items:
+            responses.setdefault(int(items.pop(b'UID')), {}).update(items)
+    return responses
+
+
+def _text(value) -> str:
+    if isinstance(value, bytes):
+        return value.decode('ascii', errors='replace').lower()
+    return ''
+
+
+def find_text_part(structure: list, section: str = '') -> Optional[Tuple[str, str, Optional[str], str]]:
+    """
+    Walks a parsed BODYSTRUCTURE and returns (section, transfer encoding, charset, subtype) of the first
+    text/plain part, or of the first text/html part when there is no plain text.
+    A single-part message always returns its only part, whatever its type.
+    """
+    if not structure:
+        return None
+    if isinstance(structure[0], list):
+        children = []
+        for part in structure:
+            if not isinstance(part, list):
+                break
+            children.append(part)
+        html_part = None
+        for number, part in enumerate(children, start=1):
+            found = find_text_part(part, f"{section}.{number}" if section else str(number))
+            if found and found[3] == 'plain':
+                return found
+            html_part = html_part or found
+        return html_part
+
+    content_type = f"{_text(structure[0])}/{_text(structure[1])}"
+    if section and content_type not in ('text/plain', 'text/html'):
+        return None
+    params = structure[2] if len(structure) > 2 and isinstance(structure[2], list) else []
+    charset = None
+    for name, value in zip(params[::2], params[1::2]):
+        if _text(name) == 'charset':
+            charset = _text(value)
+    encoding = _text(structure[5]) if len(structure) > 5 else ''
+    return section or '1', encoding or '7bit', charset, _text(structure[1])
+
+
+def _find_item(items: Dict[bytes, object], prefix: bytes):
+    for key, value in items.items():
+        if key.startswith(prefix):
+            return value
+    return None
+
+
+def uid_command(mail: imaplib.IMAP4, command: str, *args) -> Tuple[str, list]:
+    """Runs a UID command, recording its round trip time in the imap_command_seconds metric."""
+    with METRICS.time('imap_command_seconds', command=command):
+        return mail.uid(command, *args)
+
+
+def _uid_fetch(mail: imaplib.IMAP4, uids: Iterable[int], query: str) -> Dict[int, Dict[bytes, object]]:
+    typ, data = uid_command(mail, 'FETCH', format_uid_set(uids), query)
+    if typ != 'OK':
+        raise imaplib.IMAP4.error(f"FETCH failed: {data}")
+    METRICS.inc('imap_fetched_bytes_total', sum(len(part) for item in data
+                                                for part in (item if isinstance(item, tuple) else (item,))
+                                                if isinstance(part, bytes)))
+    with METRICS.time('parse_seconds', stage='response'):
+        return parse_fetch_response(data)
+
+
+def fetch_headers(mail: imaplib.IMAP4, uids: Sequence[int],
+                  fields: Sequence[str] = HEADER_FIELDS) -> Dict[int, Dict[bytes, object]]:
+    """
+    Downloads the given header fields and the body structure of many emails with one FETCH command, without
+    marking them as read. Returns the parsed response by UID, for header_bytes and fetch_raw.
+    """
+    if not uids:
+        return {}
+    return _uid_fetch(mail, uids, f"(BODY.PEEK[HEADER.FIELDS ({' '.join(fields)})] BODYSTRUCTURE)")
+
+
+def header_bytes(items: Dict[bytes, object]) -> bytes:
+    """The header block of one email in a fetch_headers response."""
+    value = _find_item(items, b'BODY[HEADER')
+    return value if isinstance(value, bytes) else b''
+
+
+def fetch_raw(mail: imaplib.IMAP4, uids: Sequence[int],
+              max_body_bytes: Optional[int] = DEFAULT_MAX_BODY_BYTES,
+              headers: Optional[Dict[int, Dict[bytes, object]]] = None,
+              body_uids: Optional[Iterable[int]] = None) -> List[RawEmail]:
+    """
+    Downloads what classification needs from many emails, without decoding it: one FETCH command for the
+    headers and body structures, plus one FETCH per distinct text part section. BODY.PEEK is used throughout
+    so the messages are never marked as read.
+
+    Args:
+        mail (imaplib.IMAP4): A logged-in connection with a mailbox selected.
+        uids (Sequence[int]): UIDs of the emails to fetch.
+        max_body_bytes (Optional[int]): Only download the first max_body_bytes of each text part.
+        headers (Optional[Dict[int, Dict[bytes, object]]]): The emails' fetch_headers response, if it was
+            already downloaded.
+        body_uids (Optional[Iterable[int]]): Only download the text parts of these emails; the others get a
+            payload of None. All of them by default.
+
+    Returns:
+        List[RawEmail]: The fetched emails, in the order of `uids`. UIDs the server did not return are skipped.
+    """
+    if not uids:
+        return []
+    if headers is None:
+        headers = fetch_headers(mail, uids)
+    wanted = set(int(uid) for uid in body_uids) if body_uids is not None else None
+
+    # Group the UIDs by the section holding their text so each group needs a single FETCH
+    sections: Dict[str, List[int]] = {}
+    text_parts: Dict[int, Tuple[str, str, Optional[str], str]] = {}
+    for uid, items in headers.items():
+        structure = items.get(b'BODYSTRUCTURE')
+        part = find_text_part(structure) if isinstance(structure, list) else None
+        if part:
+            text_parts[uid] = part
+            if wanted is None or uid in wanted:
+                sections.setdefault(part[0], []).append(uid)
+
+    payloads: Dict[int, bytes] = {}
+    partial = f"<0.{max_body_bytes}>" if max_body_bytes else ""
+    for section, section_uids in sections.items():
+        for uid, items in _uid_fetch(mail, section_uids, f"(BODY.PEEK[{section}]{partial})").items():
+            payload = _find_item(items, f"BODY[{section}]".encode())
+            if isinstance(payload, bytes):
+                payloads[uid] = payload
+
+    raw_emails = []
+    for uid in uids:
+        items = headers.get(int(uid))
+        if items is None:
+            continue
+        _, encoding, charset, subtype = text_parts.get(int(uid), ('', '', None, 'plain'))
+        raw_emails.append(RawEmail(int(uid), header_bytes(items), payloads.get(int(uid)), encoding, charset,
+                                   subtype))
+    return raw_emails
+
+
+def decode_emails(raw_emails: Sequence[RawEmail],
+                  max_body_bytes: Optional[int] = DEFAULT_MAX_BODY_BYTES) -> List[FetchedEmail]:
+    """
+    Decodes the headers and text parts fetched by fetch_raw. Pure computation, so it can run in a process pool
+    while the next chunk is being fetched.
+    """
+    start = time.perf_counter()
+    fetched = []
+    for raw in raw_emails:
+        headers = parse_headers(raw.header)
+        body = decode_body(raw.payload, raw.encoding, raw.charset, raw.subtype, max_body_bytes) \
+            if raw.payload is not None else ""
+        fetched.append(FetchedEmail(raw.uid, decode_header_value(headers['from']),
+                                    decode_header_value(headers['subject']), body))
+    METRICS.observe('parse_seconds', time.perf_counter() - start, stage='decode')
+    return fetched
+
+
+def fetch_emails(mail: imaplib.IMAP4, uids: Sequence[int],
+                 max_body_bytes: Optional[int] = DEFAULT_MAX_BODY_BYTES) -> List[FetchedEmail]:
+    """
+    Fetches the sender, subject and first text part (plain text, or HTML stripped to its text) of many emails.
+    See fetch_raw and decode_emails.
+    """
+    fetched = decode_emails(fetch_raw(mail, uids, max_body_bytes), max_body_bytes)
+    METRICS.inc('emails_fetched_total', len(fetched))
+    return fetched
+
+
+def get_uidvalidity(mail: imaplib.IMAP4, folder: str) -> Optional[int]:
+    """
+    Returns the UIDVALIDITY of the selected folder, asking the server with STATUS if SELECT did not report it.
+    """
+    typ, data = mail.response('UIDVALIDITY')
+    if data and data[0]:
+        return int(data[-1])
+    typ, data = mail.status(folder, '(UIDVALIDITY)')
+    if typ == 'OK' and data and data[0]:
+        words = data[0].decode(errors='replace').replace('(', ' ').replace(')', ' ').split()
+        for name, value in zip(words, words[1:]):
+            if name.upper() == 'UIDVALIDITY':
+                return int(value)
+    return None
+
+
+def search_uids(mail: imaplib.IMAP4, min_uid: int = 1) -> List[int]:
+    """
+    Returns the UIDs of the selected folder from `min_uid` upwards, in ascending order.
+    """
+    typ, data = uid_command(mail, 'SEARCH', None, 'ALL' if min_uid <= 1 else f"UID {min_uid}:*")
+    if typ != 'OK':
+        raise imaplib.IMAP4.error(f"SEARCH failed: {data}")
+    # 'n:*' always includes the highest UID, even when it is below n
+    return sorted(uid for uid in (int(uid) for uid in b' '.join(data).split()) if uid >= min_uid)
+
+
+def format_search_date(day: date) -> str:
+    """Formats a date for SINCE and BEFORE criteria, e.g. 7-Mar-2024."""
+    return f"{day.day}-{_MONTHS[day.month - 1]}-{day.year}"
+
+
+def parse_uid_set(text: str) -> List[int]:
+    """Expands an IMAP sequence set of UIDs, e.g. '1:3,7' -> [1, 2, 3, 7]."""
+    uids: List[int] = []
+    for part in text.split(','):
+        if not part:
+            continue
+        start, _, end = part.partition(':')
+        low, high = sorted((int(start), int(end or start)))
+        uids.extend(range(low, high + 1))
+    return uids
+
+
+def esearch(mail: imaplib.IMAP4, return_options: str, *criteria: str) -> Dict[str, str]:
+    """
+    Runs UID SEARCH RETURN (`return_options`) on a server with the ESEARCH capability and returns the result
+    items by name, e.g. {'MIN': '4', 'MAX': '90', 'COUNT': '12'}. Items with no value, such as MIN when
+    nothing matched, are missing.
+    """
+    typ, data = uid_command(mail, 'SEARCH', 'RETURN', f"({return_options})", *criteria)
+    if typ != 'OK':
+        raise imaplib.IMAP4.error(f"SEARCH failed: {data}")
+    # imaplib only collects SEARCH responses; the ESEARCH one is still waiting among the untagged responses
+    typ, data = mail.response('ESEARCH')
+    line = next((item for item in reversed(data or ()) if item), b'')
+    words = _ESEARCH_TAG.sub('', line.decode(errors='replace')).split()
+    if words and words[0].upper() == 'UID':
+        words = words[1:]
+    return {name.upper(): value for name, value in zip(words[::2], words[1::2])}
+
+
+def uid_bounds(mail: imaplib.IMAP4, min_uid: int = 1, criteria: Sequence[str] = ()) -> Optional[Tuple[int, int]]:
+    """
+    Returns the lowest and highest UID of the selected folder from `min_uid` upwards, or None if there are
+    none. With ESEARCH both come from a single command that also applies `criteria`; otherwise the highest UID
+    is asked for and `min_uid` is taken as the lowest.
+    """
+    if 'ESEARCH' in mail.capabilities:
+        found = esearch(mail, 'MIN MAX', f"UID {max(min_uid, 1)}:*", *criteria)
+        if 'MAX' not in found:
+            return None
+        low, high = int(found['MIN']), int(found['MAX'])
+    else:
+        typ, data = uid_command(mail, 'SEARCH', None, 'UID *')
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"SEARCH failed: {data}")
+        uids = [int(uid) for uid in b' '.join(part for part in data if part).split()]
+        if not uids:
+            return None
+        low, high = min_uid, max(uids)
+    # 'n:*' always includes the highest UID, even when it is below n
+    if high < min_uid:
+        return None
+    return max(low, min_uid, 1), high
+
+
+def _search_window(mail: imaplib.IMAP4, low: int, high: int, criteria: Sequence[str], use_esearch: bool) -> List[int]:
+    if use_esearch:
+        # The result comes back as a compressed sequence set instead of one number per email
+        return parse_uid_set(esearch(mail, 'ALL', f"UID {low}:{high}", *criteria).get('ALL', ''))
+    typ, data = uid_command(mail, 'SEARCH', None, f"UID {low}:{high}", *criteria)
+    if typ != 'OK':
+        raise imaplib.IMAP4.error(f"SEARCH failed: {data}")
+    return [int(uid) for uid in b' '.join(part for part in data if part).split()]
+
+
+def iter_uids(mail: imaplib.IMAP4, min_uid: int = 1, since: Optional[date] = None, newest_first: bool = True,
+              window: int = DEFAULT_SEARCH_WINDOW) -> Iterator[int]:
+    """
+    Yields the UIDs of the selected folder from `min_uid` upwards, newest first unless `newest_first` is False.
+    With `since`, only emails received on or after that day are yielded.
+    The folder is searched one range of `window` UIDs at a time, and the next range is only searched once the
+    caller has consumed the previous one, so a folder of a million emails costs no more memory than one of a
+    thousand, and a caller that stops early (e.g. with islice) never searches the rest. Ranges are widened
+    while they turn out sparse. ESEARCH is used when the server supports it.
+    Other commands may be sent on the connection between two UIDs.
+    """
+    criteria = [f"SINCE {format_search_date(since)}"] if since is not None else []
+    bounds = uid_bounds(mail, min_uid, criteria)
+    if bounds is None:
+        return
+    low, high = bounds
+    use_esearch = 'ESEARCH' in mail.capabilities
+    while low <= high:
+        if newest_first:
+            start, end = max(low, high - window + 1), high
+            high = start - 1
+        else:
+            start, end = low, min(high, low + window - 1)
+            low = end + 1
+        uids = _search_window(mail, start, end, criteria, use_esearch)
+        if len(uids) < window // 2:
+            window = min(window * 2, MAX_SEARCH_WINDOW)
+        yield from sorted((uid for uid in uids if start <= uid <= end), reverse=newest_first)
+
+
+def quote_search_string(value: str) -> Optional[str]:
+    """
+    Quotes a string for a SEARCH criterion, or returns None if it cannot be sent as a quoted string: imaplib
+    sends commands as ASCII, and quoted strings may not contain line breaks.
+    """
+    if not value or not value.isascii() or '\r' in value or '\n' in value:
+        return None
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def header_search_criteria(key: str, values: Iterable[str]) -> List[str]:
+    """
+    SEARCH criteria matching any of `values` as a substring of a header, e.g. FROM "example.com". Values that
+    cannot be quoted are left out.
+    """
+    criteria = []
+    for value in values:
+        quoted = quote_search_string(value)
+        if quoted is not None:
+            criteria.append(f"{key} {quoted}")
+    return criteria
+
+
+def search_criteria_chunks(criteria: Sequence[str], max_length: int = MAX_SEARCH_LENGTH) -> Iterator[str]:
+    """
+    Combines criteria with OR into search keys no longer than `max_length` characters, e.g.
+    ['FROM "a"', 'FROM "b"', 'FROM "c"'] -> 'OR OR FROM "a" FROM "b" FROM "c"'. A criterion longer than
+    `max_length` gets a key of its own.
+    """
+    chunk: List[str] = []
+    length = 0
+    for criterion in criteria:
+        # Every criterion after the first adds an OR in front and a space before it
+        grown = length + len(criterion) + (4 if chunk else 0)
+        if chunk and grown > max_length:
+            yield 'OR ' * (len(chunk) - 1) + ' '.join(chunk)
+            chunk, grown = [], len(criterion)
+        chunk.append(criterion)
+        length = grown
+    if chunk:
+        yield 'OR ' * (len(chunk) - 1) + ' '.join(chunk)
+
+
+def search_any_uids(mail: imaplib.IMAP4, criteria: Sequence[str], min_uid: int = 1,
+                    max_length: int = MAX_SEARCH_LENGTH, max_uid: Optional[int] = None) -> Set[int]:
+    """
+    Returns the UIDs of the selected folder from `min_uid` upwards, and up to `max_uid` if given, that match any
+    of the criteria. The criteria are sent in as few SEARCH commands as `max_length` allows, and their results
+    are combined here.
+    """
+    uid_range = f"UID {max(min_uid, 1)}:{'*' if max_uid is None else max_uid}"
+    uids: Set[int] = set()
+    for key in search_criteria_chunks(criteria, max_length):
+        typ, data = uid_command(mail, 'SEARCH', None, uid_range, key)
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(f"SEARCH failed: {data}")
+        uids.update(uid for uid in (int(uid) for uid in b' '.join(data).split())
+                    if uid >= min_uid and (max_uid is None or uid <= max_uid))
+    return uids
@@ -0,0 +1,554 @@
+import email
+import email.utils
+import re
+import select
+import socket
+import socketserver
+import threading
+import time
+from datetime import datetime, timezone
+from email.message import Message
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from imap_fetch import _parse, _tokenize_text, format_uid_set
+
+_LITERAL_MARKER = re.compile(rb'\{(\d+)\+?\}$')
+_MONTHS = {month: number for number, month in enumerate(
+    ['jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'], start=1)}
+
+
+class StoredMessage:
+    def __init__(self, uid: int, raw: bytes, flags: Iterable[str] = (), internal_date: Optional[datetime] = None):
+        self.uid = uid
+        self.raw = raw
+        self.flags = set(flags)
+        self.internal_date = internal_date or datetime.now(timezone.utc)
+        self._message: Optional[Message] = None
+
+    @property
+    def message(self) -> Message:
+        if self._message is None:
+            self._message = email.message_from_bytes(self.raw)
+        return self._message
+
+
+class Folder:
+    def __init__(self, name: str, uidvalidity: int):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.uidnext = 1
+        self.messages: List[StoredMessage] = []
+
+    def add(self, raw: bytes, flags: Iterable[str] = (), internal_date: Optional[datetime] = None) -> int:
+        uid = self.uidnext
+        self.uidnext += 1
+        self.messages.append(StoredMessage(uid, raw, flags, internal_date))
+        return uid
+
+
+class StandInIMAPServer(socketserver.ThreadingTCPServer):
+    """
+    A small in-process IMAP4rev1 server holding mailboxes in memory. It understands the subset of IMAP this
+    application uses (LOGIN, SELECT, STATUS, UID SEARCH/FETCH/STORE/COPY/MOVE/EXPUNGE, IDLE, ...), so the scan,
+    watch and move code paths can be exercised locally. `latency` seconds are slept before every tagged
+    response to imitate a distant server.
+
+    Use as a context manager, then connect with imaplib.IMAP4(*server.address).
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, users: Optional[Dict[str, str]] = None, latency: float = 0.0, idle: bool = True,
+                 move: bool = True, host: str = '127.0.0.1', port: int = 0):
+        super().__init__((host, port), _IMAPHandler)
+        self.users = users
+        self.latency = latency
+        self.capabilities = ['IMAP4rev1', 'UIDPLUS', 'ESEARCH'] + (['IDLE'] if idle else []) + \
+            (['MOVE'] if move else [])
+        self.lock = threading.Condition()
+        self.folders: Dict[str, Folder] = {}
+        self.create_folder('INBOX')
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def address(self) -> Tuple[str, int]:
+        return self.server_address[0], self.server_address[1]
+
+    def __enter__(self) -> "StandInIMAPServer":
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.shutdown()
+        self.server_close()
+
+    def create_folder(self, name: str) -> Folder:
+        with self.lock:
+            key = name.upper() if name.upper() == 'INBOX' else name
+            if key not in self.folders:
+                self.folders[key] = Folder(key, int(time.time()) + len(self.folders))
+            return self.folders[key]
+
+    def get_folder(self, name: str) -> Optional[Folder]:
+        return self.folders.get(name.upper() if name.upper() == 'INBOX' else name)
+
+    def add_message(self, raw: bytes, folder: str = 'INBOX', flags: Iterable[str] = (),
+                    internal_date: Optional[datetime] = None) -> int:
+        """Delivers a message and wakes up any IDLE-ing client. Returns its UID."""
+        with self.lock:
+            uid = self.create_folder(folder).add(raw, flags, internal_date)
+            self.lock.notify_all()
+            return uid
+
+    def reset_uidvalidity(self, folder: str = 'INBOX') -> None:
+        """Renumbers a folder as a server would after rebuilding it."""
+        with self.lock:
+            current = self.get_folder(folder)
+            current.uidvalidity += 1
+            for uid, message in enumerate(current.messages, start=1):
+                message.uid = uid
+            current.uidnext = len(current.messages) + 1
+
+
+def _quote(value: str) -> bytes:
+    return b'"' + value.replace('\\', '\\\\').replace('"', '\\"').encode() + b'"'
+
+
+def _nstring(value) -> bytes:
+    return b'NIL' if value is None else _quote(str(value))
+
+
+def _raw_bytes(text: str) -> bytes:
+    try:
+        return text.encode('ascii', 'surrogateescape')
+    except UnicodeEncodeError:
+        return text.encode('utf-8', 'surrogateescape')
+
+
+def _part_bytes(part: Message) -> bytes:
+    # get_payload() re-decodes 8-bit text with the part's charset; the stored payload keeps the original bytes
+    payload = part._payload
+    return _raw_bytes(payload) if isinstance(payload, str) else b''
+
+
+def _body_structure(part: Message) -> bytes:
+    if part.is_multipart():
+        children = b''.join(_body_structure(child) for child in part.get_payload())
+        return b'(' + children + b' ' + _quote(part.get_content_subtype().upper()) + b')'
+    params = [(name, value) for name, value in part.get_params(header='content-type') or []][1:]
+    if params:
+        params_bytes = b'(' + b' '.join(_quote(name.upper()) + b' ' + _quote(str(value))
+                                        for name, value in params) + b')'
+    else:
+        params_bytes = b'NIL'
+    body = _part_bytes(part)
+    fields = [_quote(part.get_content_maintype().upper()), _quote(part.get_content_subtype().upper()), params_bytes,
+              _nstring(part['content-id']), _nstring(part['content-description']),
+              _quote((part['content-transfer-encoding'] or '7BIT').upper()), str(len(body)).encode()]
+    if part.get_content_maintype() == 'text':
+        fields.append(str(body.count(b'\n') + 1).encode())
+    return b'(' + b' '.join(fields) + b')'
+
+
+def _split_raw(raw: bytes) -> Tuple[bytes, bytes]:
+    for separator in (b'\r\n\r\n', b'\n\n'):
+        index = raw.find(separator)
+        if index >= 0:
+            return raw[:index + len(separator)], raw[index + len(separator):]
+    return raw, b''
+
+
+def _section_bytes(stored: StoredMessage, section: str, fields: Optional[List[str]], exclude: bool) -> bytes:
+    upper = section.upper()
+    if upper == '':
+        return stored.raw
+    if upper == 'HEADER':
+        return _split_raw(stored.raw)[0]
+    if upper == 'TEXT':
+        return _split_raw(stored.raw)[1]
+    if upper.startswith('HEADER.FIELDS'):
+        wanted = {field.lower() for field in fields or []}
+        lines = [f"{name}: {value}\r\n" for name, value in stored.message.items()
+                 if (name.lower() in wanted) != exclude]
+        return _raw_bytes(''.join(lines) + '\r\n')
+    part = stored.message
+    for number in section.split('.'):
+        if part.is_multipart():
+            children = part.get_payload()
+            index = int(number) - 1
+            if index >= len(children):
+                return b''
+            part = children[index]
+        elif number != '1':
+            return b''
+    if part.is_multipart():
+        return _split_raw(part.as_bytes())[1]
+    return _part_bytes(part)
+
+
+def _parse_date(value: str) -> datetime:
+    day, month, year = value.split('-')
+    return datetime(int(year), _MONTHS[month.lower()], int(day), tzinfo=timezone.utc)
+
+
+class _IMAPHandler(socketserver.StreamRequestHandler):
+    server: StandInIMAPServer
+
+    def setup(self) -> None:
+        super().setup()
+        self.folder: Optional[Folder] = None
+        self.reported_exists = 0
+
+    def send(self, data: bytes) -> None:
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def tagged(self, tag: bytes, status: str, text: str) -> None:
+        self.send(tag + b' ' + status.encode() + b' ' + text.encode() + b'\r\n')
+
+    def read_command(self) -> Optional[bytes]:
+        line = self.rfile.readline()
+        if not line:
+            return None
+        # Inline client literals: "... {12}" followed by 12 bytes
+        while True:
+            stripped = line.rstrip(b'\r\n')
+            match = _LITERAL_MARKER.search(stripped)
+            if not match:
+                return stripped
+            if not stripped.endswith(b'+}'):
+                self.send(b'+ Ready for literal\r\n')
+            literal = self.rfile.read(int(match.group(1)))
+            line = stripped[:match.start()] + _quote(literal.decode('utf-8', 'replace')) + self.rfile.readline()
+
+    def handle(self) -> None:
+        self.send(b'* OK [CAPABILITY ' + ' '.join(self.server.capabilities).encode() + b'] Stand-in IMAP ready\r\n')
+        while True:
+            try:
+                line = self.read_command()
+            except (ConnectionError, socket.timeout):
+                return
+            if line is None:
+                return
+            parts = line.split(b' ', 2)
+            if len(parts) < 2:
+                self.send(b'* BAD Invalid command\r\n')
+                continue
+            tag, command = parts[0], parts[1].upper().decode()
+            args = parts[2] if len(parts) > 2 else b''
+            uid = False
+            if command == 'UID':
+                uid = True
+                sub = args.split(b' ', 1)
+                command, args = sub[0].upper().decode(), (sub[1] if len(sub) > 1 else b'')
+            handler = getattr(self, f"cmd_{command.lower()}", None)
+            if handler is None:
+                self.tagged(tag, 'BAD', f"Unknown command {command}")
+                continue
+            if self.server.latency:
+                # Round trip delay, spent outside the lock so connections are delayed independently
+                time.sleep(self.server.latency)
+            try:
+                if command == 'IDLE':
+                    # IDLE waits for deliveries, so it takes the lock itself only while looking at the folder
+                    keep_going = handler(tag, [], uid)
+                else:
+                    with self.server.lock:
+                        keep_going = handler(tag, _parse(_tokenize_text(args)), uid)
+            except Exception as e:  # Report, rather than drop the connection, like a real server
+                self.tagged(tag, 'BAD', f"{command} failed: {e}")
+                continue
+            if keep_going is False:
+                return
+
+    # -- commands --------------------------------------------------------------------------------------------------
+
+    def cmd_capability(self, tag, args, uid):
+        self.send(b'* CAPABILITY ' + ' '.join(self.server.capabilities).encode() + b'\r\n')
+        self.tagged(tag, 'OK', 'CAPABILITY completed')
+
+    def cmd_login(self, tag, args, uid):
+        user, password = (value.decode() for value in args[:2])
+        if self.server.users is not None and self.server.users.get(user) != password:
+            self.tagged(tag, 'NO', '[AUTHENTICATIONFAILED] Invalid credentials')
+        else:
+            self.tagged(tag, 'OK', 'LOGIN completed')
+
+    def cmd_logout(self, tag, args, uid):
+        self.send(b'* BYE Logging out\r\n')
+        self.tagged(tag, 'OK', 'LOGOUT completed')
+        return False
+
+    def cmd_noop(self, tag, args, uid):
+        self.report_exists()
+        self.tagged(tag, 'OK', 'NOOP completed')
+
+    def cmd_create(self, tag, args, uid):
+        name = args[0].decode()
+        if self.server.get_folder(name):
+            self.tagged(tag, 'NO', '[ALREADYEXISTS] Mailbox already exists')
+        else:
+            self.server.create_folder(name)
+            self.tagged(tag, 'OK', 'CREATE completed')
+
+    def cmd_select(self, tag, args, uid):
+        folder = self.server.get_folder(args[0].decode())
+        if folder is None:
+            self.tagged(tag, 'NO', '[NONEXISTENT] No such mailbox')
+            return
+        self.folder = folder
+        self.reported_exists = len(folder.messages)
+        self.send(f"* {len(folder.messages)} EXISTS\r\n* 0 RECENT\r\n"
+                  f"* FLAGS (\\Seen \\Deleted \\Flagged)\r\n"
+                  f"* OK [UIDVALIDITY {folder.uidvalidity}] UIDs valid\r\n"
+                  f"* OK [UIDNEXT {folder.uidnext}] Predicted next UID\r\n".encode())
+        self.tagged(tag, 'OK', '[READ-WRITE] SELECT completed')
+
+    cmd_examine = cmd_select
+
+    def cmd_status(self, tag, args, uid):
+        folder = self.server.get_folder(args[0].decode())
+        if folder is None:
+            self.tagged(tag, 'NO', '[NONEXISTENT] No such mailbox')
+            return
+        values = {'MESSAGES': len(folder.messages), 'UIDNEXT': folder.uidnext, 'UIDVALIDITY': folder.uidvalidity,
+                  'UNSEEN': sum('\\Seen' not in message.flags for message in folder.messages), 'RECENT': 0}
+        items = ' '.join(f"{item.decode().upper()} {values[item.decode().upper()]}" for item in args[1])
+        self.send(b'* STATUS ' + _quote(folder.name) + f" ({items})\r\n".encode())
+        self.tagged(tag, 'OK', 'STATUS completed')
+
+    def cmd_idle(self, tag, args, uid):
+        # Deliveries the client has not been told about yet are announced in the same packet as the continuation
+        with self.server.lock:
+            self.send(b'+ idling\r\n' + self.exists_update())
+        while True:
+            with self.server.lock:
+                self.report_exists()
+            if not select.select([self.request], [], [], 0.05)[0]:
+                with self.server.lock:
+                    self.server.lock.wait(0.05)
+                continue
+            line = self.rfile.readline()
+            if not line or line.strip().upper() == b'DONE':
+                break
+        self.tagged(tag, 'OK', 'IDLE terminated')
+
+    def cmd_search(self, tag, args, uid):
+        messages = self.require_folder(tag)
+        if messages is None:
+            return
+        return_options = None
+        if args and isinstance(args[0], bytes) and args[0].upper() == b'RETURN':
+            return_options = [option.upper() for option in args[1]]
+            args = args[2:]
+        if args and isinstance(args[0], bytes) and args[0].upper() == b'CHARSET':
+            args = args[2:]
+        matches = [(seq, message) for seq, message in enumerate(messages, start=1)
+                   if self.matches_all(args, seq, message)]
+        numbers = [message.uid if uid else seq for seq, message in matches]
+        if return_options is not None:
+            response = f"* ESEARCH (TAG \"{tag.decode()}\")" + (" UID" if uid else "")
+            if numbers and (b'MIN' in return_options or not return_options):
+                response += f" MIN {min(numbers)}"
+            if numbers and b'MAX' in return_options:
+                response += f" MAX {max(numbers)}"
+            if b'COUNT' in return_options:
+                response += f" COUNT {len(numbers)}"
+            if numbers and (b'ALL' in return_options or not return_options):
+                response += f" ALL {format_uid_set(numbers)}"
+            self.send(response.encode() + b'\r\n')
+        else:
+            self.send(b'* SEARCH' + b''.join(b' ' + str(number).encode() for number in numbers) + b'\r\n')
+        self.tagged(tag, 'OK', 'SEARCH completed')
+
+    def cmd_fetch(self, tag, args, uid):
+        messages = self.require_folder(tag)
+        if messages is None:
+            return
+        items = args[1] if isinstance(args[1], list) else args[1:]
+        for seq, message in self.select_messages(args[0], uid):
+            response = [b'UID', str(message.uid).encode()]
+            for item in items:
+                response.extend(self.fetch_item(message, item.decode()))
+            chunks = [f"* {seq} FETCH (".encode()]
+            for index, value in enumerate(response):
+                if index:
+                    chunks.append(b' ')
+                if isinstance(value, tuple):
+                    chunks.append(b'{' + str(len(value[0])).encode() + b'}\r\n' + value[0])
+                else:
+                    chunks.append(value)
+            self.send(b''.join(chunks) + b')\r\n')
+        self.tagged(tag, 'OK', 'FETCH completed')
+
+    def cmd_store(self, tag, args, uid):
+        if self.require_folder(tag) is None:
+            return
+        action = args[1].decode().upper()
+        flags = {flag.decode() for flag in (args[2] if isinstance(args[2], list) else args[2:])}
+        for seq, message in self.select_messages(args[0], uid):
+            if action.startswith('+'):
+                message.flags |= flags
+            elif action.startswith('-'):
+                message.flags -= flags
+            else:
+                message.flags = set(flags)
+            if '.SILENT' not in action:
+                self.send(f"* {seq} FETCH (UID {message.uid} FLAGS ({' '.join(sorted(message.flags))}))\r\n"
+                          .encode())
+        self.tagged(tag, 'OK', 'STORE completed')
+
+    def cmd_copy(self, tag, args, uid):
+        if self.require_folder(tag) is None:
+            return
+        target = self.server.get_folder(args[1].decode())
+        if target is None:
+            self.tagged(tag, 'NO', '[TRYCREATE] No such mailbox')
+            return
+        for _, message in self.select_messages(args[0], uid):
+            target.add(message.raw, message.flags - {'\\Deleted'}, message.internal_date)
+        self.tagged(tag, 'OK', 'COPY completed')
+
+    def cmd_move(self, tag, args, uid):
+        if self.require_folder(tag) is None:
+            return
+        if 'MOVE' not in self.server.capabilities:
+            self.tagged(tag, 'BAD', 'MOVE not supported')
+            return
+        target = self.server.get_folder(args[1].decode())
+        if target is None:
+            self.tagged(tag, 'NO', '[TRYCREATE] No such mailbox')
+            return
+        moving = self.select_messages(args[0], uid)
+        for _, message in moving:
+            target.add(message.raw, message.flags, message.internal_date)
+        self.remove({id(message) for _, message in moving})
+        self.tagged(tag, 'OK', 'MOVE completed')
+
+    def cmd_expunge(self, tag, args, uid):
+        if self.require_folder(tag) is None:
+            return
+        candidates = self.select_messages(args[0], True) if uid else list(enumerate(self.folder.messages, 1))
+        self.remove({id(message) for _, message in candidates if '\\Deleted' in message.flags})
+        self.tagged(tag, 'OK', 'EXPUNGE completed')
+
+    # -- helpers ---------------------------------------------------------------------------------------------------
+
+    def require_folder(self, tag) -> Optional[List[StoredMessage]]:
+        if self.folder is None:
+            self.tagged(tag, 'BAD', 'No mailbox selected')
+            return None
+        return self.folder.messages
+
+    def exists_update(self) -> bytes:
+        """The EXISTS response for a changed message count, or b'' if the client already knows the count."""
+        if self.folder is None or len(self.folder.messages) == self.reported_exists:
+            return b''
+        self.reported_exists = len(self.folder.messages)
+        return f"* {self.reported_exists} EXISTS\r\n".encode()
+
+    def report_exists(self) -> None:
+        update = self.exists_update()
+        if update:
+            self.send(update)
+
+    def remove(self, message_ids: set) -> None:
+        for seq in range(len(self.folder.messages), 0, -1):
+            if id(self.folder.messages[seq - 1]) in message_ids:
+                del self.folder.messages[seq - 1]
+                self.send(f"* {seq} EXPUNGE\r\n".encode())
+        self.reported_exists = len(self.folder.messages)
+
+    def select_messages(self, sequence_set: bytes, uid: bool) -> List[Tuple[int, StoredMessage]]:
+        messages = self.folder.messages
+        largest = (messages[-1].uid if uid else len(messages)) if messages else 0
+        wanted = _parse_set(sequence_set.decode(), largest)
+        return [(seq, message) for seq, message in enumerate(messages, start=1)
+                if (message.uid if uid else seq) in wanted]
+
+    def matches_all(self, criteria: list, seq: int, message: StoredMessage) -> bool:
+        criteria = list(criteria)
+        while criteria:
+            if not self.match_one(criteria, seq, message):
+                return False
+        return True
+
+    def match_one(self, criteria: list, seq: int, message: StoredMessage) -> bool:
+        key = criteria.pop(0)
+        if isinstance(key, list):
+            return self.matches_all(key, seq, message)
+        name = key.decode().upper()
+        if name == 'ALL':
+            return True
+        if name == 'NOT':
+            return not self.match_one(criteria, seq, message)
+        if name == 'OR':
+            first = self.match_one(criteria, seq, message)
+            second = self.match_one(criteria, seq, message)
+            return first or second
+        if name in ('FROM', 'SUBJECT', 'TO'):
+            value = criteria.pop(0).decode().lower()
+            return value in str(message.message[name.lower()] or '').lower()
+        if name == 'UID':
+            largest = self.folder.messages[-1].uid if self.folder.messages else 0
+            return message.uid in _parse_set(criteria.pop(0).decode(), largest)
+        if name in ('SINCE', 'BEFORE', 'ON'):
+            date = _parse_date(criteria.pop(0).decode())
+            received = message.internal_date.replace(hour=0, minute=0, second=0, microsecond=0)
+            return {'SINCE': received >= date, 'BEFORE': received < date, 'ON': received == date}[name]
+        if name in ('SEEN', 'UNSEEN', 'DELETED', 'FLAGGED'):
+            flag = '\\' + name.replace('UN', '', 1).capitalize()
+            return (flag in message.flags) != name.startswith('UN')
+        if name == 'LARGER':
+            return len(message.raw) > int(criteria.pop(0))
+        if name == 'SMALLER':
+            return len(message.raw) < int(criteria.pop(0))
+        if name[0].isdigit() or name[0] == '*':
+            return seq in _parse_set(name, len(self.folder.messages))
+        raise ValueError(f"unsupported search key {name}")
+
+    def fetch_item(self, message: StoredMessage, item: str) -> list:
+        upper = item.upper()
+        if upper == 'UID':
+            return []
+        if upper == 'FLAGS':
+            return [b'FLAGS', f"({' '.join(sorted(message.flags))})".encode()]
+        if upper == 'RFC822.SIZE':
+            return [b'RFC822.SIZE', str(len(message.raw)).encode()]
+        if upper == 'INTERNALDATE':
+            return [b'INTERNALDATE', _quote(email.utils.format_datetime(message.internal_date))]
+        if upper == 'BODYSTRUCTURE':
+            return [b'BODYSTRUCTURE', _body_structure(message.message)]
+        if upper in ('RFC822', 'RFC822.HEADER'):
+            if upper == 'RFC822':
+                message.flags.add('\\Seen')
+            return [upper.encode(), (message.raw if upper == 'RFC822' else _split_raw(message.raw)[0],)]
+        match = re.match(r'BODY(\.PEEK)?\[([^\]]*)\](?:<(\d+)(?:\.(\d+))?>)?$', item, re.IGNORECASE)
+        if not match:
+            raise ValueError(f"unsupported fetch item {item}")
+        peek, section, start, length = match.groups()
+        fields = None
+        field_match = re.match(r'(HEADER\.FIELDS(?:\.NOT)?)\s*\(([^)]*)\)', section, re.IGNORECASE)
+        if field_match:
+            fields = field_match.group(2).split()
+        data = _section_bytes(message, field_match.group(1) if field_match else section, fields,
+                              bool(field_match) and field_match.group(1).upper().endswith('.NOT'))
+        key = f"BODY[{section}]"
+        if start is not None:
+            data = data[int(start):int(start) + int(length)] if length else data[int(start):]
+            key += f"<{start}>"
+        if not peek:
+            message.flags.add('\\Seen')
+        return [key.encode(), (data,)]
+
+
+def _parse_set(sequence_set: str, largest: int) -> set:
+    numbers = set()
+    for item in sequence_set.split(','):
+        if ':' in item:
+            start, end = (largest if value == '*' else int(value) for value in item.split(':'))
+            numbers.update(range(min(start, end), max(start, end) + 1))
+        else:
+            numbers.add(largest if item == '*' else int(item))
+    return numbers
@@ -0,0 +1,136 @@
+import csv
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Union
+
+if TYPE_CHECKING:  # pandas is only needed by callers that pass a DataFrame
+    import pandas as pd
+
+
+class AhoCorasick:
+    """
+    Multi-pattern substring matcher. All patterns are compiled into a single automaton so a text is
+    scanned once, regardless of how many patterns there are.
+    """
+
+    def __init__(self, patterns: Iterable[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[bool] = [False]
+        self.match_all = False
+
+        for pattern in patterns:
+            self._add(pattern)
+        self._build_failure_links()
+
+    def __bool__(self) -> bool:
+        return self.match_all or bool(self.goto[0])
+
+    def _add(self, pattern: str) -> None:
+        if not pattern:
+            # An empty pattern is a substring of every text
+            self.match_all = True
+            return
+        state = 0
+        for char in pattern:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(False)
+            state = next_state
+        self.output[state] = True
+
+    def _build_failure_links(self) -> None:
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(char, 0)
+                self.fail[next_state] = target if target != next_state else 0
+                # A state also matches if any of its suffixes is a complete pattern
+                self.output[next_state] = self.output[next_state] or self.output[self.fail[next_state]]
+
+    def search(self, text: str) -> bool:
+        """Returns True as soon as any pattern is found in `text`."""
+        if self.match_all:
+            return True
+        goto, fail, output = self.goto, self.fail, self.output
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                return True
+        return False
+
+
+def _column_patterns(keep_df: "pd.DataFrame", column: str) -> List[str]:
+    if column not in keep_df.columns:
+        return []
+    return [str(value).lower() for value in keep_df[column].dropna().unique()]
+
+
+class KeepListMatcher:
+    """
+    The rules from keep_data.csv compiled once into one automaton per field:
+    Keywords are searched in the sender, subject and body, Sender rules in the sender and Subject rules
+    in the subject. The Sender and Subject patterns are kept as well, so a server can be asked for the emails
+    matching them (see search_kept_uids in spam_detector).
+    """
+
+    def __init__(self, keywords: Iterable[str] = (), senders: Iterable[str] = (), subjects: Iterable[str] = ()):
+        self.sender_patterns = list(senders)
+        self.subject_patterns = list(subjects)
+        self.keywords = AhoCorasick(keywords)
+        self.senders = AhoCorasick(self.sender_patterns)
+        self.subjects = AhoCorasick(self.subject_patterns)
+
+    @classmethod
+    def from_dataframe(cls, keep_df: "pd.DataFrame") -> "KeepListMatcher":
+        return cls(_column_patterns(keep_df, 'Keywords'),
+                   _column_patterns(keep_df, 'Sender'),
+                   _column_patterns(keep_df, 'Subject'))
+
+    @classmethod
+    def from_csv(cls, path: Union[str, Path]) -> "KeepListMatcher":
+        """Reads keep_data.csv without pandas; a missing file means no rules."""
+        columns: Dict[str, set] = {'Keywords': set(), 'Sender': set(), 'Subject': set()}
+        if not Path(path).is_file():
+            return cls()
+        with open(path, newline='', encoding='utf-8') as file:
+            for row in csv.DictReader(file):
+                for column, patterns in columns.items():
+                    # Empty cells are missing values, as pandas reads them
+                    if row.get(column):
+                        patterns.add(row[column].lower())
+        return cls(sorted(columns['Keywords']), sorted(columns['Sender']), sorted(columns['Subject']))
+
+    def __bool__(self) -> bool:
+        return bool(self.keywords) or bool(self.senders) or bool(self.subjects)
+
+    def matches(self, email_sender: Optional[str], email_subject: Optional[str], email_body: Optional[str]) -> bool:
+        """Returns True if the email matches any keep rule."""
+        # Lowercase each field once per email rather than once per rule
+        sender = (email_sender or "").lower()
+        subject = (email_subject or "").lower()
+        if self.senders.search(sender) or self.subjects.search(subject):
+            return True
+        if not self.keywords:
+            return False
+        return (self.keywords.search(sender) or self.keywords.search(subject) or
+                self.keywords.search((email_body or "").lower()))
+
+
+def compile_keep_list(keep_rules: Union["pd.DataFrame", KeepListMatcher]) -> KeepListMatcher:
+    """
+    Compiles the keep rules into a KeepListMatcher. Already compiled matchers are returned unchanged.
+    """
+    if isinstance(keep_rules, KeepListMatcher):
+        return keep_rules
+    return KeepListMatcher.from_dataframe(keep_rules)
@@ -1,24 +1,57 @@
 import imaplib
 import json
+import queue
 import threading
 import tkinter as tk
+import tkinter.font as tkfont
 from pathlib import Path
 from tkinter import scrolledtext, Listbox
+from typing import NamedTuple, Optional
 
 import customtkinter as ctk
 import pandas as pd
 from PIL import Image
 
-from src.spam_detector import load_model, load_json_file, get_and_filter_emails, move_email_to_spam
+from body_store import BodyStore, make_preview
+from campaigns import CampaignIndex
+from engine import ScanEngine
+from metrics import METRICS
+from online_model import OnlineLearner
+from scan_state import ScanStateStore, DEFAULT_STATE_PATH
+from spam_detector import load_model, load_json_file, get_and_filter_emails, move_emails_to_spam, \
+    get_mail_server, build_model_input, close_connections, DEFAULT_SCAN_LIMIT
+from spam_list import SpamEmail, SpamListStore
+from verdict_cache import DEFAULT_CACHE_PATH, VerdictCache
+from watcher import MailboxWatcher
 
 ctk.set_appearance_mode("Dark")  # Default theme
 ctk.set_default_color_theme("dark-blue")
 
+# Milliseconds between two drains of the UI event queue, and the most events handled per drain
+UI_TICK_MS = 50
+MAX_EVENTS_PER_TICK = 5000
+# Lines kept in the command output; older ones are dropped
+MAX_CONSOLE_LINES = 5000
+# IMAP connections a scan splits the emails of an account among
+SCAN_CONNECTIONS = 2
+
+
+class ScanSettings(NamedTuple):
+    """The settings a scan or the watcher runs with, read from the widgets on the main loop when it starts."""
+    user: str  # Email and password as entered; either may be empty
+    password: str
+    limit: Optional[int]
+    incremental: bool
+    group_campaigns: bool
+    learning: bool
+
 
 class EmailDetailsDialog(ctk.CTkToplevel):
     def __init__(self, parent, email_details):
         super().__init__(parent)
-        self.title("Email Details")
+        # A campaign row shows its first email
+        members = email_details.get("members", 1)
+        self.title(f"Email Details (1 of {members} similar emails)" if members > 1 else "Email Details")
         self.geometry("400x300")
 
         # Make the dialog modal
@@ -49,6 +82,88 @@ class EmailDetailsDialog(ctk.CTkToplevel):
         body_text.configure(state="disabled")  # Make the text widget read-only
 
 
+class VirtualSpamList(ctk.CTkFrame):
+    """
+    Shows the rows of a SpamListStore, creating listbox items only for the rows that fit on screen, so the list
+    stays responsive with any number of rows. Selected rows are remembered by row id, also while scrolled away.
+    """
+
+    def __init__(self, parent, store: SpamListStore, on_open, font=("Arial", 10)):
+        super().__init__(parent, fg_color="transparent")
+        self.store = store
+        self.on_open = on_open
+        self.top = 0  # Position of the first visible row
+        self.selected = set()  # Ids of the selected rows
+        self.visible_ids = []  # Ids of the rows the listbox currently shows
+        self.line_height = tkfont.Font(font=font).metrics("linespace") + 1
+
+        self.scrollbar = ctk.CTkScrollbar(self, command=self.on_scroll)
+        self.scrollbar.pack(side="right", fill="y")
+        self.listbox = Listbox(self, bg="#2e2e2e", fg="white", height=10, font=font, borderwidth=0,
+                               highlightthickness=0, selectmode='multiple', activestyle='none')
+        self.listbox.pack(side="left", fill="both", expand=True)
+        self.listbox.bind("<<ListboxSelect>>", lambda event: self.sync_selection())
+        self.listbox.bind("<Double-1>", self.on_double_click)
+        self.listbox.bind("<Configure>", lambda event: self.refresh())
+        self.listbox.bind("<MouseWheel>", lambda event: self.scroll_by(-1 if event.delta > 0 else 1))
+        self.listbox.bind("<Button-4>", lambda event: self.scroll_by(-1))
+        self.listbox.bind("<Button-5>", lambda event: self.scroll_by(1))
+
+    def page_size(self):
+        return max(1, self.listbox.winfo_height() // self.line_height)
+
+    def refresh(self):
+        # Re-renders the visible window of rows
+        total = len(self.store)
+        page = self.page_size()
+        self.top = max(0, min(self.top, total - page))
+        self.visible_ids = [self.store.row_id_at(position) for position in range(self.top, min(total, self.top + page))]
+        self.listbox.delete(0, tk.END)
+        for index, row_id in enumerate(self.visible_ids):
+            self.listbox.insert(tk.END, self.store.text(row_id))
+            if row_id in self.selected:
+                self.listbox.selection_set(index)
+        if total:
+            self.scrollbar.set(self.top / total, (self.top + len(self.visible_ids)) / total)
+        else:
+            self.scrollbar.set(0, 1)
+        return "break"
+
+    def scroll_by(self, rows):
+        self.top += rows * 3
+        return self.refresh()
+
+    def on_scroll(self, action, amount, unit=None):
+        # Called by the scrollbar, like a widget's yview
+        if action == "moveto":
+            self.top = int(float(amount) * len(self.store))
+        elif unit == "pages":
+            self.top += int(amount) * self.page_size()
+        else:
+            self.top += int(amount)
+        self.refresh()
+
+    def sync_selection(self):
+        for index, row_id in enumerate(self.visible_ids):
+            if self.listbox.selection_includes(index):
+                self.selected.add(row_id)
+            else:
+                self.selected.discard(row_id)
+
+    def select_all(self):
+        self.selected = set(self.store.row_ids())
+        self.refresh()
+
+    def selected_rows(self):
+        # Selected rows still in the store, in list order
+        return [row_id for row_id in self.store.row_ids() if row_id in self.selected]
+
+    def on_double_click(self, event):
+        index = self.listbox.nearest(event.y)
+        if 0 <= index < len(self.visible_ids):
+            self.on_open(self.visible_ids[index])
+
+
 class CustomCredentialDialog(ctk.CTkToplevel):
     def __init__(self, parent):
         super().__init__(parent)
@@ -103,8 +218,25 @@ class CustomCredentialDialog(ctk.CTkToplevel):
 class SpamDetectorApp(ctk.CTk):
     def __init__(self):
         super().__init__()
-        self.email_details = {}  # Initialize a dictionary to store email details
+        self.spam_store = SpamListStore()  # Emails in the spam list, by row
+        self.campaigns = CampaignIndex()  # Groups the spam list into campaigns of near-identical emails
+        self.learned = set()  # (account, uid) of kept emails the online model already learned from
+        # Worker threads never touch widgets; they queue events that the main loop handles every UI_TICK_MS
+        self.ui_events = queue.SimpleQueue()
         self.mail = None  # Initialize the mail server
+        self.watcher = None  # Real-time watcher, running while "Watch Inbox" is active
+        self.engine = None  # Multi-account scan engine, keeps its connections between scans
+        # (server, user, password) of the accounts scanned or watched without the engine, by user; their spam is
+        # moved through a connection logged in for the move
+        self.logins = {}
+        self.learner = None  # Online model, updated from "Remove Spam!!!" decisions while learning is enabled
+        self.scan_cancel = threading.Event()  # Set by "Stop Scan"; every scan starts with a fresh one
+        self.model_path = '../models/spam_classifier.joblib'
+        self.metrics_dir = Path("../data")  # metrics.json and metrics.prom are written here after every scan
+        # Verdicts of emails already classified, so rescans and campaign copies skip the model
+        self.verdict_cache = VerdictCache(path=DEFAULT_CACHE_PATH)
+        # Full bodies of the listed spam, on disk; the list itself keeps a preview of each
+        self.body_store = BodyStore()
 
         self.title('Email Spam Detector')
         self.geometry('1300x700')
@@ -124,6 +256,10 @@ class SpamDetectorApp(ctk.CTk):
         # Theme selection section
         self.setup_theme_selection()
 
+        # Keep the metrics summary current while scans run
+        self.refresh_metrics()
+        self.drain_ui_events()
+
     def setup_layout_frames(self):
         self.left_frame = ctk.CTkFrame(self, corner_radius=10)
         self.left_frame.pack(side='left', fill='both', expand=True, padx=(20, 10), pady=20)
@@ -172,13 +308,46 @@ class SpamDetectorApp(ctk.CTk):
         # Number of emails entry and label
         self.num_emails_label = ctk.CTkLabel(self.left_frame, text="Number of Emails to Check:", font=("Arial", 10))
         self.num_emails_label.pack(pady=(10, 2))
-        self.num_emails_entry = ctk.CTkEntry(self.left_frame, width=400, placeholder_text="Number of emails to check")
-        self.num_emails_entry.pack(pady=(0, 20))
+        self.num_emails_entry = ctk.CTkEntry(self.left_frame, width=400,
+                                             placeholder_text=f"Newest emails to check (default {DEFAULT_SCAN_LIMIT}, "
+                                                              f"0 for all)")
+        self.num_emails_entry.pack(pady=(0, 10))
+
+        # Incremental scan toggle: skip emails already checked by a previous run
+        self.incremental_var = tk.BooleanVar(value=True)
+        self.incremental_checkbox = ctk.CTkCheckBox(self.left_frame, text="Only check new emails",
+                                                    variable=self.incremental_var)
+        self.incremental_checkbox.pack(pady=(0, 5))
+
+        # Online learning toggle: use the online model and train it on the spam the user removes or keeps
+        self.learning_var = tk.BooleanVar(value=False)
+        self.learning_checkbox = ctk.CTkCheckBox(self.left_frame, text="Learn from my decisions",
+                                                 variable=self.learning_var)
+        self.learning_checkbox.pack(pady=(0, 5))
+
+        # Campaign grouping toggle: near-identical emails share one verdict and one row in the spam list
+        self.campaigns_var = tk.BooleanVar(value=True)
+        self.campaigns_checkbox = ctk.CTkCheckBox(self.left_frame, text="Group spam campaigns",
+                                                  variable=self.campaigns_var)
+        self.campaigns_checkbox.pack(pady=(0, 20))
 
         # Run detection button
         self.run_button = ctk.CTkButton(self.left_frame, text="Detect Spam Emails", command=self.run_spam_detection)
         self.run_button.pack(pady=(10, 0), fill='x')
 
+        # Scan every saved account at once
+        self.scan_all_button = ctk.CTkButton(self.left_frame, text="Scan All Saved Accounts",
+                                             command=self.run_all_accounts_detection)
+        self.scan_all_button.pack(pady=(10, 0), fill='x')
+
+        # Stops running scans after the emails already being fetched
+        self.stop_button = ctk.CTkButton(self.left_frame, text="Stop Scan", command=self.stop_scans)
+        self.stop_button.pack(pady=(10, 0), fill='x')
+
+        # Real-time watch button, toggles the IMAP IDLE watcher
+        self.watch_button = ctk.CTkButton(self.left_frame, text="Watch Inbox", command=self.toggle_watcher)
+        self.watch_button.pack(pady=(10, 0), fill='x')
+
         # Populate the dropdown with saved credentials
         self.populate_credentials_dropdown()
 
@@ -189,14 +358,15 @@ class SpamDetectorApp(ctk.CTk):
         self.console_output = scrolledtext.ScrolledText(self.right_frame, bg="#2e2e2e", fg="white", font=("Arial", 10))
         self.console_output.pack(padx=10, pady=(0, 10), fill='both', expand=True)
 
+        # Live summary of where scan time goes, from the metrics the scan path records
+        self.metrics_label = ctk.CTkLabel(self.right_frame, text="", font=("Arial", 10), justify="left", anchor="w")
+        self.metrics_label.pack(padx=10, pady=(0, 5), fill='x')
+
         self.spam_list_title = ctk.CTkLabel(self.right_frame, text="Spam Emails Detected", font=("Arial", 12, "bold"))
         self.spam_list_title.pack(pady=(5, 5))
 
-        self.spam_listbox = Listbox(self.right_frame, bg="#2e2e2e", fg="white", height=10, font=("Arial", 10),
-                                    borderwidth=0, highlightthickness=0,
-                                    selectmode='multiple')  # selectmode='multiple' allows multiple selection
-        self.spam_listbox.pack(padx=10, pady=(0, 10), fill='both', expand=True)
-        self.spam_listbox.bind("<Double-1>", lambda event: self.view_email_details())
+        self.spam_list = VirtualSpamList(self.right_frame, self.spam_store, self.view_email_details)
+        self.spam_list.pack(padx=10, pady=(0, 10), fill='both', expand=True)
 
         self.select_all_button = ctk.CTkButton(self.right_frame, text="Select All", command=self.select_all)
         self.select_all_button.pack(side="left", padx=(0, 5), pady=(10, 0))
@@ -219,8 +389,18 @@ class SpamDetectorApp(ctk.CTk):
         self.theme_combobox.set("Dark")  # Default value
         self.theme_combobox.pack(pady=10)
 
+    def read_settings(self):
+        # Tkinter is not thread-safe, so worker threads get the settings rather than reading the widgets
+        return ScanSettings(self.email_entry.get().strip(), self.password_entry.get().strip(), self.get_scan_limit(),
+                            self.incremental_var.get(), self.campaigns_var.get(), self.learning_var.get())
+
     def run_spam_detection(self):
-        threading.Thread(target=self.process_emails, args=()).start()
+        self.scan_cancel = threading.Event()
+        threading.Thread(target=self.process_emails, args=(self.scan_cancel, self.read_settings())).start()
+
+    def stop_scans(self):
+        self.scan_cancel.set()
+        self.log_to_console("Stopping the scan...")
 
     def load_credentials(self):
         if self.credentials_file.exists():
@@ -278,20 +458,69 @@ class SpamDetectorApp(ctk.CTk):
     def change_theme(self, theme):
         ctk.set_appearance_mode(theme.lower())
 
-    def log_to_console(self, message):
-        self.console_output.insert(tk.END, message + "\n")
-        self.console_output.see(tk.END)
-
-    def process_emails(self):
-        self.log_to_console("------------------------------------------------")
-        self.log_to_console("Starting email filter process...")
-        model_path = '../models/spam_classifier.joblib'
-        model = load_model(model_path, self.log_to_console)  # Ensure load_model accepts a logging function
+    def refresh_metrics(self):
+        self.metrics_label.configure(text=METRICS.summary())
+        self.after(1000, self.refresh_metrics)
 
-        # Try to get user and password from GUI inputs
-        gui_user = self.email_entry.get().strip()
-        gui_password = self.password_entry.get().strip()
+    def export_metrics(self):
+        try:
+            METRICS.write_json(self.metrics_dir / "metrics.json")
+            METRICS.write_prometheus(self.metrics_dir / "metrics.prom")
+        except OSError as e:
+            self.log_to_console(f"Could not write metrics: {e}")
 
+    def log_to_console(self, message):
+        # Safe to call from any thread
+        self.ui_events.put(("log", message))
+
+    def call_in_ui(self, func, *args):
+        # Runs func(*args) on the main loop; for widget changes requested by worker threads
+        self.ui_events.put(("call", func, args))
+
+    def drain_ui_events(self):
+        # Handles queued events in one batch: one console insert and one spam list refresh per tick
+        lines, spam_changed = [], False
+        for _ in range(MAX_EVENTS_PER_TICK):
+            try:
+                event = self.ui_events.get_nowait()
+            except queue.Empty:
+                break
+            if event[0] == "log":
+                lines.append(event[1])
+            elif event[0] == "spam":
+                self.spam_store.add(event[1], event[2])
+                spam_changed = True
+            else:
+                event[1](*event[2])
+        if lines:
+            self.console_output.insert(tk.END, "\n".join(lines) + "\n")
+            excess = int(self.console_output.index("end-1c").split(".")[0]) - MAX_CONSOLE_LINES
+            if excess > 0:
+                self.console_output.delete("1.0", f"{excess + 1}.0")
+            self.console_output.see(tk.END)
+        if spam_changed:
+            self.refresh_spam_list()
+        self.after(UI_TICK_MS, self.drain_ui_events)
+
+    def refresh_spam_list(self):
+        self.spam_list_title.configure(text=f"Spam Emails Detected ({len(self.spam_store)})"
+                                       if len(self.spam_store) else "Spam Emails Detected")
+        self.spam_list.refresh()
+
+    def get_scan_limit(self):
+        # Newest emails to check per account; None checks all of them
+        text = self.num_emails_entry.get().strip()
+        if not text:
+            return DEFAULT_SCAN_LIMIT
+        try:
+            limit = int(text)
+        except ValueError:
+            self.log_to_console(f"'{text}' is not a number of emails. Checking the newest {DEFAULT_SCAN_LIMIT}.")
+            return DEFAULT_SCAN_LIMIT
+        return limit if limit > 0 else None
+
+    def resolve_credentials(self, gui_user, gui_password):
+        # Prefer the user and password entered in the GUI
         email_info = load_json_file(Path("../data/email_data.json"),
                                     self.log_to_console)  # Ensure load_json_file accepts a logging function
 
@@ -317,120 +546,251 @@ class SpamDetectorApp(ctk.CTk):
                 user = email_info[first_key].get("user")
                 password = email_info[first_key].get("pass")
 
+        return user, password
+
+    def get_model(self, learning):
+        # The online model while learning is enabled, the offline one otherwise
+        if not learning:
+            return load_model(self.model_path, self.log_to_console)
+        if self.learner is None:
+            # Seeded from the pipeline, since the compact export has no per-term counts to fold in
+            self.learner = OnlineLearner.load(lambda: load_model(self.model_path, self.log_to_console, compact=False),
+                                              self.log_to_console)
+        return self.learner.model
+
+    def load_keep_data(self):
+        # Check for keep_data.csv and update it with the table data
+        keep_data_path = Path("../data/keep_data.csv")
+        if keep_data_path.exists():
+            keep_data_df = pd.read_csv(keep_data_path)
+        else:
+            keep_data_df = pd.DataFrame(columns=["Keywords", "Sender", "Subject"])
+
+        # Remove duplicates
+        keep_data_df.drop_duplicates(inplace=True)
+        return keep_data_df
+
+    def process_emails(self, cancel, settings):
+        self.log_to_console("------------------------------------------------")
+        self.log_to_console("Starting email filter process...")
+        model = self.get_model(settings.learning)
+
+        user, password = self.resolve_credentials(settings.user, settings.password)
+
         if user and password:
             self.log_to_console("Email credentials loaded successfully.")
             # Determine mail server from username
             if not self.determine_mail_server(user):
                 return
 
-            # Check for keep_data.csv and update it with the table data
-            keep_data_path = Path("../data/keep_data.csv")
-            if keep_data_path.exists():
-                keep_data_df = pd.read_csv(keep_data_path)
-            else:
-                keep_data_df = pd.DataFrame(columns=["Keywords", "Sender", "Subject"])
-
-            # Remove duplicates
-            keep_data_df.drop_duplicates(inplace=True)
+            keep_data_df = self.load_keep_data()
 
             if model is not None:
-                get_and_filter_emails(self.mail, user, password, keep_data_df, model,
-                                      self.log_to_console, self.add_email_to_list)
+                state_store = ScanStateStore() if settings.incremental else None
+                try:
+                    server = get_mail_server(user)
+                    self.logins[user] = (server, user, password)
+                    get_and_filter_emails(self.mail, user, password, keep_data_df, model, self.log_to_console,
+                                          lambda *email: self.add_email_to_list(
+                                              *email, account=user, group_campaigns=settings.group_campaigns),
+                                          state_store=state_store, cache=self.verdict_cache,
+                                          group_campaigns=settings.group_campaigns,
+                                          connect=lambda: imaplib.IMAP4_SSL(server), connections=SCAN_CONNECTIONS,
+                                          cancel=cancel, limit=settings.limit)
+                finally:
+                    if state_store is not None:
+                        state_store.close()
             else:
                 self.log_to_console("Failed to load or create the machine learning model.")
         else:
             self.log_to_console("Email credentials are missing or incomplete.")
 
+        self.export_metrics()
+        self.log_to_console("Process completed.")
+        self.log_to_console("------------------------------------------------")
+
+    def run_all_accounts_detection(self):
+        self.scan_cancel = threading.Event()
+        threading.Thread(target=self.process_all_accounts, args=(self.scan_cancel, self.read_settings())).start()
+
+    def process_all_accounts(self, cancel, settings):
+        self.log_to_console("------------------------------------------------")
+        self.log_to_console("Scanning all saved accounts...")
+        email_info = load_json_file(self.credentials_file, self.log_to_console)
+        if not email_info:
+            self.log_to_console("No saved credentials to scan.")
+            return
+        model = self.get_model(settings.learning)
+
+        keep_data_df = self.load_keep_data()
+        state_path = DEFAULT_STATE_PATH if settings.incremental else None
+        # Keep the engine, and with it the open connections, while the saved accounts stay the same
+        if self.engine is None or self.engine.accounts != email_info:
+            if self.engine is not None:
+                self.engine.close()
+            self.engine = ScanEngine(email_info, model, keep_data_df, self.log_to_console,
+                                     lambda account, *email: self.add_email_to_list(
+                                         *email, account=account, group_campaigns=self.engine.group_campaigns),
+                                     state_path=state_path, cache=self.verdict_cache, shards=SCAN_CONNECTIONS)
+        # Every other setting, the keep list and the model may have changed since the last scan
+        self.engine.configure(model, keep_data_df, state_path, settings.limit, settings.group_campaigns)
+        results = self.engine.scan(cancel=cancel)
+
+        for name, spam_count in results.items():
+            self.log_to_console(f"{name}: " + ("scan failed" if spam_count is None else f"{spam_count} spam"))
+        self.export_metrics()
         self.log_to_console("Process completed.")
         self.log_to_console("------------------------------------------------")
 
+    def toggle_watcher(self):
+        if self.watcher is not None and self.watcher.running:
+            self.watcher.stop(timeout=0)  # The watcher finishes on its own thread
+            self.watcher = None
+            self.watch_button.configure(text="Watch Inbox")
+        else:
+            threading.Thread(target=self.start_watcher, args=(self.read_settings(),)).start()
+
+    def start_watcher(self, settings):
+        user, password = self.resolve_credentials(settings.user, settings.password)
+        if not user or not password:
+            self.log_to_console("Email credentials are missing or incomplete.")
+            return
+        server = get_mail_server(user)
+        if not server:
+            self.call_in_ui(lambda: self.error_label.configure(
+                text=f"Mail server for '{user.split('@')[-1]}' not supported. Please include the full email address."))
+            return
+
+        model = self.get_model(settings.learning)
+        state_path = DEFAULT_STATE_PATH if settings.incremental else None
+        self.logins[user] = (server, user, password)
+        self.watcher = MailboxWatcher(lambda: imaplib.IMAP4_SSL(server), user, password, model, self.load_keep_data(),
+                                      self.log_to_console,
+                                      lambda *email: self.add_email_to_list(
+                                          *email, account=user, group_campaigns=settings.group_campaigns),
+                                      state_path=state_path,
+                                      cache=self.verdict_cache, group_campaigns=settings.group_campaigns)
+        self.watcher.start()
+        self.call_in_ui(lambda: self.watch_button.configure(text="Stop Watching"))
+
     def determine_mail_server(self, username):
         # Try to determine the mail server from the username
         # This is just a basic example, you may need to refine it for your use case
-        mail_servers = {
-            "gmail.com": "imap.gmail.com",
-            "outlook.com": "outlook.office365.com",
-            "yahoo.com": "imap.mail.yahoo.com",
-            "aol.com": "imap.aol.com",
-            "icloud.com": "imap.mail.me.com",
-            "zoho.com": "imap.zoho.com",
-            "protonmail.com": "imap.protonmail.ch",
-            "mail.com": "imap.mail.com",
-            "yandex.com": "imap.yandex.com",
-            "gmx.com": "imap.gmx.com",
-            "hotmail.com": "imap-mail.outlook.com",
-            "live.com": "imap-mail.outlook.com",
-            "msn.com": "imap-mail.outlook.com",
-            "me.com": "imap.mail.me.com",
-            "att.net": "imap.mail.att.net",
-            "verizon.net": "incoming.verizon.net",
-            "cox.net": "imap.cox.net",
-            "charter.net": "mobile.charter.net",
-            "earthlink.net": "imap.earthlink.net",
-            "rr.com": "mail.twc.com",
-            # Add more mail server mappings as needed
-        }
         domain = username.split('@')[-1]  # Get domain from username
-        self.mail = imaplib.IMAP4_SSL(mail_servers.get(domain))  # Get mail server based on domain
+        server = get_mail_server(username)
+        self.mail = imaplib.IMAP4_SSL(server) if server else None  # Get mail server based on domain
         if not self.mail:
             # If mail server cannot be determined, display error message
-            self.email_entry.configure(text_color="red")  # Set border color to red to indicate error
-            self.error_label.configure(
-                text=f"Mail server for '{domain}' not supported. Please include the full email address.")
+            self.call_in_ui(lambda: self.email_entry.configure(text_color="red"))  # Red to indicate the error
+            self.call_in_ui(lambda: self.error_label.configure(
+                text=f"Mail server for '{domain}' not supported. Please include the full email address."))
             return False
-            # Adjust the appearance of the email entry widget to indicate the error
         else:
-            self.email_entry.configure(text_color="white")  # Reset border color if mail server is determined
-            self.error_label.configure(text="")  # Clear error message
+            self.call_in_ui(lambda: self.email_entry.configure(text_color="white"))  # Reset the text color
+            self.call_in_ui(lambda: self.error_label.configure(text=""))  # Clear error message
             return True
 
 
     def remove_selected_spam_threaded(self):
-        threading.Thread(target=self.remove_selected_spam, args=()).start()
-
-    def remove_selected_spam(self):
-        selected_indices = self.spam_listbox.curselection()  # Get indices of selected items
-
-        if not selected_indices:
+        # The selection is read here, on the main loop; the IMAP commands run on a worker thread
+        selected_rows = self.spam_list.selected_rows()
+        if not selected_rows:
             self.log_to_console("No emails selected.")
             return
-
-        for index in selected_indices:
-            # Retrieve the detailed email information using the listbox index
-            email_detail = self.email_details.get(index)
-            if email_detail:
-                email_id = email_detail["email_id"]
-                move_email_to_spam(self.mail, email_id, self.log_to_console)
-                self.log_to_console(f"Moved to Spam: {email_detail['from']}: {email_detail['subject']}")
-
-        # Clear the listbox and dictionary of processed emails
-        for i in reversed(selected_indices):
-            self.spam_listbox.delete(i)
-            # Also remove from the email_details dictionary if necessary
-            if i in self.email_details:
-                del self.email_details[i]
-
+        # A campaign row stands for every email of the campaign
+        selected = [email for row_id in selected_rows for email in self.spam_store.members(row_id)]
+        threading.Thread(target=self.remove_selected_spam, args=(selected,)).start()
+
+    def remove_selected_spam(self, selected):
+        # Move the selection account by account; the server sees one command per chunk of UIDs
+        by_account = {}
+        for email in selected:
+            by_account.setdefault(email.account, []).append(email.email_id)
+        moved_ids = set()
+        for account, email_ids in by_account.items():
+            if account in self.logins:
+                results = self.move_with_new_login(account, email_ids)
+            else:
+                with self.engine.pool(account).connection() as mail:
+                    mail.select('inbox')
+                    results = move_emails_to_spam(mail, email_ids, self.log_to_console)
+            moved_ids.update((account, str(uid)) for uids, moved in results if moved for uid in uids)
+        self.call_in_ui(self.finish_removal, moved_ids)
+        self.export_metrics()
+
+    def move_with_new_login(self, account, email_ids):
+        # Scans and the watcher keep no connection for moves, so one is opened for the account and closed again
+        server, user, password = self.logins[account]
+        try:
+            mail = imaplib.IMAP4_SSL(server)
+        except OSError as e:
+            self.log_to_console(f"Could not connect to {server} to move emails of {user}: {e}")
+            return []
+        try:
+            mail.login(user, password)
+            mail.select('inbox')
+            return move_emails_to_spam(mail, email_ids, self.log_to_console)
+        except imaplib.IMAP4.error as e:
+            self.log_to_console(f"Could not move emails of {user}: {e}")
+            return []
+        finally:
+            close_connections([mail])
+
+    def finish_removal(self, moved_ids):
+        # Drop the moved emails from the list, and rows left without emails
+        removed = self.spam_store.remove_emails(moved_ids)
+        for email in removed:
+            self.log_to_console(f"Moved to Spam: {email.sender}: {email.subject}")
+        self.refresh_spam_list()
         self.log_to_console("Selected spam emails have been moved.")
-
-    def add_email_to_list(self, email_id, from_, subject, body):
-        listbox_index = self.spam_listbox.size()
-        self.spam_listbox.insert(tk.END, f"{from_}: {subject}")
-        # Store the email details associated with this listbox entry
-        self.email_details[listbox_index] = {"email_id": email_id, "from": from_, "subject": subject, "body": body}
-
-    def view_email_details(self):
-        selected_indices = self.spam_listbox.curselection()
-        if not selected_indices:
-            return  # No selection made
-        selected_index = selected_indices[0]  # Assuming single selection
-        email_details = self.email_details.get(selected_index)
-        if email_details:
-            EmailDetailsDialog(self, email_details)
+        if self.learning_var.get():
+            # Flagged emails left in the list are taken as not spam, once each
+            kept = [email for email in self.spam_store.emails() if email.key not in self.learned]
+            self.learned.update(email.key for email in kept)
+            threading.Thread(target=self.learn_from_decisions, args=(removed, kept)).start()
+        else:
+            self.body_store.discard(email.key for email in removed)
+
+    def email_body(self, email):
+        # The preview stands in for bodies evicted from the store
+        body = self.body_store.get(email.key)
+        return email.preview if body is None else body
+
+    def learn_from_decisions(self, removed, kept):
+        # Removed emails are confirmed spam, kept ones not spam
+        messages = [(email.sender, email.subject, self.email_body(email)) for email in removed + kept]
+        self.body_store.discard(email.key for email in removed)
+        if not messages:
+            return
+        if self.learner is None:
+            self.get_model(True)
+        snapshot = self.learner.learn(messages, [True] * len(removed) + [False] * len(kept))
+        self.log_to_console(f"Model updated from {len(removed)} removed and {len(kept)} kept email(s), "
+                            f"saved as {snapshot.name}.")
+
+    def add_email_to_list(self, email_id, from_, subject, body, account=None, group_campaigns=False):
+        # Called from scan threads; the row is added by the main loop
+        campaign = None
+        if group_campaigns:
+            campaign = self.campaigns.assign([build_model_input(from_, subject, body)])[0]
+        email = SpamEmail(str(email_id), from_, subject, make_preview(body), account)
+        self.body_store.put(email.key, body)
+        self.ui_events.put(("spam", email, campaign))
+
+    def view_email_details(self, row_id):
+        members = self.spam_store.members(row_id)
+        email = members[0]
+        body = self.body_store.get(email.key)
+        if body is None:
+            body = email.preview + "\n\n(The full text is no longer cached; only its opening is shown.)"
+        EmailDetailsDialog(self, {"from": email.sender, "subject": email.subject, "body": body,
+                                  "members": len(members)})
 
     def select_all(self):
-        self.spam_listbox.select_set(0, tk.END)
+        self.spam_list.select_all()
 
 
 if __name__ == "__main__":
     app = SpamDetectorApp()
     app.mainloop()
+    app.body_store.close()  # Deletes the temporary file holding the bodies
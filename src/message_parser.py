@@ -0,0 +1,160 @@
+import binascii
+import html
+import quopri
+import re
+from email.errors import HeaderParseError
+from email.header import decode_header, make_header
+from email.message import Message
+from email.parser import BytesHeaderParser
+from typing import Optional, Tuple
+
+# Bytes of a body part kept for classification; the rest of a long newsletter adds little but parse time
+DEFAULT_MAX_BODY_BYTES = 64 * 1024
+# Nesting depth of multiparts followed before giving up on a message
+MAX_DEPTH = 10
+
+_HEADER_END = re.compile(rb'\r?\n\r?\n')
+_HTML_DROP = re.compile(r'<(script|style|head)\b.*?</\1\s*>|<!--.*?-->', re.IGNORECASE | re.DOTALL)
+_HTML_BREAK = re.compile(r'<(?:br|/?p|/?div|/?tr|/?li|/?h[1-6]|/?table)\b[^>]*>', re.IGNORECASE)
+_HTML_TAG = re.compile(r'<[^>]*>')
+_SPACES = re.compile(r'[ \t\r\f\v]+')
+_BLANK_LINES = re.compile(r'\n\s*\n+')
+_header_parser = BytesHeaderParser()
+
+
+def decode_part(payload: bytes, encoding: str, charset: Optional[str]) -> str:
+    """
+    Undoes the transfer encoding of a (possibly truncated) body part and decodes it with its charset.
+    """
+    if encoding == 'base64':
+        compact = b''.join(payload.split())
+        # A truncated part may end in the middle of a base64 quantum
+        try:
+            payload = binascii.a2b_base64(compact[:len(compact) // 4 * 4])
+        except binascii.Error:
+            payload = b''
+    elif encoding == 'quoted-printable':
+        payload = quopri.decodestring(payload)
+    try:
+        return payload.decode(charset or 'utf-8', errors='replace')
+    except LookupError:
+        return payload.decode('utf-8', errors='replace')
+
+
+def strip_html(markup: str) -> str:
+    """Reduces HTML to its visible text: scripts, styles and tags are dropped and entities are unescaped."""
+    text = _HTML_DROP.sub(' ', markup)
+    text = _HTML_BREAK.sub('\n', text)
+    text = html.unescape(_HTML_TAG.sub(' ', text))
+    return _BLANK_LINES.sub('\n\n', _SPACES.sub(' ', text)).strip()
+
+
+def decode_body(payload: bytes, encoding: str, charset: Optional[str], subtype: str = 'plain',
+                max_body_bytes: Optional[int] = DEFAULT_MAX_BODY_BYTES) -> str:
+    """
+    Turns the raw payload of a text part into the text the model sees: at most max_body_bytes of it are
+    decoded, and HTML is stripped to its visible text.
+    """
+    if max_body_bytes:
+        payload = payload[:max_body_bytes]
+    text = decode_part(payload, (encoding or '7bit').lower(), charset)
+    return strip_html(text) if subtype == 'html' else text
+
+
+def decode_header_value(value) -> str:
+    """Decodes RFC 2047 encoded words (=?utf-8?b?...?=) in a header value."""
+    if value is None:
+        return ""
+    try:
+        return str(make_header(decode_header(str(value))))
+    except (HeaderParseError, LookupError, UnicodeError, ValueError):
+        return str(value)
+
+
+def parse_headers(header_bytes: bytes) -> Message:
+    """Parses a header block only; the body, if any follows, is not looked at."""
+    return _header_parser.parsebytes(header_bytes, headersonly=True)
+
+
+def _split_headers(raw: bytes, start: int, end: int) -> Tuple[Message, int]:
+    """Parses the headers of the part raw[start:end]. Returns them and the offset of the part's body."""
+    # Slices rather than startswith, so memory-mapped files can be parsed in place as well
+    for blank in (b'\n', b'\r\n'):
+        if raw[start:min(start + len(blank), end)] == blank:  # No headers at all
+            return parse_headers(b''), start + len(blank)
+    match = _HEADER_END.search(raw, start, end)
+    body_start = match.end() if match else end
+    return parse_headers(raw[start:body_start]), body_start
+
+
+def _iter_parts(raw: bytes, start: int, end: int, boundary: str):
+    """Yields (start, end) of every part of a multipart body, without copying any of them."""
+    delimiter = re.compile(rb'^--' + re.escape(boundary.encode('utf-8', 'replace')) + rb'(--)?[ \t]*\r?$',
+                           re.MULTILINE)
+    part_start = None
+    for match in delimiter.finditer(raw, start, end):
+        if part_start is not None:
+            # The line break before a delimiter belongs to the delimiter
+            part_end = match.start()
+            if part_end > part_start and raw[part_end - 1:part_end] == b'\n':
+                part_end -= 1
+            if part_end > part_start and raw[part_end - 1:part_end] == b'\r':
+                part_end -= 1
+            yield part_start, part_end
+        if match.group(1):
+            return
+        part_start = min(match.end() + 1, end)
+    if part_start is not None and part_start < end:
+        yield part_start, end  # Missing close delimiter
+
+
+def find_text_part(raw: bytes, start: int = 0, end: Optional[int] = None,
+                   depth: int = 0) -> Optional[Tuple[int, int, str, Optional[str], str]]:
+    """
+    Finds the first text/plain part of a raw message, or the first text/html part when there is no plain text.
+    Only part headers are parsed on the way; attachments are skipped without being decoded or copied.
+
+    Returns:
+        Optional[Tuple[int, int, str, Optional[str], str]]: (start, end, transfer encoding, charset, subtype)
+            of the part's payload in `raw`, or None when the message has no text part.
+    """
+    end = len(raw) if end is None else end
+    headers, body_start = _split_headers(raw, start, end)
+    content_type = headers.get_content_type()
+    if content_type.startswith('multipart/'):
+        boundary = headers.get_param('boundary')
+        if not boundary or depth >= MAX_DEPTH:
+            return None
+        html_part = None
+        for part_start, part_end in _iter_parts(raw, body_start, end, str(boundary)):
+            found = find_text_part(raw, part_start, part_end, depth + 1)
+            if found and found[4] == 'plain':
+                return found
+            html_part = html_part or found
+        return html_part
+    if content_type not in ('text/plain', 'text/html'):
+        return None
+    if depth and headers.get_content_disposition() == 'attachment':
+        return None
+    encoding = str(headers.get('Content-Transfer-Encoding', '7bit')).strip().lower()
+    return body_start, end, encoding, headers.get_content_charset(), headers.get_content_subtype()
+
+
+def parse_message(raw: bytes, max_body_bytes: Optional[int] = DEFAULT_MAX_BODY_BYTES, start: int = 0,
+                  end: Optional[int] = None) -> Tuple[str, str, str]:
+    """
+    Returns (sender, subject, body) of a raw message. Headers are parsed only as far as needed, only the
+    selected text part is decoded, with the charset it declares, and at most max_body_bytes of it are used.
+    With `start` and `end`, the message is raw[start:end] of a larger buffer, such as a memory-mapped mbox
+    file, and is parsed without being copied out of it.
+    """
+    end = len(raw) if end is None else end
+    headers, _ = _split_headers(raw, start, end)
+    sender, subject = decode_header_value(headers['From']), decode_header_value(headers['Subject'])
+    found = find_text_part(raw, start, end)
+    if found is None:
+        return sender, subject, ""
+    start, end, encoding, charset, subtype = found
+    if max_body_bytes:
+        end = min(end, start + max_body_bytes)
+    return sender, subject, decode_body(raw[start:end], encoding, charset, subtype, max_body_bytes)
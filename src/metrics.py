@@ -0,0 +1,215 @@
+import bisect
+import json
+import math
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+# Upper bounds of the latency buckets in seconds: 0.1 ms up to ~105 s, growing by sqrt(2)
+LATENCY_BUCKETS = tuple(round(0.0001 * 2 ** (i / 2), 7) for i in range(41))
+# Upper bounds of the batch size buckets
+SIZE_BUCKETS = tuple(2 ** i for i in range(13))
+QUANTILES = (0.5, 0.95, 0.99)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Counts observations into fixed buckets, like a Prometheus histogram, and estimates quantiles from them."""
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # The last bucket is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """
+        Interpolates within the bucket holding the q-th observation, as histogram_quantile() does, but never
+        beyond the largest value observed.
+        """
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                if index == len(self.buckets):
+                    return self.max
+                lower = self.buckets[index - 1] if index else 0.0
+                return min(lower + (self.buckets[index] - lower) * (rank - cumulative) / count, self.max)
+            cumulative += count
+        return self.max
+
+
+class Metrics:
+    """
+    Thread-safe counters and histograms for the scan path. Metrics are identified by name plus optional labels,
+    e.g. counter('imap_commands_total', command='FETCH'). Names follow Prometheus conventions (_total,
+    _seconds, _bytes), so the text export can be scraped as is.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.started = time.time()
+
+    def inc(self, name: str, amount: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + amount
+
+    def observe(self, name: str, value: float, buckets: Sequence[float] = LATENCY_BUCKETS, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    @contextmanager
+    def time(self, name: str, **labels: str) -> Iterator[None]:
+        """Observes how long the with block took, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def counter(self, name: str, **labels: str) -> float:
+        with self._lock:
+            return self.counters.get(name, {}).get(tuple(sorted(labels.items())), 0)
+
+    def histogram(self, name: str, **labels: str) -> Optional[Histogram]:
+        with self._lock:
+            return self.histograms.get(name, {}).get(tuple(sorted(labels.items())))
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started = time.time()
+
+    def to_dict(self) -> dict:
+        """All metrics as plain data: counter values, and count, sum and p50/p95/p99 of every histogram."""
+        with self._lock:
+            counters = {name: [{'labels': dict(key), 'value': value} for key, value in series.items()]
+                        for name, series in self.counters.items()}
+            histograms = {}
+            for name, series in self.histograms.items():
+                histograms[name] = [{'labels': dict(key), 'count': hist.count, 'sum': hist.sum,
+                                     **{f"p{round(q * 100)}": hist.quantile(q) for q in QUANTILES}}
+                                    for key, hist in series.items()]
+        return {'started': self.started, 'counters': counters, 'histograms': histograms}
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines: List[str] = []
+        with self._lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                lines.extend(f"{name}{_format_labels(key)} {_format_value(value)}" for key, value in series.items())
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for key, hist in series.items():
+                    cumulative = 0
+                    for bound, count in zip(hist.buckets + (math.inf,), hist.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == math.inf else _format_value(bound)
+                        lines.append(f"{name}_bucket{_format_labels(key + (('le', le),))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {_format_value(hist.sum)}")
+                    lines.append(f"{name}_count{_format_labels(key)} {hist.count}")
+        return '\n'.join(lines) + '\n'
+
+    def write_json(self, path: Union[str, Path]) -> None:
+        _write_atomically(Path(path), self.to_json())
+
+    def write_prometheus(self, path: Union[str, Path]) -> None:
+        """Writes the text format to a file, e.g. for node_exporter's textfile collector."""
+        _write_atomically(Path(path), self.to_prometheus())
+
+    def serve_prometheus(self, port: int, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+        """Serves the text format at http://host:port/metrics on a background thread. Returns the server."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def summary(self) -> str:
+        """A few lines for people: where scan time went and what was found."""
+        lines = []
+        with self._lock:
+            for title, name in (("IMAP", 'imap_command_seconds'), ("Parse", 'parse_seconds'),
+                                ("Model", 'model_inference_seconds')):
+                series = [hist for hist in self.histograms.get(name, {}).values() if hist.count]
+                if series:
+                    count, total = sum(hist.count for hist in series), sum(hist.sum for hist in series)
+                    p95 = max(hist.quantile(0.95) for hist in series)
+                    lines.append(f"{title}: {count} calls, {total:.2f}s total, p95 {p95 * 1000:.1f} ms")
+            totals = {name: sum(series.values()) for name, series in self.counters.items()}
+        if totals.get('emails_classified_total'):
+            lines.append(f"Emails: {totals['emails_classified_total']:.0f} classified, "
+                         f"{totals.get('spam_detected_total', 0):.0f} spam, "
+                         f"{totals.get('keep_list_hits_total', 0):.0f} kept by rules, "
+                         f"{totals.get('emails_moved_total', 0):.0f} moved")
+        lookups = totals.get('verdict_cache_hits_total', 0) + totals.get('verdict_cache_misses_total', 0)
+        if lookups:
+            lines.append(f"Verdict cache: {totals.get('verdict_cache_hits_total', 0) / lookups:.0%} hits "
+                         f"of {lookups:.0f} lookups")
+        if totals.get('imap_fetched_bytes_total'):
+            lines.append(f"Fetched: {totals['imap_fetched_bytes_total'] / 1_000_000:.1f} MB")
+        return '\n'.join(lines) or "No scans yet."
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ''
+    escaped = (key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+               for key, value in labels)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _write_atomically(path: Path, text: str) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    partial = path.with_suffix(path.suffix + '.partial')
+    partial.write_text(text)
+    partial.replace(path)
+
+
+# The registry the scan path records into
+METRICS = Metrics()
@@ -1,12 +1,43 @@
-from typing import Tuple
+import argparse
+import json
+import statistics
+import tempfile
+import time
+from itertools import chain, islice
+from pathlib import Path
+from typing import Dict, Iterable, List, Sequence, Tuple, Union
+
+import numpy as np
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.naive_bayes import MultinomialNB
 from sklearn.pipeline import Pipeline, make_pipeline
 from sklearn.datasets import fetch_20newsgroups
+from sklearn.feature_selection import chi2
 from sklearn.model_selection import train_test_split
-from sklearn.metrics import classification_report
+from sklearn.metrics import accuracy_score, classification_report, precision_recall_fscore_support
 import joblib
 
+from corpus import iter_messages, parse_messages
+from header_model import DEFAULT_HEADER_MODEL_PATH, create_header_model, header_input_from_raw
+from model_store import export_compact_model, load_compact_model
+from online_model import CLASSES, create_online_model
+from spam_detector import DEFAULT_BATCH_SIZE, build_model_input
+
+MODEL_PATH = Path('../models/spam_classifier.joblib')
+# Messages per partial_fit call when training from local archives
+TRAINING_CHUNK_SIZE = 1000
+# Every HOLDOUT_EVERY-th message is held out for evaluation, up to MAX_HOLDOUT of them
+HOLDOUT_EVERY = 10
+MAX_HOLDOUT = 10_000
+# Vocabulary sizes compared by --compaction-report when none are given
+DEFAULT_REPORT_SIZES = (1000, 5000, 20000)
+# Ways of ranking terms for compact_model: chi-squared statistic, or naive Bayes log-probability ratio
+SELECTION_METHODS = ('chi2', 'nb')
+# Messages classified one at a time to measure single-message latency
+LATENCY_SAMPLES = 200
+# Messages classified right after loading, as part of the load time
+WARMUP_BATCH_SIZE = 32
+
 
 def load_data() -> Tuple[list, list]:
     """
@@ -49,20 +80,25 @@ def evaluate_model(model: Pipeline, X_test: list, y_test: list) -> None:
     print(classification_report(y_test, y_pred))
 
 
-def save_model(model: Pipeline, filename: str = 'spam_classifier.joblib') -> None:
+def save_model(model: Pipeline, filename: Union[str, Path] = MODEL_PATH) -> None:
     """
     Saves the trained model to a file.
 
     Args:
         model (Pipeline): The trained machine learning model.
-        filename (str): The name of the file to save the model. Defaults to 'spam_classifier.joblib'.
+        filename (Union[str, Path]): Where to save the model. Defaults to '../models/spam_classifier.joblib',
+            where load_model looks for it.
     """
+    Path(filename).parent.mkdir(parents=True, exist_ok=True)
     joblib.dump(model, filename)
 
 
-def create_model():
+def create_model(model_path: Union[str, Path] = MODEL_PATH):
     """
     Main function to execute the model training, evaluation, and saving process.
+
+    Args:
+        model_path (Union[str, Path]): Where to save the trained model.
     """
     # Load and split the dataset
     data, target = load_data()
@@ -73,8 +109,270 @@ def create_model():
     evaluate_model(model, X_test, y_test)
 
     # Save the model
-    save_model(model)
+    save_model(model, model_path)
+
+
+def load_corpora(spam_paths: Iterable[Union[str, Path]], ham_paths: Iterable[Union[str, Path]],
+                 processes: int = None) -> Tuple[list, list]:
+    """
+    Reads local archives into memory as model inputs and labels, for training a TfidfVectorizer pipeline,
+    which needs the whole vocabulary at once, unlike train_from_corpora.
+    """
+    texts, labels = [], []
+    for label, paths in ((1, spam_paths), (0, ham_paths)):
+        for path in paths:
+            for message in parse_messages(iter_messages(path), processes):
+                texts.append(build_model_input(*message))
+                labels.append(label)
+    return texts, labels
+
+
+def feature_scores(model: Pipeline, X: list, y: list, method: str = 'chi2') -> np.ndarray:
+    """
+    Scores every term of a TfidfVectorizer + MultinomialNB pipeline by how well it tells the classes apart:
+    the chi-squared statistic of its TF-IDF weights on X, or ('nb') the spread of its log probabilities
+    across the classes, which needs no data.
+    """
+    vectorizer, classifier = model.steps[0][1], model.steps[-1][1]
+    if method == 'chi2':
+        scores, _ = chi2(vectorizer.transform(X), y)
+        return np.nan_to_num(scores)
+    if method == 'nb':
+        log_prob = classifier.feature_log_prob_
+        return log_prob.max(axis=0) - log_prob.min(axis=0)
+    raise ValueError(f"Unknown feature selection method {method!r}; use one of {SELECTION_METHODS}.")
+
+
+def compact_model(model: Pipeline, X_train: list, y_train: list, vocabulary_size: int, method: str = 'chi2',
+                  float32: bool = False) -> Pipeline:
+    """
+    Returns a smaller copy of a TfidfVectorizer + MultinomialNB pipeline that only knows the `vocabulary_size`
+    best terms (see feature_scores). It is retrained on the same data with that vocabulary, so TF-IDF
+    normalization and class probabilities are those of the smaller model. With `float32`, its weights are
+    stored in single precision, which halves the compact export.
+
+    Args:
+        model (Pipeline): The trained machine learning model.
+        X_train (list): The data it was trained on.
+        y_train (list): The labels for the training data.
+        vocabulary_size (int): Terms kept.
+        method (str): 'chi2' or 'nb', see feature_scores.
+        float32 (bool): Whether to store the weights in single precision.
+
+    Returns:
+        Pipeline: The compacted model.
+    """
+    vectorizer, classifier = model.steps[0][1], model.steps[-1][1]
+    terms = vectorizer.get_feature_names_out()
+    best = np.argsort(-feature_scores(model, X_train, y_train, method), kind='stable')[:vocabulary_size]
+    # Sorted terms get sorted feature indices, as the compact export requires
+    params = dict(vectorizer.get_params(), vocabulary=sorted(terms[best]),
+                  dtype=np.float32 if float32 else vectorizer.dtype)
+    compacted = make_pipeline(TfidfVectorizer(**params), MultinomialNB(**classifier.get_params()))
+    compacted.fit(X_train, y_train)
+    if float32:
+        compacted.steps[-1][1].feature_log_prob_ = compacted.steps[-1][1].feature_log_prob_.astype(np.float32)
+    return compacted
+
+
+def _measure(model: Pipeline, X_test: list, y_test: list) -> Dict[str, float]:
+    """Artifact sizes, load time, latency and metrics of a model, as the app would load it (compact export)."""
+    with tempfile.TemporaryDirectory() as directory:
+        joblib_path = Path(directory) / 'model.joblib'
+        joblib.dump(model, joblib_path)
+        compact_path = export_compact_model(model, Path(directory) / 'model.compact')
+        start = time.perf_counter()
+        compact = load_compact_model(compact_path)
+        compact.predict_proba(X_test[:WARMUP_BATCH_SIZE])  # Touches the mapped arrays
+        load_ms = (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        predictions = [label for offset in range(0, len(X_test), DEFAULT_BATCH_SIZE)
+                       for label in compact.predict(X_test[offset:offset + DEFAULT_BATCH_SIZE])]
+        batch_us = (time.perf_counter() - start) * 1e6 / max(len(X_test), 1)
+        single = []
+        for text in X_test[:LATENCY_SAMPLES]:
+            start = time.perf_counter()
+            compact.predict_proba([text])
+            single.append((time.perf_counter() - start) * 1000)
+
+        classes = list(compact.classes_)
+        precision, recall, f1, _ = precision_recall_fscore_support(
+            y_test, predictions, pos_label=1, average='binary' if 1 in classes and len(classes) == 2 else 'macro',
+            zero_division=0)
+        return {
+            'vocabulary': len(compact.vocabulary),
+            'joblib_kb': round(joblib_path.stat().st_size / 1024, 1),
+            'compact_kb': round(sum(path.stat().st_size for path in compact_path.iterdir()) / 1024, 1),
+            'load_ms': round(load_ms, 2),
+            'batch_us_per_message': round(batch_us, 1),
+            'single_message_ms': round(statistics.median(single), 3) if single else None,
+            'accuracy': round(accuracy_score(y_test, predictions), 4),
+            'precision': round(float(precision), 4),
+            'recall': round(float(recall), 4),
+            'f1': round(float(f1), 4),
+        }
+
+
+def compaction_report(model: Pipeline, X_train: list, y_train: list, X_test: list, y_test: list,
+                      sizes: Sequence[int] = DEFAULT_REPORT_SIZES, method: str = 'chi2',
+                      float32: bool = False) -> List[Dict[str, float]]:
+    """
+    Compacts a model to each vocabulary size (see compact_model) and measures every result, and the full model,
+    on the test set: artifact sizes, load time of the compact export, per-message latency in batches and one at
+    a time, and classification metrics. Returns one row per model, the full model first.
+    """
+    full_size = len(model.steps[0][1].vocabulary_)
+    rows = [dict(_measure(model, X_test, y_test), model='full')]
+    for size in sorted(set(size for size in sizes if 0 < size < full_size)):
+        compacted = compact_model(model, X_train, y_train, size, method, float32)
+        rows.append(dict(_measure(compacted, X_test, y_test), model=f"{method} {size}" + (" f32" if float32 else "")))
+    return rows
+
+
+def print_compaction_report(rows: Sequence[Dict[str, float]]) -> None:
+    columns = ('model', 'vocabulary', 'joblib_kb', 'compact_kb', 'load_ms', 'batch_us_per_message',
+               'single_message_ms', 'accuracy', 'precision', 'recall', 'f1')
+    widths = [max(len(column), *(len(str(row[column])) for row in rows)) for column in columns]
+    print('  '.join(column.rjust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(str(row[column]).rjust(width) for column, width in zip(columns, widths)))
+
+
+def train_from_corpora(spam_paths: Iterable[Union[str, Path]], ham_paths: Iterable[Union[str, Path]],
+                       model_path: Union[str, Path] = MODEL_PATH, chunk_size: int = TRAINING_CHUNK_SIZE,
+                       processes: int = None) -> Pipeline:
+    """
+    Trains a model out-of-core on local mail archives, without network access and without holding the corpus
+    in memory. Messages are streamed from each archive, parsed on a process pool and fed to a
+    HashingVectorizer + MultinomialNB pipeline in chunks of chunk_size with partial_fit. Naive Bayes only adds
+    up counts, so the result is the same as training on everything at once.
+
+    Args:
+        spam_paths (Iterable[Union[str, Path]]): mbox files, Maildirs or .eml directories of spam.
+        ham_paths (Iterable[Union[str, Path]]): mbox files, Maildirs or .eml directories of legitimate mail.
+        model_path (Union[str, Path]): Where to save the trained model.
+        chunk_size (int): Messages per partial_fit call.
+        processes (int): Parser processes; defaults to the number of CPUs.
+
+    Returns:
+        Pipeline: The trained machine learning model.
+    """
+    model = create_online_model()
+    vectorizer, classifier = model.steps[0][1], model.steps[-1][1]
+    holdout_texts, holdout_labels = [], []
+    seen = 0
+
+    for label, paths in ((1, spam_paths), (0, ham_paths)):
+        for path in paths:
+            texts = (build_model_input(*message) for message in parse_messages(iter_messages(path), processes))
+            trained = 0
+            while True:
+                chunk = list(islice(texts, chunk_size))
+                if not chunk:
+                    break
+                train = []
+                for text in chunk:
+                    seen += 1
+                    if seen % HOLDOUT_EVERY == 0 and len(holdout_texts) < MAX_HOLDOUT:
+                        holdout_texts.append(text)
+                        holdout_labels.append(label)
+                    else:
+                        train.append(text)
+                if train:
+                    classifier.partial_fit(vectorizer.transform(train), np.full(len(train), label),
+                                           classes=CLASSES)
+                    trained += len(train)
+            print(f"Trained on {trained} {'spam' if label else 'ham'} message(s) from {path}")
+
+    if len(set(holdout_labels)) == 2:
+        evaluate_model(model, holdout_texts, holdout_labels)
+    save_model(model, model_path)
+    return model
+
+
+def train_header_model(messages: Iterable[Tuple[Union[bytes, str], int]],
+                       model_path: Union[str, Path] = DEFAULT_HEADER_MODEL_PATH) -> Pipeline:
+    """
+    Trains the header model of the scan cascade (see HeaderCascade in spam_detector) on raw messages, of which
+    only the header blocks are read. Header inputs are a few dozen words, so they are collected in memory even
+    for large archives. Every HOLDOUT_EVERY-th message is held out to report the accuracy.
+
+    Args:
+        messages (Iterable[Tuple[Union[bytes, str], int]]): (raw message, label) pairs, 1 for spam.
+        model_path (Union[str, Path]): Where to save the trained model.
+
+    Returns:
+        Pipeline: The trained header model.
+    """
+    texts, labels, holdout_texts, holdout_labels = [], [], [], []
+    for number, (raw, label) in enumerate(messages, start=1):
+        held_out = number % HOLDOUT_EVERY == 0 and len(holdout_texts) < MAX_HOLDOUT
+        (holdout_texts if held_out else texts).append(header_input_from_raw(raw))
+        (holdout_labels if held_out else labels).append(int(label))
+    model = create_header_model(texts, labels)
+    if len(set(holdout_labels)) == 2:
+        evaluate_model(model, holdout_texts, holdout_labels)
+    save_model(model, model_path)
+    return model
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Train the spam model. Without --spam and --ham, it is trained on "
+                                                 "the 20 Newsgroups demo data, which needs network access.")
+    parser.add_argument('--spam', nargs='+', action='extend', default=[], type=Path,
+                        help="mbox files, Maildirs or .eml directories of spam")
+    parser.add_argument('--ham', nargs='+', action='extend', default=[], type=Path,
+                        help="mbox files, Maildirs or .eml directories of legitimate mail")
+    parser.add_argument('--model', type=Path, default=MODEL_PATH, help="Where to save the model")
+    parser.add_argument('--chunk-size', type=int, default=TRAINING_CHUNK_SIZE)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--header-model', type=Path, default=None,
+                        help="Also train the header model of the scan cascade on the same data and save it here")
+    parser.add_argument('--vocabulary-size', type=int, default=None,
+                        help="Keep only this many terms (see compact_model); local archives are then read into "
+                             "memory to train a TF-IDF model instead of the out-of-core one")
+    parser.add_argument('--compaction-report', nargs='?', const=','.join(map(str, DEFAULT_REPORT_SIZES)),
+                        default=None, metavar='SIZES',
+                        help="Compare the full model with compacted ones at these vocabulary sizes "
+                             f"(default: {','.join(map(str, DEFAULT_REPORT_SIZES))}) without saving any")
+    parser.add_argument('--report-json', type=Path, default=None, help="Also write the compaction report here")
+    parser.add_argument('--selection', choices=SELECTION_METHODS, default='chi2',
+                        help="How terms are ranked for compaction")
+    parser.add_argument('--float32', action='store_true', help="Store compacted weights in single precision")
+    args = parser.parse_args()
+
+    if bool(args.spam) != bool(args.ham):
+        parser.error("--spam and --ham are both required to train on local archives.")
+    if args.compaction_report or args.vocabulary_size:
+        data, target = load_corpora(args.spam, args.ham, args.processes) if args.spam else load_data()
+        X_train, X_test, y_train, y_test = train_test_split(data, target, test_size=0.25, random_state=42)
+        model = create_and_train_model(X_train, y_train)
+        if args.compaction_report:
+            try:
+                sizes = [int(size) for size in args.compaction_report.split(',')]
+            except ValueError:
+                parser.error("--compaction-report takes vocabulary sizes, e.g. 1000,5000,20000")
+            rows = compaction_report(model, X_train, y_train, X_test, y_test, sizes, args.selection, args.float32)
+            print_compaction_report(rows)
+            if args.report_json:
+                args.report_json.write_text(json.dumps(rows, indent=2))
+        if args.vocabulary_size:
+            model = compact_model(model, X_train, y_train, args.vocabulary_size, args.selection, args.float32)
+            evaluate_model(model, X_test, y_test)
+            save_model(model, args.model)
+    elif not args.spam:
+        create_model(args.model)
+    else:
+        train_from_corpora(args.spam, args.ham, args.model, args.chunk_size, args.processes)
+
+    if args.header_model and not args.spam:
+        train_header_model(zip(*load_data()), args.header_model)
+    elif args.header_model:
+        train_header_model(chain(((raw, 1) for path in args.spam for raw in iter_messages(path)),
+                                 ((raw, 0) for path in args.ham for raw in iter_messages(path))),
+                           args.header_model)
 
 
 if __name__ == "__main__":
-    create_model()
+    main()
@@ -0,0 +1,196 @@
+import json
+import re
+from collections import Counter
+from pathlib import Path
+from typing import Iterable, List, Optional, Sequence, Union
+
+import numpy as np
+
+# Bumped whenever the layout of the exported files changes
+FORMAT_VERSION = 1
+COMPACT_SUFFIX = '.compact'
+
+# Inputs every export is checked on: empty, punctuation only, and out of vocabulary, which sklearn answers with the
+# class priors, plus some of the model's own terms (see export_compact_model)
+_PROBE_DOCUMENTS = ('', '!!! ... ???', 'zzzzqqq xxyyzz')
+_PROBE_TERMS = 50
+
+# Vectorizer settings the compact model reproduces without scikit-learn
+_SUPPORTED_PARAMS = ('lowercase', 'token_pattern', 'ngram_range', 'stop_words', 'binary', 'norm', 'use_idf',
+                     'sublinear_tf')
+
+
+def compact_path_for(model_path: Union[str, Path]) -> Path:
+    """Returns where the compact export of a joblib model lives, e.g. models/spam_classifier.compact."""
+    return Path(model_path).with_suffix(COMPACT_SUFFIX)
+
+
+def file_stamp(path: Union[str, Path]) -> tuple:
+    """Modification time and size of a file, used to notice that it changed."""
+    stat = Path(path).stat()
+    return stat.st_mtime_ns, stat.st_size
+
+
+class CompactSpamModel:
+    """
+    A TF-IDF + multinomial naive Bayes classifier stored as flat arrays. The arrays are memory-mapped, so loading
+    is nearly free, several processes share the same pages, and scikit-learn does not need to be imported.
+    Offers the predict / predict_proba / classes_ interface of the scikit-learn pipeline it was exported from.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        meta = json.loads((self.path / 'meta.json').read_text())
+        if meta.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f"Unsupported compact model format in {self.path}")
+        self.params = meta['vectorizer']
+        self.classes_ = np.array(meta['classes'])
+        self.source_stamp = tuple(meta['source_stamp']) if meta.get('source_stamp') else None
+
+        # Sorted UTF-8 terms; a term's position is its feature index
+        self.vocabulary = np.load(self.path / 'vocabulary.npy', mmap_mode='r')
+        self.idf = np.load(self.path / 'idf.npy', mmap_mode='r')
+        # (n_features, n_classes), so the rows of a message's terms are contiguous
+        self.feature_log_prob = np.load(self.path / 'feature_log_prob.npy', mmap_mode='r')
+        self.class_log_prior = np.load(self.path / 'class_log_prior.npy')
+
+        self._token_pattern = re.compile(self.params['token_pattern'])
+        self._stop_words = frozenset(self.params['stop_words'] or ())
+        self._max_term_bytes = self.vocabulary.dtype.itemsize
+
+    def analyze(self, document: str) -> List[str]:
+        """Splits a document into terms exactly like the exported TfidfVectorizer."""
+        if self.params['lowercase']:
+            document = document.lower()
+        tokens = [token for token in self._token_pattern.findall(document) if token not in self._stop_words]
+        min_n, max_n = self.params['ngram_range']
+        if max_n == 1:
+            return tokens
+        terms = tokens if min_n == 1 else []
+        for n in range(max(min_n, 2), max_n + 1):
+            terms.extend(' '.join(tokens[i:i + n]) for i in range(len(tokens) - n + 1))
+        return terms
+
+    def _features(self, documents: Sequence[str]):
+        """Returns (document index, feature index, weight) arrays of the TF-IDF matrix, one entry per non-zero."""
+        doc_ids, terms, counts = [], [], []
+        for doc_id, document in enumerate(documents):
+            for term, count in Counter(self.analyze(document)).items():
+                encoded = term.encode('utf-8')
+                # Longer terms cannot be in the vocabulary, and would be truncated by the fixed-width array
+                if len(encoded) <= self._max_term_bytes:
+                    doc_ids.append(doc_id)
+                    terms.append(encoded)
+                    counts.append(count)
+        if not terms:
+            return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), np.zeros(0)
+
+        terms = np.array(terms, dtype=self.vocabulary.dtype)
+        positions = np.searchsorted(self.vocabulary, terms)
+        positions[positions == len(self.vocabulary)] = 0
+        known = self.vocabulary[positions] == terms
+
+        doc_ids = np.array(doc_ids, dtype=np.intp)[known]
+        features = positions[known]
+        weights = np.array(counts, dtype=np.float64)[known]
+        if self.params['binary']:
+            weights[:] = 1.0
+        if self.params['sublinear_tf']:
+            weights = np.log(weights) + 1.0
+        if self.params['use_idf']:
+            weights *= self.idf[features]
+        norm = self.params['norm']
+        if norm:
+            totals = np.bincount(doc_ids, weights=weights * weights if norm == 'l2' else np.abs(weights),
+                                 minlength=len(documents))
+            if norm == 'l2':
+                totals = np.sqrt(totals)
+            totals[totals == 0.0] = 1.0
+            weights /= totals[doc_ids]
+        return doc_ids, features, weights
+
+    def predict_log_proba(self, documents: Iterable[str]) -> np.ndarray:
+        documents = list(documents)
+        doc_ids, features, weights = self._features(documents)
+        rows = self.feature_log_prob[features]
+        # Float from the start: for a batch without a single known term, bincount would return integers
+        joint = np.zeros((len(documents), len(self.classes_)))
+        for column in range(len(self.classes_)):
+            joint[:, column] = np.bincount(doc_ids, weights=weights * rows[:, column], minlength=len(documents))
+        joint += self.class_log_prior
+        # Normalise with log-sum-exp, as MultinomialNB does
+        top = joint.max(axis=1, keepdims=True)
+        return joint - (top + np.log(np.exp(joint - top).sum(axis=1, keepdims=True)))
+
+    def predict_proba(self, documents: Iterable[str]) -> np.ndarray:
+        return np.exp(self.predict_log_proba(documents))
+
+    def predict(self, documents: Iterable[str]) -> np.ndarray:
+        return self.classes_[self.predict_log_proba(documents).argmax(axis=1)]
+
+
+def is_exportable(pipeline) -> bool:
+    """
+    Whether a model is a TfidfVectorizer + MultinomialNB pipeline, the only kind export_compact_model writes.
+    Other models, such as the hashed ones an OnlineLearner trains, are served as they are.
+    """
+    steps = [step for _, step in getattr(pipeline, 'steps', [])]
+    return len(steps) == 2 and type(steps[0]).__name__ == 'TfidfVectorizer' and \
+        type(steps[1]).__name__ == 'MultinomialNB'
+
+
+def export_compact_model(pipeline, path: Union[str, Path], source_stamp: Optional[tuple] = None) -> Path:
+    """
+    Writes a fitted TfidfVectorizer + MultinomialNB pipeline as a CompactSpamModel directory.
+    Raises ValueError for pipelines the compact format cannot reproduce.
+    """
+    if not is_exportable(pipeline):
+        raise ValueError("Only TfidfVectorizer + MultinomialNB pipelines can be exported.")
+    vectorizer, classifier = [step for _, step in pipeline.steps]
+    params = vectorizer.get_params()
+    if params['analyzer'] != 'word' or params['preprocessor'] or params['tokenizer'] or params['strip_accents']:
+        raise ValueError("Only the default word analyzer can be exported.")
+    stop_words = vectorizer.get_stop_words()
+
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    terms = sorted(vectorizer.vocabulary_, key=vectorizer.vocabulary_.get)
+    encoded = [term.encode('utf-8') for term in terms]
+    # Feature indices follow the sorted order of the terms, which a binary search over UTF-8 bytes relies on
+    if encoded != sorted(encoded):
+        raise ValueError("Vocabulary indices are not in sorted term order.")
+    np.save(path / 'vocabulary.npy', np.array(encoded, dtype=f"S{max(len(term) for term in encoded)}"))
+    # float32 models (see ml_model.compact_model) stay float32, halving the mapped arrays
+    dtype = np.float32 if classifier.feature_log_prob_.dtype == np.float32 else np.float64
+    np.save(path / 'idf.npy', np.asarray(getattr(vectorizer, 'idf_', np.ones(len(terms))), dtype=dtype))
+    np.save(path / 'feature_log_prob.npy', np.ascontiguousarray(classifier.feature_log_prob_.T, dtype=dtype))
+    np.save(path / 'class_log_prior.npy', classifier.class_log_prior_)
+
+    meta = {
+        'format_version': FORMAT_VERSION,
+        'vectorizer': {name: params[name] for name in _SUPPORTED_PARAMS},
+        'classes': classifier.classes_.tolist(),
+        'source_stamp': list(source_stamp) if source_stamp else None,
+    }
+    meta['vectorizer']['stop_words'] = sorted(stop_words) if stop_words else None
+    meta['vectorizer']['ngram_range'] = list(params['ngram_range'])
+    # Written last, so a half-written export is never mistaken for a complete one
+    (path / 'meta.json').write_text(json.dumps(meta, indent=2))
+
+    # An export that answers differently from the pipeline is removed rather than served
+    probes = list(_PROBE_DOCUMENTS) + [' '.join(terms[:_PROBE_TERMS]), ' '.join(terms[-_PROBE_TERMS:])]
+    tolerance = 1e-4 if dtype == np.float32 else 1e-8
+    try:
+        matches = np.allclose(load_compact_model(path).predict_proba(probes), pipeline.predict_proba(probes),
+                              atol=tolerance)
+    except Exception:
+        (path / 'meta.json').unlink()
+        raise
+    if not matches:
+        (path / 'meta.json').unlink()
+        raise ValueError("Compact model does not reproduce the pipeline's probabilities.")
+    return path
+
+
+def load_compact_model(path: Union[str, Path]) -> CompactSpamModel:
+    return CompactSpamModel(path)
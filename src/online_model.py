@@ -0,0 +1,153 @@
+import copy
+import re
+import threading
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional, Sequence, Tuple
+
+import joblib
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.naive_bayes import MultinomialNB
+from sklearn.pipeline import Pipeline, make_pipeline
+
+from spam_detector import build_model_input
+from verdict_cache import set_model_version
+
+ONLINE_MODEL_DIR = Path("../models/online")
+# Hashed feature space; fixed, so new words never require refitting a vocabulary
+N_FEATURES = 2 ** 18
+# Class labels, as in the offline model: 1 is spam
+CLASSES = np.array([0, 1])
+# Number of snapshots kept on disk; older ones are deleted after every save
+KEEP_SNAPSHOTS = 10
+
+_SNAPSHOT_NAME = re.compile(r'^spam_classifier\.v(\d+)\.joblib$')
+
+
+def create_online_model(base: Optional[Pipeline] = None) -> Pipeline:
+    """
+    Creates a HashingVectorizer + MultinomialNB pipeline that can be updated with partial_fit. Pass
+    classes=CLASSES to partial_fit, since an unseeded model has not seen any classes yet.
+
+    Args:
+        base (Optional[Pipeline]): A fitted TfidfVectorizer + MultinomialNB pipeline. Its per-term counts are
+            folded into the hashed feature space, so the new model starts out agreeing with it instead of empty.
+            A model that is already hashed, such as one from ml_model.train_from_corpora, is copied.
+
+    Returns:
+        Pipeline: The online model.
+    """
+    if base is not None and not hasattr(base, 'steps'):
+        raise TypeError(f"Cannot seed an online model from a {type(base).__name__}; load the pipeline itself, "
+                        f"e.g. with load_model(..., compact=False).")
+    vectorizer = HashingVectorizer(n_features=N_FEATURES, alternate_sign=False)
+    classifier = MultinomialNB()
+    if base is not None and isinstance(base.steps[0][1], HashingVectorizer):
+        return copy.deepcopy(base)  # Trained out-of-core, already in the hashed feature space
+    if base is not None:
+        base_vectorizer, base_classifier = base.steps[0][1], base.steps[-1][1]
+        terms = sorted(base_vectorizer.vocabulary_, key=base_vectorizer.vocabulary_.get)
+        # One row per term with a single non-zero at the term's hashed feature
+        hashed = vectorizer.transform(terms)
+        hashed.data[:] = 1.0
+        columns = [list(base_classifier.classes_).index(label) for label in CLASSES]
+        class_count = base_classifier.class_count_[columns]
+        feature_count = sparse.csr_matrix(hashed.T @ base_classifier.feature_count_[columns].T).T
+        # One pseudo-sample per class, weighted so that the counts add up to the base model's
+        classifier.partial_fit(sparse.diags(1.0 / class_count) @ feature_count, CLASSES, classes=CLASSES,
+                               sample_weight=class_count)
+    return make_pipeline(vectorizer, classifier)
+
+
+def list_snapshots(snapshot_dir: Path = ONLINE_MODEL_DIR) -> List[Tuple[int, Path]]:
+    """Returns (version, path) of every saved snapshot, oldest first."""
+    if not snapshot_dir.is_dir():
+        return []
+    snapshots = []
+    for path in snapshot_dir.iterdir():
+        match = _SNAPSHOT_NAME.match(path.name)
+        if match:
+            snapshots.append((int(match.group(1)), path))
+    return sorted(snapshots)
+
+
+class OnlineLearner:
+    """
+    Updates an online model with the decisions a user makes in the app and saves every update as a new,
+    numbered snapshot (spam_classifier.v0001.joblib, ...). Each update is a single partial_fit on the
+    labelled emails, so it costs about a millisecond per email regardless of how much was learned before.
+
+    Args:
+        model (Pipeline): A model created by create_online_model, or a snapshot of one.
+        snapshot_dir (Path): Where snapshots are saved.
+        version (int): Version of the snapshot the model was loaded from, 0 for a new model.
+        keep (int): Number of snapshots kept on disk.
+    """
+
+    def __init__(self, model: Pipeline, snapshot_dir: Path = ONLINE_MODEL_DIR, version: int = 0,
+                 keep: int = KEEP_SNAPSHOTS):
+        self.model = model
+        self.snapshot_dir = snapshot_dir
+        self.version = version
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._set_version()
+
+    @classmethod
+    def load(cls, base_model: Callable[[], Pipeline], log_func: Callable[[str], None],
+             snapshot_dir: Path = ONLINE_MODEL_DIR) -> 'OnlineLearner':
+        """
+        Resumes from the newest snapshot in snapshot_dir. Without one, a new online model is seeded from the
+        offline model returned by base_model.
+        """
+        for version, path in reversed(list_snapshots(snapshot_dir)):
+            try:
+                model = joblib.load(path)
+            except (OSError, ValueError, EOFError) as e:
+                log_func(f"Skipping unreadable model snapshot {path}: {e}")
+                continue
+            log_func(f"Loaded online model version {version}.")
+            return cls(model, snapshot_dir, version)
+        log_func("No online model snapshot found. Starting from the offline model.")
+        return cls(create_online_model(base_model()), snapshot_dir)
+
+    def learn(self, messages: Sequence[Tuple[str, str, str]], labels: Iterable[bool]) -> Optional[Path]:
+        """
+        Updates the model with labelled emails and saves the result as a new snapshot.
+
+        Args:
+            messages (Sequence[Tuple[str, str, str]]): (sender, subject, body) for each email.
+            labels (Iterable[bool]): Whether each email is spam.
+
+        Returns:
+            Optional[Path]: The saved snapshot, or None if there was nothing to learn.
+        """
+        labels = np.array([int(bool(label)) for label in labels], dtype=int)
+        if not len(messages):
+            return None
+        vectorizer, classifier = self.model.steps[0][1], self.model.steps[-1][1]
+        features = vectorizer.transform([build_model_input(*message) for message in messages])
+        with self._lock:
+            classifier.partial_fit(features, labels, classes=CLASSES)
+            return self.save_snapshot()
+
+    def save_snapshot(self) -> Path:
+        """Saves the model as the next version and deletes snapshots beyond the newest `keep`."""
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+        self.version += 1
+        self._set_version()
+        path = self.snapshot_dir / f"spam_classifier.v{self.version:04d}.joblib"
+        # Written under a temporary name first, so a crash never leaves a truncated newest snapshot
+        partial = path.with_suffix('.partial')
+        joblib.dump(self.model, partial, compress=3)
+        partial.replace(path)
+        for _, old in list_snapshots(self.snapshot_dir)[:-self.keep]:
+            old.unlink(missing_ok=True)
+        return path
+
+    def _set_version(self) -> None:
+        # Verdicts cached for the previous version are invalidated; version 0 is never cached, since a new
+        # model seeded from another offline model would have the same number
+        if self.version:
+            set_model_version(self.model, f"{self.snapshot_dir.resolve()}/v{self.version:04d}")
@@ -0,0 +1,202 @@
+import imaplib
+import queue
+import threading
+from concurrent.futures import Executor
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from imap_fetch import FetchedEmail, RawEmail, decode_emails, fetch_raw
+from message_parser import DEFAULT_MAX_BODY_BYTES
+from metrics import METRICS
+
+# Chunks waiting between two stages; a full queue makes the stage before it wait (backpressure)
+DEFAULT_QUEUE_SIZE = 4
+# Threads decoding fetched chunks, and threads classifying decoded ones
+DEFAULT_PARSE_WORKERS = 1
+DEFAULT_CLASSIFY_WORKERS = 1
+# Seconds a blocked stage waits before checking whether the scan was stopped
+_POLL_SECONDS = 0.1
+
+Verdicts = List[Tuple[int, bool, float]]
+
+
+class ScanCancelled(Exception):
+    """Raised inside the pipeline's threads when the scan was stopped; never leaves ScanPipeline.run."""
+
+
+class ScanPipeline:
+    """
+    Scans UIDs in stages that run at the same time, so the network is never idle while emails are parsed or
+    classified, and the CPU is never idle while waiting for the server:
+
+        fetcher per connection -> parse workers -> classify workers -> the caller, in UID order
+
+    Each fetcher takes the next chunk of `batch_size` UIDs whenever it is ready, so with several connections
+    to the same mailbox the UIDs are split among them and a slow connection simply takes fewer chunks.
+    Stages are connected by queues of `queue_size` chunks; when a later stage falls behind, the earlier ones
+    wait, so memory stays bounded whatever the number of emails.
+
+    Args:
+        classify (Callable[[List[FetchedEmail]], Verdicts]): Classifies and reports one decoded chunk, returning
+            its (uid, is_spam, score) verdicts. Called from the classify workers.
+        batch_size (int): UIDs fetched and classified per chunk.
+        max_body_bytes (Optional[int]): Bytes of each email's text part downloaded and classified.
+        fetch (Optional[Callable[[imaplib.IMAP4, List[int]], List[RawEmail]]]): Downloads one chunk on one of the
+            connections; fetch_raw by default. Called from the fetchers.
+        parse_workers (int): Threads decoding chunks.
+        classify_workers (int): Threads classifying chunks.
+        queue_size (int): Chunks waiting between two stages.
+        parse_pool (Optional[Executor]): Process pool the parse workers hand their chunks to, so decoding
+            runs outside the interpreter lock.
+        cancel (Optional[threading.Event]): Set it to stop the scan; chunks already being fetched are finished
+            first, so the connections stay usable.
+    """
+
+    def __init__(self, classify: Callable[[List[FetchedEmail]], Verdicts], batch_size: int,
+                 max_body_bytes: Optional[int] = DEFAULT_MAX_BODY_BYTES,
+                 fetch: Optional[Callable[[imaplib.IMAP4, List[int]], List[RawEmail]]] = None,
+                 parse_workers: int = DEFAULT_PARSE_WORKERS, classify_workers: int = DEFAULT_CLASSIFY_WORKERS,
+                 queue_size: int = DEFAULT_QUEUE_SIZE, parse_pool: Optional[Executor] = None,
+                 cancel: Optional[threading.Event] = None):
+        self.classify = classify
+        self.batch_size = batch_size
+        self.max_body_bytes = max_body_bytes
+        self.fetch = fetch or (lambda mail, uids: fetch_raw(mail, uids, max_body_bytes))
+        self.parse_workers = max(1, parse_workers)
+        self.classify_workers = max(1, classify_workers)
+        self.queue_size = queue_size
+        self.parse_pool = parse_pool
+        self.cancel = cancel or threading.Event()
+
+    def run(self, connections: Sequence[imaplib.IMAP4], uids: Iterable[int]) -> Iterator[Tuple[List[int], Verdicts]]:
+        """
+        Scans `uids` of the mailbox selected on every connection and yields (chunk, verdicts) for each chunk of
+        UIDs, in the order of `uids`. Stops early, without an error, once `cancel` is set. An error in any stage
+        stops the other stages and is raised here.
+        `uids` is consumed lazily, a few chunks ahead of the fetchers, and only on the thread of the first
+        connection's fetcher, between its commands; it may therefore be a generator that searches on that
+        connection, such as iter_uids.
+        """
+        if not connections:
+            return
+        stop = threading.Event()
+        errors: List[BaseException] = []
+        uid_iterator = iter(uids)
+        # Chunks listed so far, and whether every chunk has been listed
+        listed = [0]
+        listing_done = threading.Event()
+        chunk_queue: "queue.Queue[Tuple[int, List[int]]]" = queue.Queue(self.queue_size * len(connections))
+        raw_queue: "queue.Queue[Tuple[int, List[int], List[RawEmail]]]" = queue.Queue(self.queue_size)
+        parsed_queue: "queue.Queue[Tuple[int, List[int], List[FetchedEmail]]]" = queue.Queue(self.queue_size)
+        results: "queue.Queue[Tuple[int, List[int], Verdicts]]" = queue.Queue()
+
+        def stopped() -> bool:
+            return stop.is_set() or self.cancel.is_set()
+
+        def put(target: queue.Queue, item) -> None:
+            while True:
+                if stopped():
+                    raise ScanCancelled()
+                try:
+                    target.put(item, timeout=_POLL_SECONDS)
+                    METRICS.observe('pipeline_queue_depth', target.qsize(), (0, 1, 2, 4, 8, 16, 32))
+                    return
+                except queue.Full:
+                    continue
+
+        def get(source: queue.Queue):
+            while True:
+                if stopped():
+                    raise ScanCancelled()
+                try:
+                    return source.get(timeout=_POLL_SECONDS)
+                except queue.Empty:
+                    continue
+
+        def stage(work: Callable[[], None]) -> Callable[[], None]:
+            def target() -> None:
+                try:
+                    work()
+                except ScanCancelled:
+                    pass
+                except BaseException as e:  # Raised again by run, on the caller's thread
+                    errors.append(e)
+                    stop.set()
+            return target
+
+        def list_chunks() -> None:
+            """Lists chunks until the chunk queue is full or `uids` runs out."""
+            while not listing_done.is_set() and not chunk_queue.full():
+                chunk = list(islice(uid_iterator, self.batch_size))
+                if not chunk:
+                    listing_done.set()
+                    return
+                chunk_queue.put((listed[0], chunk))
+                listed[0] += 1
+
+        def fetcher(mail: imaplib.IMAP4, lists: bool) -> Callable[[], None]:
+            def work() -> None:
+                while not stopped():
+                    if lists:
+                        list_chunks()
+                    try:
+                        index, chunk = chunk_queue.get(timeout=_POLL_SECONDS)
+                    except queue.Empty:
+                        if listing_done.is_set():
+                            return
+                        continue
+                    with METRICS.time('pipeline_stage_seconds', stage='fetch'):
+                        raw = self.fetch(mail, chunk)
+                    put(raw_queue, (index, chunk, raw))
+            return work
+
+        def parser() -> None:
+            while True:
+                index, chunk, raw = get(raw_queue)
+                with METRICS.time('pipeline_stage_seconds', stage='parse'):
+                    if self.parse_pool is not None:
+                        fetched = self.parse_pool.submit(decode_emails, raw, self.max_body_bytes).result()
+                    else:
+                        fetched = decode_emails(raw, self.max_body_bytes)
+                METRICS.inc('emails_fetched_total', len(fetched))
+                put(parsed_queue, (index, chunk, fetched))
+
+        def classifier() -> None:
+            while True:
+                index, chunk, fetched = get(parsed_queue)
+                with METRICS.time('pipeline_stage_seconds', stage='classify'):
+                    verdicts = self.classify(fetched)
+                results.put((index, chunk, verdicts))
+
+        threads = [threading.Thread(target=stage(fetcher(mail, number == 0)), name=f"scan-fetch-{number}",
+                                    daemon=True)
+                   for number, mail in enumerate(connections)]
+        threads += [threading.Thread(target=stage(parser), name=f"scan-parse-{number}", daemon=True)
+                    for number in range(self.parse_workers)]
+        threads += [threading.Thread(target=stage(classifier), name=f"scan-classify-{number}", daemon=True)
+                    for number in range(self.classify_workers)]
+        for thread in threads:
+            thread.start()
+
+        # Chunks finished out of order wait here until the chunks before them are done
+        finished: Dict[int, Tuple[List[int], Verdicts]] = {}
+        next_index = 0
+        try:
+            while not (listing_done.is_set() and next_index >= listed[0]):
+                try:
+                    index, chunk, verdicts = results.get(timeout=_POLL_SECONDS)
+                except queue.Empty:
+                    if stopped():
+                        break
+                    continue
+                finished[index] = (chunk, verdicts)
+                while next_index in finished:
+                    yield finished.pop(next_index)
+                    next_index += 1
+        finally:
+            stop.set()
+            # Fetchers finish their current command, so the connections can be used again afterwards
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
@@ -0,0 +1,105 @@
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Tuple, Union
+
+DEFAULT_STATE_PATH = Path("../data/scan_state.sqlite3")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS checkpoints (
+    account TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    last_uid INTEGER NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (account, folder)
+);
+CREATE TABLE IF NOT EXISTS verdicts (
+    account TEXT NOT NULL,
+    folder TEXT NOT NULL,
+    uidvalidity INTEGER NOT NULL,
+    uid INTEGER NOT NULL,
+    is_spam INTEGER NOT NULL,
+    score REAL NOT NULL,
+    scanned_at REAL NOT NULL,
+    PRIMARY KEY (account, folder, uidvalidity, uid)
+);
+"""
+
+
+class ScanStateStore:
+    """
+    Remembers, per account and folder, the highest UID already classified and the verdict for every
+    classified email, so later scans only need to fetch newer mail. Everything recorded for a folder is
+    discarded when its UIDVALIDITY changes, since the server may then have reassigned UIDs.
+    """
+
+    def __init__(self, path: Union[str, Path] = DEFAULT_STATE_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.path))
+        self.connection.executescript(_SCHEMA)
+
+    def close(self) -> None:
+        self.connection.close()
+
+    def __enter__(self) -> "ScanStateStore":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def get_checkpoint(self, account: str, folder: str, uidvalidity: int) -> int:
+        """
+        Returns the highest UID already classified, or 0 if the folder must be scanned from the start.
+        """
+        row = self.connection.execute(
+            "SELECT uidvalidity, last_uid FROM checkpoints WHERE account = ? AND folder = ?",
+            (account, folder)).fetchone()
+        if row is None:
+            return 0
+        if row[0] != uidvalidity:
+            self.reset(account, folder)
+            return 0
+        return row[1]
+
+    def reset(self, account: str, folder: str) -> None:
+        """Forgets the checkpoint and verdicts of a folder."""
+        with self.connection:
+            self.connection.execute("DELETE FROM checkpoints WHERE account = ? AND folder = ?", (account, folder))
+            self.connection.execute("DELETE FROM verdicts WHERE account = ? AND folder = ?", (account, folder))
+
+    def record_verdicts(self, account: str, folder: str, uidvalidity: int,
+                        verdicts: Iterable[Tuple[int, bool, float]]) -> None:
+        """
+        Stores (uid, is_spam, score) for classified emails and advances the folder's checkpoint past them.
+        """
+        now = time.time()
+        rows = [(account, folder, uidvalidity, int(uid), int(bool(spam)), float(score), now)
+                for uid, spam, score in verdicts]
+        if not rows:
+            return
+        last_uid = max(row[3] for row in rows)
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO verdicts (account, folder, uidvalidity, uid, is_spam, score, scanned_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.connection.execute(
+                "INSERT INTO checkpoints (account, folder, uidvalidity, last_uid, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (account, folder) DO UPDATE SET "
+                "last_uid = MAX(last_uid, excluded.last_uid), uidvalidity = excluded.uidvalidity, "
+                "updated_at = excluded.updated_at",
+                (account, folder, uidvalidity, last_uid, now))
+
+    def get_verdicts(self, account: str, folder: str, spam_only: bool = False) -> Dict[int, Tuple[bool, float]]:
+        """Returns {uid: (is_spam, score)} for every email recorded in a folder."""
+        query = "SELECT uid, is_spam, score FROM verdicts WHERE account = ? AND folder = ?"
+        if spam_only:
+            query += " AND is_spam = 1"
+        return {uid: (bool(spam), score) for uid, spam, score in self.connection.execute(query, (account, folder))}
+
+    def forget_uids(self, account: str, folder: str, uids: Iterable[int]) -> None:
+        """Drops the verdicts of emails that no longer exist in the folder, e.g. after moving them to Spam."""
+        with self.connection:
+            self.connection.executemany("DELETE FROM verdicts WHERE account = ? AND folder = ? AND uid = ?",
+                                        [(account, folder, int(uid)) for uid in uids])
@@ -1,29 +1,148 @@
-import email
+import argparse
 import imaplib
 import json
+import sys
+import threading
+import time
+from concurrent.futures import Executor
+from datetime import date
+from functools import partial
+from itertools import islice
 from pathlib import Path
-from typing import Optional, Dict, Callable
+from typing import TYPE_CHECKING, Optional, Dict, Callable, Iterable, Iterator, List, Sequence, Set, Tuple, Union
 
-import joblib
-import pandas as pd
+from campaigns import CampaignIndex
+from classify_service import ServiceClient
+from header_model import CASCADE_HEADER_FIELDS, DEFAULT_UNCERTAINTY_BAND, build_header_input, is_uncertain
+from imap_fetch import FetchedEmail, RawEmail, decode_emails, fetch_emails, fetch_headers, fetch_raw, get_uidvalidity, \
+    header_bytes, header_search_criteria, iter_uids, search_any_uids, uid_command, uid_set_chunks
+from message_parser import DEFAULT_MAX_BODY_BYTES, parse_headers
+from keep_list import KeepListMatcher, compile_keep_list
+from metrics import METRICS, SIZE_BUCKETS
+from model_store import compact_path_for, export_compact_model, file_stamp, is_exportable, load_compact_model
+from scan_pipeline import DEFAULT_CLASSIFY_WORKERS, DEFAULT_PARSE_WORKERS, ScanPipeline
+from scan_state import ScanStateStore
+from verdict_cache import DEFAULT_CACHE_PATH, VerdictCache, input_digest, model_version, set_model_version
 
-from ml_model import create_model
+if TYPE_CHECKING:  # Only the GUI passes DataFrames; the scan path itself does not need pandas
+    import pandas as pd
 
+# Loaded models by resolved path, with the file stamp they were loaded from
+_model_cache: Dict[str, Tuple[tuple, object]] = {}
+_model_cache_lock = threading.Lock()
 
-def load_model(model_path: str, log_func: Callable[[str], None]):
+# Number of emails handed to the model in a single transform + predict_proba call
+DEFAULT_BATCH_SIZE = 256
+# Emails checked per scan of a folder
+DEFAULT_SCAN_LIMIT = 100
+DEFAULT_MODEL_PATH = Path("../models/spam_classifier.joblib")
+DEFAULT_CREDENTIALS_PATH = Path("../data/email_data.json")
+DEFAULT_KEEP_DATA_PATH = Path("../data/keep_data.csv")
+
+# Exit codes of the command line interface
+EXIT_OK = 0
+EXIT_ERROR = 1  # Unexpected failure
+EXIT_USAGE = 2  # Invalid arguments (argparse uses 2 as well)
+EXIT_CONFIG = 3  # Missing credentials, unknown account or unsupported mail server
+EXIT_SCAN_FAILED = 4  # At least one account could not be scanned
+
+# IMAP servers of the common email providers, by the domain of the email address
+MAIL_SERVERS = {
+    "gmail.com": "imap.gmail.com",
+    "outlook.com": "outlook.office365.com",
+    "yahoo.com": "imap.mail.yahoo.com",
+    "aol.com": "imap.aol.com",
+    "icloud.com": "imap.mail.me.com",
+    "zoho.com": "imap.zoho.com",
+    "protonmail.com": "imap.protonmail.ch",
+    "mail.com": "imap.mail.com",
+    "yandex.com": "imap.yandex.com",
+    "gmx.com": "imap.gmx.com",
+    "hotmail.com": "imap-mail.outlook.com",
+    "live.com": "imap-mail.outlook.com",
+    "msn.com": "imap-mail.outlook.com",
+    "me.com": "imap.mail.me.com",
+    "att.net": "imap.mail.att.net",
+    "verizon.net": "incoming.verizon.net",
+    "cox.net": "imap.cox.net",
+    "charter.net": "mobile.charter.net",
+    "earthlink.net": "imap.earthlink.net",
+    "rr.com": "mail.twc.com",
+    # Add more mail server mappings as needed
+}
+
+
+def load_model(model_path: str, log_func: Callable[[str], None], compact: bool = True):
     """
     Attempts to load a pre-trained model from the specified path. If the model does not exist,
     it trains a new model and saves it to the same path.
+    Models are cached per process and only reloaded when the file changes. A compact, memory-mapped export of the
+    model (see model_store) is used when it is up to date, and written after loading the joblib file otherwise.
+    With `compact` False, the scikit-learn pipeline itself is loaded, e.g. to seed an online model from it.
     """
-    if Path(model_path).is_file():
-        log_func(f"Loading model from {model_path}")
-        return joblib.load(model_path)
-    else:
+    if not Path(model_path).is_file():
+        from ml_model import create_model  # Imported here since training needs all of scikit-learn
+
         log_func(f"Model file not found at {model_path}. Training a new model.")
-        create_model()  # Ensure this function trains the model and saves it to `model_path`
+        create_model(model_path)
         log_func(f"New model trained and saved to {model_path}")
+
+    if not compact:
+        import joblib
+
+        log_func(f"Loading model from {model_path}")
         return joblib.load(model_path)
 
+    stamp = file_stamp(model_path)
+    key = str(Path(model_path).resolve())
+    with _model_cache_lock:
+        cached = _model_cache.get(key)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+
+        compact_path = compact_path_for(model_path)
+        model = None
+        if (compact_path / 'meta.json').is_file():
+            try:
+                model = load_compact_model(compact_path)
+            except (OSError, ValueError) as e:
+                log_func(f"Could not load compact model from {compact_path}: {e}")
+            if model is not None and model.source_stamp != stamp:
+                model = None  # Exported from an older version of the model file
+        if model is not None:
+            log_func(f"Loading model from {compact_path}")
+        else:
+            import joblib  # Imported here since unpickling the pipeline needs scikit-learn anyway
+
+            log_func(f"Loading model from {model_path}")
+            model = joblib.load(model_path)
+            try:
+                # Models of other kinds (e.g. hashed online models) are served as loaded, without a log line
+                if is_exportable(model):
+                    export_compact_model(model, compact_path, stamp)
+            except (OSError, ValueError) as e:
+                log_func(f"Compact model not exported: {e}")
+        _model_cache[key] = (stamp, model)
+        # Cached verdicts of this model stay valid until the file changes
+        set_model_version(model, f"{key}@{stamp[0]}:{stamp[1]}")
+        return model
+
+
+def connect_model(model_path: str, log_func: Callable[[str], None], service_url: Optional[str] = None):
+    """
+    Returns the model to classify with. With a `service_url`, that is a client of a classification service
+    (see classify_service) shared by every scanner on this computer, which falls back to loading the model here
+    with load_model while the service is not running. Without one, the model is loaded here right away.
+    """
+    if not service_url:
+        return load_model(model_path, log_func)
+    return ServiceClient(service_url, lambda: load_model(model_path, log_func), log_func)
+
+
+def get_mail_server(username: str) -> Optional[str]:
+    """Returns the IMAP server for an email address, or None if its domain is unknown."""
+    return MAIL_SERVERS.get(username.split('@')[-1].lower())
+
 
 def print_separator(log_func: Callable[[str], None]):
     """Prints a separator for better command window visibility."""
@@ -42,7 +161,28 @@ def create_spam_folder(mail: imaplib.IMAP4_SSL, log_func: Callable[[str], None])
         log_func(f"Error creating Spam folder: {e}.")
 
 
-def is_spam(email_sender: str, email_subject: str, email_body: str, model, keep_df: pd.DataFrame) -> bool:
+def matches_keep_list(email_sender: str, email_subject: str, email_body: str,
+                      keep_rules: Union["pd.DataFrame", KeepListMatcher]) -> bool:
+    """
+    Checks whether an email matches any of the keep rules (keywords, senders or subjects).
+    Pass a compiled KeepListMatcher when checking many emails so the rules are only compiled once.
+    """
+    return compile_keep_list(keep_rules).matches(email_sender, email_subject, email_body)
+
+
+def build_model_input(email_sender: str, email_subject: str, email_body: str) -> str:
+    """
+    Builds the text the model is trained on: the sender's domain, the subject and the body.
+    """
+    # Preprocess the sender's email if necessary (e.g., extracting the domain)
+    sender_domain = email_sender.split('@')[-1]
+
+    # Combine sender, subject, and body as input to the model
+    return f"{sender_domain} {email_subject} {email_body}"
+
+
+def is_spam(email_sender: str, email_subject: str, email_body: str, model,
+            keep_df: Union["pd.DataFrame", KeepListMatcher], cache: Optional[VerdictCache] = None) -> bool:
     """
     Determines if an email is spam using a pre-trained machine learning model.
 
@@ -51,53 +191,186 @@ def is_spam(email_sender: str, email_subject: str, email_body: str, model, keep_
         email_subject (str): The subject of the email.
         email_body (str): The body content of the email.
         model: The pre-trained spam detection model.
-        keep_df: DataFrame housing any keyword arguments that force the model NOT to classify as spam
+        keep_df: DataFrame housing any keyword arguments that force the model NOT to classify as spam,
+            or the same rules already compiled with compile_keep_list
+        cache (Optional[VerdictCache]): Verdicts of emails already classified by this model.
 
     Returns:
         bool: True if the email is considered spam, False otherwise.
     """
-    # Check each row in the DataFrame for keywords
-    for _, row in keep_df.iterrows():
-        # Check for matches in the sender, subject, or body
-        if (pd.notna(row['Keywords']) and (row['Keywords'].lower() in email_sender.lower() or
-                                           row['Keywords'].lower() in email_subject.lower() or
-                                           row['Keywords'].lower() in email_body.lower())) or \
-                (pd.notna(row['Sender']) and row['Sender'].lower() in email_sender.lower()) or \
-                (pd.notna(row['Subject']) and row['Subject'].lower() in email_subject.lower()):
-            return False  # Skip classification if a match is found
+    if cache is not None:
+        labels, _ = classify_batch([(email_sender, email_subject, email_body)], model, keep_df, cache=cache)
+        return labels[0]
 
-    # Preprocess the sender's email if necessary (e.g., extracting the domain)
-    sender_domain = email_sender.split('@')[-1]
-
-    # Combine sender, subject, and body as input to the model
-    email_content = f"{sender_domain} {email_subject} {email_body}"
+    METRICS.inc('emails_classified_total')
+    if matches_keep_list(email_sender, email_subject, email_body, keep_df):
+        METRICS.inc('keep_list_hits_total')
+        return False  # Skip classification if a match is found
 
     # Predict using the model
-    prediction = model.predict([email_content])
+    with METRICS.time('model_inference_seconds'):
+        prediction = model.predict([build_model_input(email_sender, email_subject, email_body)])
+    METRICS.observe('model_batch_size', 1, SIZE_BUCKETS)
 
     # Assuming the model is trained such that '1' indicates spam
-    return prediction[0] == 1
+    spam = prediction[0] == 1
+    METRICS.inc('spam_detected_total', int(spam))
+    return spam
 
 
-def move_email_to_spam(mail: imaplib.IMAP4_SSL, email_id: str, log_func: Callable[[str], None]) -> None:
+def chunked(items: Iterable, size: int) -> Iterator[list]:
+    """Yields successive lists of at most `size` items."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def classify_batch(messages: Sequence[Tuple[str, str, str]], model, keep_df: Union["pd.DataFrame", KeepListMatcher],
+                   batch_size: int = DEFAULT_BATCH_SIZE, cache: Optional[VerdictCache] = None,
+                   campaigns: Optional[CampaignIndex] = None) -> Tuple[List[bool], List[float]]:
     """
-    Moves an email to the 'Spam' folder. Uses the copy and delete approach if the MOVE command is not supported.
+    Classifies many emails at once, running one vectorizer transform and one predict_proba per chunk.
+    With a `cache`, emails whose model input was already classified by the same model version reuse that
+    verdict. With `campaigns`, near-identical emails are grouped and only the first email of each campaign
+    reaches the model; the others get its verdict.
+
+    Args:
+        messages (Sequence[Tuple[str, str, str]]): (sender, subject, body) for each email.
+        model: The pre-trained spam detection model.
+        keep_df: DataFrame housing any keyword arguments that force the model NOT to classify as spam,
+            or the same rules already compiled with compile_keep_list
+        batch_size (int): Maximum number of emails handed to the model per call.
+        cache (Optional[VerdictCache]): Verdicts of emails already classified. Only used for models loaded with
+            load_model or learned by an OnlineLearner, whose version is known.
+        campaigns (Optional[CampaignIndex]): Campaigns seen so far, e.g. earlier in the same scan.
+
+    Returns:
+        Tuple[List[bool], List[float]]: The spam label and the spam probability for each email, in input order.
+            Emails matching the keep list are labelled not spam with a score of 0.0.
     """
-    try:
-        spam_folder_name = 'Spam'
-        # Attempt to use the MOVE command if available
+    labels = [False] * len(messages)
+    scores = [0.0] * len(messages)
+
+    # Emails matching the keep list never reach the model
+    keep_matcher = compile_keep_list(keep_df)
+    with METRICS.time('keep_list_seconds'):
+        pending = [index for index, (sender, subject, body) in enumerate(messages)
+                   if not keep_matcher.matches(sender, subject, body)]
+    METRICS.inc('emails_classified_total', len(messages))
+    METRICS.inc('keep_list_hits_total', len(messages) - len(pending))
+
+    texts = {index: build_model_input(*messages[index]) for index in pending}
+    version = model_version(model) if cache is not None else None
+    if version is not None and pending:
+        digests = {index: input_digest(texts[index]) for index in pending}
+        uncached = []
+        for index, verdict in zip(pending, cache.lookup([digests[index] for index in pending], version)):
+            if verdict is None:
+                uncached.append(index)
+            else:
+                labels[index], scores[index] = verdict
+        pending = uncached
+
+    # Campaign members wait for the verdict of their representative
+    members: Dict[int, List[int]] = {}
+    if campaigns is not None and pending:
+        campaign_version = model_version(model)
+        representatives = []
+        for index, campaign in zip(pending, campaigns.assign([texts[index] for index in pending])):
+            verdict = campaigns.verdict(campaign, campaign_version) if campaign is not None else None
+            if verdict is not None:
+                labels[index], scores[index] = verdict
+            elif campaign is not None and campaign in members:
+                members[campaign].append(index)
+            else:
+                representatives.append(index)
+                if campaign is not None:
+                    members[campaign] = [index]
+        METRICS.inc('campaign_verdicts_reused_total', len(pending) - len(representatives))
+        pending = representatives
+
+    classes = list(model.classes_)
+    # Assuming the model is trained such that '1' indicates spam
+    spam_column = classes.index(1) if 1 in classes else None
+
+    for chunk in chunked(pending, batch_size):
+        with METRICS.time('model_inference_seconds'):
+            probabilities = model.predict_proba([texts[index] for index in chunk])
+        METRICS.observe('model_batch_size', len(chunk), SIZE_BUCKETS)
+        for index, row in zip(chunk, probabilities):
+            # Same decision rule as model.predict: the most probable class wins
+            labels[index] = bool(classes[row.argmax()] == 1)
+            scores[index] = float(row[spam_column]) if spam_column is not None else 0.0
+        if version is not None:
+            cache.store([digests[index] for index in chunk], [(labels[index], scores[index]) for index in chunk],
+                        version)
+
+    for campaign, indices in members.items():
+        representative = indices[0]
+        campaigns.set_verdict(campaign, campaign_version, (labels[representative], scores[representative]))
+        for index in indices[1:]:
+            labels[index], scores[index] = labels[representative], scores[representative]
+
+    METRICS.inc('spam_detected_total', sum(labels))
+    return labels, scores
+
+
+def move_emails_to_spam(mail: imaplib.IMAP4, email_ids: Iterable, log_func: Callable[[str], None],
+                        spam_folder_name: str = 'Spam') -> List[Tuple[List[int], bool]]:
+    """
+    Moves many emails to the 'Spam' folder, compressing their UIDs into sets (e.g. 1:50,73,90:120) so each chunk
+    costs a single UID MOVE, or a single COPY + STORE + EXPUNGE on servers without MOVE.
+
+    Args:
+        mail (imaplib.IMAP4): A logged-in connection with the source folder selected.
+        email_ids (Iterable): UIDs of the emails to move.
+        log_func (Callable[[str], None]): Receives progress messages.
+        spam_folder_name (str): The destination folder.
+
+    Returns:
+        List[Tuple[List[int], bool]]: The UIDs of each chunk and whether that chunk was moved.
+    """
+    use_move = 'MOVE' in mail.capabilities
+    use_uid_expunge = 'UIDPLUS' in mail.capabilities
+    results = []
+    for uids, uid_set in uid_set_chunks(int(email_id) for email_id in email_ids):
         try:
-            mail.uid('MOVE', email_id, spam_folder_name)  # Using UID to ensure the correct email is targeted
-            log_func("Email successfully moved to Spam using MOVE.")
-        except AttributeError:
-            # Fallback to COPY then DELETE if MOVE is not available
-            mail.uid('COPY', email_id, spam_folder_name)
-            mail.uid('STORE', email_id, '+FLAGS', '(\\Deleted)')
-            mail.expunge()
-            log_func("Email successfully moved to Spam using COPY and DELETE.")
-    except imaplib.IMAP4.error as e:
-        log_func(f"Error moving email to Spam: {e}.")
+            if use_move:
+                typ, data = uid_command(mail, 'MOVE', uid_set, spam_folder_name)
+            else:
+                # Fallback to COPY then DELETE if MOVE is not available
+                typ, data = uid_command(mail, 'COPY', uid_set, spam_folder_name)
+                if typ == 'OK':
+                    typ, data = uid_command(mail, 'STORE', uid_set, '+FLAGS.SILENT', '(\\Deleted)')
+                if typ == 'OK':
+                    # UID EXPUNGE only removes these emails, not others already flagged as deleted
+                    typ, data = uid_command(mail, 'EXPUNGE', uid_set) if use_uid_expunge else mail.expunge()
+            moved = typ == 'OK'
+            METRICS.inc('emails_moved_total' if moved else 'move_failures_total', len(uids))
+            if moved:
+                method = 'MOVE' if use_move else 'COPY and DELETE'
+                log_func(f"{len(uids)} email(s) successfully moved to Spam using {method}.")
+            else:
+                log_func(f"Error moving {len(uids)} email(s) to Spam: {data}.")
+        except imaplib.IMAP4.error as e:
+            log_func(f"Error moving {len(uids)} email(s) to Spam: {e}.")
+            METRICS.inc('move_failures_total', len(uids))
+            moved = False
+        results.append((uids, moved))
     print_separator(log_func)
+    return results
+
+
+def move_email_to_spam(mail: imaplib.IMAP4_SSL, email_id: str, log_func: Callable[[str], None]) -> None:
+    """
+    Moves an email to the 'Spam' folder. Uses the copy and delete approach if the MOVE command is not supported.
+    """
+    move_emails_to_spam(mail, [email_id], log_func)
 
 
 def load_json_file(file_path: Path, log_func: Callable[[str], None]) -> Optional[Dict]:
@@ -116,66 +389,467 @@ def load_json_file(file_path: Path, log_func: Callable[[str], None]) -> Optional
         return None
 
 
-def get_and_filter_emails(mail: imaplib.IMAP4_SSL, usr: str, pw: str, keep_df: pd.DataFrame, model,
+def scan_uids(mail: imaplib.IMAP4, uids: Sequence[int], model, keep_matcher: KeepListMatcher,
+              log_func: Callable[[str], None], add_to_list_func: Callable[[str, str, str, str], None],
+              batch_size: int = DEFAULT_BATCH_SIZE, max_body_bytes: Optional[int] = DEFAULT_MAX_BODY_BYTES,
+              parse_pool: Optional[Executor] = None, cache: Optional[VerdictCache] = None,
+              campaigns: Optional[CampaignIndex] = None) -> Iterator[List[Tuple[int, bool, float]]]:
+    """
+    Fetches and classifies emails of the selected folder chunk by chunk, reporting spam as soon as a chunk is done.
+    Yields the (uid, is_spam, score) verdicts of each chunk.
+    With a `parse_pool` (e.g. a ProcessPoolExecutor), each chunk is decoded on the pool while the next one is
+    being fetched. With a `cache`, emails already classified by the same model skip the model, and with
+    `campaigns`, so do later copies of a campaign.
+    """
+    if parse_pool is None:
+        for chunk in chunked(uids, batch_size):
+            yield _classify_fetched(fetch_emails(mail, chunk, max_body_bytes), model, keep_matcher, log_func,
+                                    add_to_list_func, batch_size, cache, campaigns)
+        return
+
+    pending = None
+    for chunk in chunked(uids, batch_size):
+        decoding = parse_pool.submit(decode_emails, fetch_raw(mail, chunk, max_body_bytes), max_body_bytes)
+        if pending is not None:
+            yield _classify_fetched(pending.result(), model, keep_matcher, log_func, add_to_list_func, batch_size,
+                                    cache, campaigns)
+        pending = decoding
+    if pending is not None:
+        yield _classify_fetched(pending.result(), model, keep_matcher, log_func, add_to_list_func, batch_size, cache,
+                                campaigns)
+
+
+class HeaderCascade:
+    """
+    Header-first classification for scans. A cheap header model (see header_model) classifies every email from a
+    header-only fetch; only emails whose spam probability falls inside `band` are escalated, which means their
+    text part is downloaded and the body model decides. Emails the header model calls spam have their text
+    downloaded as well while there are Keywords keep rules, so those rules still apply to them.
+    Used by filter_folder: `fetch` runs on the fetching connections and `take_verdicts` when classifying.
+
+    Args:
+        header_model: A model trained on build_header_input texts, e.g. loaded with load_model.
+        keep_matcher (KeepListMatcher): The keep rules of the scan.
+        band (Tuple[float, float]): Spam probabilities the header model is not trusted with.
+        max_body_bytes (Optional[int]): Bytes of each escalated email's text part downloaded.
+    """
+
+    def __init__(self, header_model, keep_matcher: KeepListMatcher,
+                 band: Tuple[float, float] = DEFAULT_UNCERTAINTY_BAND,
+                 max_body_bytes: Optional[int] = DEFAULT_MAX_BODY_BYTES):
+        self.header_model = header_model
+        self.keep_matcher = keep_matcher
+        self.band = band
+        self.max_body_bytes = max_body_bytes
+        self.decided = 0
+        self.escalated = 0
+        self._verdicts: Dict[int, Tuple[bool, float]] = {}
+        self._lock = threading.Lock()
+
+    def fetch(self, mail: imaplib.IMAP4, uids: Sequence[int]) -> List[RawEmail]:
+        """Fetches the headers of `uids`, classifies them, and fetches the text of the emails that need it."""
+        headers = fetch_headers(mail, uids, CASCADE_HEADER_FIELDS)
+        fetched_uids = [int(uid) for uid in uids if int(uid) in headers]
+        body_uids = []
+        decided = {}
+        if fetched_uids:
+            with METRICS.time('model_inference_seconds', model='header'):
+                probabilities = self.header_model.predict_proba(
+                    [build_header_input(parse_headers(header_bytes(headers[uid]))) for uid in fetched_uids])
+            classes = list(self.header_model.classes_)
+            spam_column = classes.index(1) if 1 in classes else None
+            for uid, row in zip(fetched_uids, probabilities):
+                score = float(row[spam_column]) if spam_column is not None else 0.0
+                if is_uncertain(score, self.band):
+                    body_uids.append(uid)
+                    continue
+                spam = bool(classes[row.argmax()] == 1)
+                decided[uid] = (spam, score)
+                if spam and self.keep_matcher.keywords:
+                    body_uids.append(uid)
+        with self._lock:
+            self._verdicts.update(decided)
+            self.decided += len(decided)
+            self.escalated += len(fetched_uids) - len(decided)
+        METRICS.inc('cascade_emails_total', len(decided), tier='header')
+        METRICS.inc('cascade_emails_total', len(fetched_uids) - len(decided), tier='body')
+        return fetch_raw(mail, uids, self.max_body_bytes, headers, body_uids)
+
+    def take_verdicts(self, uids: Iterable[int]) -> Dict[int, Tuple[bool, float]]:
+        """Returns and forgets the (is_spam, score) the header model decided for any of `uids`."""
+        with self._lock:
+            return {uid: self._verdicts.pop(uid) for uid in uids if uid in self._verdicts}
+
+    def stats(self) -> Dict[str, object]:
+        """Emails decided from their headers, emails escalated to the body model, and the escalation rate."""
+        with self._lock:
+            total = self.decided + self.escalated
+            return {'decided_by_headers': self.decided, 'escalated': self.escalated,
+                    'escalation_rate': round(self.escalated / total, 4) if total else None}
+
+
+def _classify_fetched(fetched: List[FetchedEmail], model, keep_matcher: KeepListMatcher,
+                      log_func: Callable[[str], None], add_to_list_func: Callable[[str, str, str, str], None],
+                      batch_size: int, cache: Optional[VerdictCache] = None,
+                      campaigns: Optional[CampaignIndex] = None,
+                      cascade: Optional[HeaderCascade] = None) -> List[Tuple[int, bool, float]]:
+    decided = cascade.take_verdicts(message.uid for message in fetched) if cascade is not None else {}
+    escalated = [message for message in fetched if message.uid not in decided]
+    labels, scores = classify_batch([(message.sender, message.subject, message.body) for message in escalated],
+                                    model, keep_matcher, batch_size, cache, campaigns)
+    verdicts = {message.uid: (spam, score) for message, spam, score in zip(escalated, labels, scores)}
+    if decided:
+        kept = 0
+        for message in fetched:
+            if message.uid in decided:
+                # The body is empty unless keyword rules needed it, and then the keep rules see it here
+                if keep_matcher.matches(message.sender, message.subject, message.body):
+                    decided[message.uid] = (False, 0.0)
+                    kept += 1
+                verdicts[message.uid] = decided[message.uid]
+        METRICS.inc('emails_classified_total', len(decided))
+        METRICS.inc('keep_list_hits_total', kept)
+        METRICS.inc('spam_detected_total', sum(spam for spam, _ in decided.values()))
+
+    for message in fetched:
+        if verdicts[message.uid][0]:
+            log_func(f"***SPAM DETECTED***: From: {message.sender}, Subject: {message.subject[:30]}...")
+            add_to_list_func(str(message.uid), message.sender, message.subject, message.body)
+    return [(message.uid, *verdicts[message.uid]) for message in fetched]
+
+
+def search_kept_uids(mail: imaplib.IMAP4, keep_matcher: KeepListMatcher, min_uid: int = 1,
+                     max_uid: Optional[int] = None) -> Set[int]:
+    """
+    Asks the server which emails of the selected folder, from `min_uid` upwards and up to `max_uid` if given,
+    match a Sender or Subject keep rule, so they need not be downloaded at all. Keyword rules also look at the
+    body and are only matched locally, as are rules that cannot be sent in a SEARCH command (see
+    quote_search_string); emails matching those are still fetched and kept by classify_batch.
+    """
+    criteria = header_search_criteria('FROM', keep_matcher.sender_patterns) + \
+        header_search_criteria('SUBJECT', keep_matcher.subject_patterns)
+    if not criteria:
+        return set()
+    return search_any_uids(mail, criteria, min_uid, max_uid=max_uid)
+
+
+def filter_folder(mail: imaplib.IMAP4, usr: str, keep_df: Union["pd.DataFrame", KeepListMatcher], model,
+                  log_func: Callable[[str], None], add_to_list_func: Callable[[str, str, str, str], None],
+                  batch_size: int = DEFAULT_BATCH_SIZE, max_body_bytes: Optional[int] = DEFAULT_MAX_BODY_BYTES,
+                  state_store: Optional[ScanStateStore] = None, folder: str = 'inbox',
+                  parse_pool: Optional[Executor] = None, cache: Optional[VerdictCache] = None,
+                  group_campaigns: bool = False, limit: Optional[int] = DEFAULT_SCAN_LIMIT,
+                  prefilter_keep_list: bool = True, connections: Sequence[imaplib.IMAP4] = (),
+                  parse_workers: int = DEFAULT_PARSE_WORKERS, classify_workers: int = DEFAULT_CLASSIFY_WORKERS,
+                  cancel: Optional[threading.Event] = None, header_model=None,
+                  uncertainty_band: Tuple[float, float] = DEFAULT_UNCERTAINTY_BAND, since: Optional[date] = None,
+                  newest_first: bool = True) -> int:
+    """
+    Selects a folder on an already logged-in connection and reports the spam emails in it, checking at most
+    `limit` emails (None for all of them), newest first unless `newest_first` is False or a `state_store` is
+    given, and with `since` only those received on or after that day.
+    Returns the number of spam emails found.
+    The folder is searched a UID range at a time while earlier emails are being checked (see iter_uids), so
+    neither the list of UIDs nor the emails are ever held for the whole folder.
+    Emails are fetched, decoded and classified at the same time by a ScanPipeline with `parse_workers` and
+    `classify_workers` threads. Further logged-in `connections` to the same account each fetch a share of the
+    chunks. Setting `cancel` stops the scan after the chunks in progress.
+    With a `state_store`, emails are checked oldest first from the folder's checkpoint, which moves with every
+    chunk. A `limit` then pages through a backlog over several scans instead of skipping the emails beyond it.
+    The first scan of a folder, without a checkpoint, starts at the newest `limit` emails, and older ones are
+    left unchecked.
+    With a `header_model`, emails are first classified from their headers alone, and only those whose spam
+    probability falls inside `uncertainty_band` have their body downloaded (see HeaderCascade).
+    With `group_campaigns`, near-identical emails found during the scan are grouped (see CampaignIndex), and the
+    model only classifies the first email of each group. With `prefilter_keep_list`, emails matching a Sender or
+    Subject keep rule are found with a server-side SEARCH over the UIDs of each chunk and never downloaded (see
+    search_kept_uids).
+    """
+    mail.select(folder)
+
+    uidvalidity = get_uidvalidity(mail, folder) if state_store is not None else None
+    last_uid = 0
+    if uidvalidity is not None:
+        last_uid = state_store.get_checkpoint(usr, folder, uidvalidity)
+        if last_uid:
+            log_func(f"Resuming from UID {last_uid}; only newer emails will be checked.")
+    elif state_store is not None:
+        log_func("Server did not report UIDVALIDITY. Scanning the whole folder.")
+    if uidvalidity is not None:
+        if not last_uid and limit is not None:
+            newest = list(islice(iter_uids(mail, 1, since), limit))
+            if newest:
+                last_uid = min(newest) - 1
+                log_func(f"First scan of {folder}; checking the newest {len(newest)} emails.")
+        # The checkpoint is only moved past emails below which everything was checked
+        newest_first = False
+
+    create_spam_folder(mail, log_func)
+
+    # Compile the keep rules once for the whole run
+    keep_matcher = compile_keep_list(keep_df)
+
+    kept: Set[int] = set()
+    prefilter_failed = threading.Event()
+
+    campaigns = CampaignIndex() if group_campaigns else None
+    cascade = HeaderCascade(header_model, keep_matcher, uncertainty_band, max_body_bytes) \
+        if header_model is not None else None
+    fetch = cascade.fetch if cascade is not None else partial(fetch_raw, max_body_bytes=max_body_bytes)
+
+    def fetch_unkept(connection: imaplib.IMAP4, uids: Sequence[int]):
+        # Kept emails are searched for chunk by chunk, so a limited scan never searches the rest of the folder
+        if prefilter_keep_list and uids and not prefilter_failed.is_set():
+            try:
+                kept.update(search_kept_uids(connection, keep_matcher, min(uids), max(uids)))
+            except imaplib.IMAP4.error as e:
+                prefilter_failed.set()
+                log_func(f"Server could not search for kept emails ({e}). Checking them locally.")
+        return fetch(connection, [uid for uid in uids if uid not in kept])
+
+    shards = [mail, *connections]
+    for connection in connections:
+        connection.select(folder)
+    pipeline = ScanPipeline(lambda fetched: _classify_fetched(fetched, model, keep_matcher, log_func, add_to_list_func,
+                                                              batch_size, cache, campaigns, cascade),
+                            batch_size, max_body_bytes, fetch_unkept, parse_workers, classify_workers,
+                            parse_pool=parse_pool, cancel=cancel)
+    # The UIDs are only searched on `mail`, by the pipeline's first fetcher, as it needs more of them
+    email_uids = islice(iter_uids(mail, last_uid + 1, since, newest_first), limit)
+    spam_count = 0
+    checked = 0
+    kept_count = 0
+    for chunk, verdicts in pipeline.run(shards, email_uids):
+        # Kept emails were left out of the download and are labelled as classify_batch labels them
+        skipped = [(uid, False, 0.0) for uid in chunk if uid in kept]
+        checked += len(chunk)
+        kept_count += len(skipped)
+        spam_count += sum(spam for _, spam, _ in verdicts)
+        if uidvalidity is not None:
+            state_store.record_verdicts(usr, folder, uidvalidity, verdicts + skipped)
+    if kept_count:
+        log_func(f"{kept_count} emails matched a keep rule and were not downloaded.")
+        METRICS.inc('emails_classified_total', kept_count)
+        METRICS.inc('keep_list_hits_total', kept_count)
+        METRICS.inc('keep_list_prefiltered_total', kept_count)
+    if cascade is not None:
+        stats = cascade.stats()
+        if stats['escalation_rate'] is not None:
+            log_func(f"{stats['decided_by_headers']} emails decided from their headers; "
+                     f"{stats['escalation_rate']:.0%} needed their body.")
+    log_func(f"{checked} emails checked.")
+    if cancel is not None and cancel.is_set():
+        log_func("Scan stopped.")
+    return spam_count
+
+
+def open_connections(connect: Callable[[], imaplib.IMAP4], usr: str, pw: str, count: int,
+                     log_func: Callable[[str], None]) -> List[imaplib.IMAP4]:
+    """
+    Opens up to `count` further logged-in connections to an account, for filter_folder to split a scan among.
+    Connections the server refuses are left out.
+    """
+    opened = []
+    for _ in range(max(0, count)):
+        try:
+            connection = connect()
+            connection.login(usr, pw)
+        except (OSError, imaplib.IMAP4.error) as e:
+            log_func(f"Could not open another connection ({e}). Scanning with {len(opened) + 1}.")
+            break
+        opened.append(connection)
+    return opened
+
+
+def close_connections(connections: Iterable[imaplib.IMAP4]) -> None:
+    for connection in connections:
+        try:
+            connection.logout()
+        except (OSError, imaplib.IMAP4.error):
+            pass
+
+
+def get_and_filter_emails(mail: imaplib.IMAP4_SSL, usr: str, pw: str,
+                          keep_df: Union["pd.DataFrame", KeepListMatcher], model,
                           log_func: Callable[[str], None],
-                          add_to_list_func: Callable[[str, str, str, str], None]) -> None:
+                          add_to_list_func: Callable[[str, str, str, str], None],
+                          batch_size: int = DEFAULT_BATCH_SIZE,
+                          max_body_bytes: Optional[int] = DEFAULT_MAX_BODY_BYTES,
+                          state_store: Optional[ScanStateStore] = None, folder: str = 'inbox',
+                          cache: Optional[VerdictCache] = None, group_campaigns: bool = False,
+                          connect: Optional[Callable[[], imaplib.IMAP4]] = None, connections: int = 1,
+                          cancel: Optional[threading.Event] = None,
+                          limit: Optional[int] = DEFAULT_SCAN_LIMIT) -> None:
     """
     Connects to an email account, identifies spam emails, and moves them to a 'Spam' folder.
+    The newest `limit` emails are checked (None for all of them).
+    Emails are fetched and classified in chunks of `batch_size` UIDs; only the headers and the first text part
+    of each email are downloaded, capped to `max_body_bytes` (None for no cap).
+    With a `state_store`, only emails newer than the last scan of this account and folder are fetched, oldest
+    first, and every verdict is recorded so the next scan can continue from there. With a `cache`, emails whose
+    content was already classified by the same model reuse that verdict, and with `group_campaigns`,
+    near-identical emails of a campaign share the verdict of the campaign's first email.
+    With `connect` and more than one connection, that many connections are opened and the emails are split
+    among them. Setting `cancel` stops the scan.
     """
     print_separator(log_func)
     log_func("Connecting to email server...")
     mail.login(usr, pw)
-    mail.select('inbox')
     log_func("Connection successful. Fetching emails...")
 
-    result, data = mail.search(None, "All")
-    email_ids = data[0].split()[:100]
+    extra = open_connections(connect, usr, pw, connections - 1, log_func) if connect is not None else []
+    try:
+        filter_folder(mail, usr, keep_df, model, log_func, add_to_list_func, batch_size, max_body_bytes,
+                      state_store, folder, cache=cache, group_campaigns=group_campaigns, limit=limit,
+                      connections=extra, cancel=cancel)
+    finally:
+        close_connections(extra)
+
+    print_separator(log_func)
+    log_func("Email filtering complete.")
 
-    create_spam_folder(mail, log_func)
 
-    for email_id in email_ids:
-        result, data = mail.fetch(email_id, '(RFC822)')
-        raw_email = data[0][1]
-        msg = email.message_from_bytes(raw_email)
-
-        subject = msg['subject']
-        from_ = msg['from']
-        body = ""
-        if msg.is_multipart():
-            for part in msg.walk():
-                if part.get_content_type() == "text/plain":
-                    body = part.get_payload(decode=True).decode()
-                    break
+def _scan_account(name: str, credentials: Dict[str, str], args: argparse.Namespace, model,
+                  keep_matcher: KeepListMatcher, cache: Optional[VerdictCache], emit: Callable[[dict], None],
+                  log_func: Callable[[str], None], header_model=None) -> bool:
+    """Scans one account for the command line interface. Returns whether the scan succeeded."""
+    usr, pw = credentials.get("user"), credentials.get("pass")
+    server = get_mail_server(usr or "")
+    if not (usr and pw and server):
+        emit({'type': 'error', 'account': name, 'error': "credentials missing or mail server not supported"})
+        return False
+
+    spam = []
+
+    def report(uid: str, sender: str, subject: str, body: str) -> None:
+        spam.append(int(uid))
+        emit({'type': 'spam', 'account': name, 'folder': args.folder, 'uid': int(uid), 'from': sender,
+              'subject': subject})
+
+    start = time.monotonic()
+    moved = 0
+    state_store = ScanStateStore(args.state) if args.state else None
+    try:
+        mail = imaplib.IMAP4_SSL(server)
+        extra = []
+        try:
+            mail.login(usr, pw)
+            extra = open_connections(lambda: imaplib.IMAP4_SSL(server), usr, pw, args.connections - 1, log_func)
+            filter_folder(mail, usr, keep_matcher, model, log_func, report, args.batch_size, args.max_body_bytes,
+                          state_store, args.folder, cache=cache, limit=args.limit,
+                          prefilter_keep_list=not args.no_prefilter, connections=extra,
+                          parse_workers=args.parse_workers, header_model=header_model,
+                          uncertainty_band=args.uncertainty_band, since=args.since,
+                          newest_first=not args.oldest_first)
+            if args.move and spam:
+                moved = sum(len(uids) for uids, ok in move_emails_to_spam(mail, sorted(spam), log_func) if ok)
+        finally:
+            close_connections([mail, *extra])
+    except (OSError, imaplib.IMAP4.error) as e:
+        emit({'type': 'error', 'account': name, 'error': str(e)})
+        return False
+    finally:
+        if state_store is not None:
+            state_store.close()
+    emit({'type': 'summary', 'account': name, 'folder': args.folder, 'spam': len(spam), 'moved': moved,
+          'seconds': round(time.monotonic() - start, 3)})
+    return True
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    """
+    Headless entry point: scans saved accounts without the GUI and without importing it. Results are printed
+    one JSON object per line with --json. Returns an exit code (EXIT_*) for cron and systemd.
+    """
+    parser = argparse.ArgumentParser(description="Detect spam without the GUI.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    scan = commands.add_parser('scan', help="Scan saved accounts and report the spam found")
+    scan.add_argument('--account', action='append',
+                      help="Name of the saved credentials in email_data.json; repeat for several (default: the first)")
+    scan.add_argument('--all', action='store_true', help="Scan every saved account")
+    scan.add_argument('--folder', default='inbox')
+    scan.add_argument('--limit', type=int, default=DEFAULT_SCAN_LIMIT,
+                      help=f"Emails checked per account, newest first or from the --state checkpoint "
+                           f"(default: {DEFAULT_SCAN_LIMIT}, 0 for all)")
+    scan.add_argument('--since', type=date.fromisoformat, default=None,
+                      help="Only check emails received on or after this day, e.g. 2024-03-07")
+    scan.add_argument('--oldest-first', action='store_true',
+                      help="Check the oldest emails first (always the case with --state)")
+    scan.add_argument('--json', action='store_true', help="Print results as JSON Lines")
+    scan.add_argument('--move', action='store_true', help="Move the spam found to the Spam folder")
+    scan.add_argument('--credentials', type=Path, default=DEFAULT_CREDENTIALS_PATH)
+    scan.add_argument('--model', type=Path, default=DEFAULT_MODEL_PATH)
+    scan.add_argument('--keep-data', type=Path, default=DEFAULT_KEEP_DATA_PATH)
+    scan.add_argument('--state', type=Path, default=None,
+                      help="ScanStateStore database; each run continues, oldest first, where the last stopped")
+    scan.add_argument('--cache', type=Path, default=DEFAULT_CACHE_PATH, help="Database of cached verdicts")
+    scan.add_argument('--no-cache', action='store_true', help="Classify every email, even ones seen before")
+    scan.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+    scan.add_argument('--max-body-bytes', type=int, default=DEFAULT_MAX_BODY_BYTES)
+    scan.add_argument('--connections', type=int, default=1,
+                      help="IMAP connections per account; the emails of a large folder are split among them")
+    scan.add_argument('--parse-workers', type=int, default=DEFAULT_PARSE_WORKERS,
+                      help="Threads decoding fetched emails while others are fetched and classified")
+    scan.add_argument('--header-model', type=Path, default=None,
+                      help="Header model (ml_model.py --header-model); emails are first classified from their "
+                           "headers and only uncertain ones have their body downloaded")
+    scan.add_argument('--uncertainty-band', default=f"{DEFAULT_UNCERTAINTY_BAND[0]},{DEFAULT_UNCERTAINTY_BAND[1]}",
+                      help="Header model spam probabilities LOW,HIGH between which the body decides")
+    scan.add_argument('--no-prefilter', action='store_true',
+                      help="Download emails matching a Sender or Subject keep rule instead of leaving them out "
+                           "with a server-side search")
+    scan.add_argument('--service', default=None,
+                      help="URL of a running classify_service.py to share its model, e.g. http://127.0.0.1:8765")
+    scan.add_argument('--quiet', action='store_true', help="Do not print progress messages to stderr")
+    args = parser.parse_args(argv)
+    args.limit = args.limit or None
+    try:
+        low, high = (float(bound) for bound in args.uncertainty_band.split(','))
+    except ValueError:
+        parser.error("--uncertainty-band takes two probabilities, e.g. 0.1,0.9")
+    args.uncertainty_band = (low, high)
+
+    def log(message: str) -> None:
+        if not args.quiet:
+            print(message, file=sys.stderr, flush=True)
+
+    def emit(record: dict) -> None:
+        if args.json:
+            print(json.dumps(record, ensure_ascii=False), flush=True)
+        elif record['type'] == 'spam':
+            print(f"{record['account']}: spam UID {record['uid']}: {record['from']}: {record['subject']}", flush=True)
+        elif record['type'] == 'summary':
+            print(f"{record['account']}: {record['spam']} spam, {record['moved']} moved, {record['seconds']}s",
+                  flush=True)
         else:
-            body = msg.get_payload(decode=True).decode()
+            print(f"{record['account']}: scan failed: {record['error']}", file=sys.stderr, flush=True)
 
-        if is_spam(from_, subject, body, model, keep_df):
-            log_func(f"***SPAM DETECTED***: From: {from_}, Subject: {subject[:30]}...")
-            add_to_list_func(email_id.decode(), from_, subject, body)
+    email_info = load_json_file(args.credentials, log)
+    if not email_info:
+        return EXIT_CONFIG
+    names = list(email_info) if args.all else args.account or [next(iter(email_info))]
+    unknown = [name for name in names if name not in email_info]
+    if unknown:
+        log(f"Unknown account(s): {', '.join(unknown)}")
+        return EXIT_CONFIG
 
-    print_separator(log_func)
-    log_func("Email filtering complete.")
+    model = connect_model(str(args.model), log, args.service)
+    keep_matcher = KeepListMatcher.from_csv(args.keep_data)
+    header_model = None
+    if args.header_model:
+        if not args.header_model.is_file():
+            log(f"Header model not found at {args.header_model}. Train it with ml_model.py --header-model.")
+            return EXIT_CONFIG
+        header_model = load_model(str(args.header_model), log)
+    cache = None if args.no_cache else VerdictCache(path=args.cache)
+    try:
+        results = [_scan_account(name, email_info[name], args, model, keep_matcher, cache, emit, log, header_model)
+                   for name in names]
+    finally:
+        if cache is not None:
+            cache.close()
+    return EXIT_OK if all(results) else EXIT_SCAN_FAILED
 
 
 if __name__ == "__main__":
-    print("------------------------------------------------")
-    print("Starting email filter process...")
-    model_path = '../models/spam_classifier.joblib'
-    model = load_model(model_path, None)  # This will now correctly reference the defined load_model function
-
-    email_info = load_json_file(Path("../data/email_data.json"), None)
-    if email_info:
-        user = email_info.get("gmail_personal", {}).get("user")
-        password = email_info.get("gmail_personal", {}).get("pass")
-        if user and password:
-            print("Email credentials loaded successfully.")
-            if model is not None:
-                get_and_filter_emails(user, password, model, None)  # Make sure to pass the model as an argument
-            else:
-                print("Failed to load or create the machine learning model.")
-        else:
-            print("Email credentials are missing in the loaded JSON.")
-    else:
-        print("Failed to load email credentials.")
-    print("Process completed.")
-    print("------------------------------------------------")
+    sys.exit(main())
@@ -0,0 +1,101 @@
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+
+class SpamEmail(NamedTuple):
+    """
+    An email reported as spam, as shown in the spam list. Only the opening of the body is kept (see
+    make_preview); the full body is in a BodyStore under the email's key.
+    """
+    email_id: str
+    sender: str
+    subject: str
+    preview: str
+    account: Optional[str] = None
+
+    @property
+    def key(self) -> Tuple[Optional[str], str]:
+        """Identifies the email across accounts: (account, uid)."""
+        return self.account, self.email_id
+
+
+class SpamListStore:
+    """
+    The rows of the spam list, in the order they were reported. Every row has an id that stays the same when
+    other rows are removed, so views can keep selections by id. A row holds one email, or every email of a
+    campaign (see CampaignIndex), shown by its first email.
+    """
+
+    def __init__(self):
+        self._rows: Dict[int, List[SpamEmail]] = {}
+        self._campaigns: Dict[int, Optional[int]] = {}  # Campaign of every row
+        self._campaign_rows: Dict[int, int] = {}  # Row of every campaign
+        self._next_id = 0
+        self._order: Optional[List[int]] = []  # Row ids by position; rebuilt lazily after removals
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, row_id: int) -> bool:
+        return row_id in self._rows
+
+    def add(self, email: SpamEmail, campaign: Optional[int] = None) -> int:
+        """Adds an email, to the row of its campaign if there is one already. Returns the row id."""
+        if campaign is not None and campaign in self._campaign_rows:
+            row_id = self._campaign_rows[campaign]
+            self._rows[row_id].append(email)
+            return row_id
+        row_id = self._next_id
+        self._next_id += 1
+        self._rows[row_id] = [email]
+        self._campaigns[row_id] = campaign
+        if campaign is not None:
+            self._campaign_rows[campaign] = row_id
+        if self._order is not None:
+            self._order.append(row_id)
+        return row_id
+
+    def row_id_at(self, position: int) -> int:
+        if self._order is None:
+            self._order = list(self._rows)
+        return self._order[position]
+
+    def row_ids(self) -> List[int]:
+        if self._order is None:
+            self._order = list(self._rows)
+        return list(self._order)
+
+    def members(self, row_id: int) -> List[SpamEmail]:
+        """Every email of a row; the first one is shown."""
+        return list(self._rows[row_id])
+
+    def text(self, row_id: int) -> str:
+        """The row as the list shows it."""
+        members = self._rows[row_id]
+        email = members[0]
+        text = f"[{email.account}] {email.sender}: {email.subject}" if email.account else \
+            f"{email.sender}: {email.subject}"
+        return f"{text}  (+{len(members) - 1} similar)" if len(members) > 1 else text
+
+    def emails(self) -> Iterator[SpamEmail]:
+        for members in self._rows.values():
+            yield from members
+
+    def remove_emails(self, keys: Iterable[Tuple[Optional[str], str]]) -> List[SpamEmail]:
+        """Removes emails by (account, uid), and rows left without emails. Returns the removed emails."""
+        keys: Set[Tuple[Optional[str], str]] = set(keys)
+        removed = []
+        for row_id in list(self._rows):
+            members = self._rows[row_id]
+            kept = [email for email in members if email.key not in keys]
+            if len(kept) == len(members):
+                continue
+            removed.extend(email for email in members if email.key in keys)
+            if kept:
+                self._rows[row_id] = kept
+            else:
+                del self._rows[row_id]
+                campaign = self._campaigns.pop(row_id)
+                if campaign is not None:
+                    del self._campaign_rows[campaign]
+                self._order = None
+        return removed
@@ -0,0 +1,110 @@
+import random
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from email.utils import format_datetime
+from pathlib import Path
+from typing import Iterator, Tuple, Union
+
+# Vocabulary of the two classes of the bundled demo model: talk.politics.misc (spam) and sci.space (ham)
+SPAM_WORDS = ("government president congress senate tax taxes vote election clinton law rights federal "
+              "administration policy political party gun health care budget state people".split())
+HAM_WORDS = ("space nasa orbit launch shuttle moon mission satellite rocket earth lunar spacecraft solar "
+             "station flight telescope mars planet engine fuel".split())
+# Words both classes use, so not every message is trivially separable
+COMMON_WORDS = ("the of and to in is that for it with as was on be this are by have from or at an but not "
+                "report meeting today please thanks update week".split())
+DOMAINS = ("example.com", "mail.example.org", "news.example.net", "shop.example.biz")
+CHARSETS = ("utf-8", "utf-8", "utf-8", "iso-8859-1", "windows-1252")
+NAMES = ("Alex", "Sam", "Jordan", "Taylor", "Morgan", "Casey", "Riley", "Jamie")
+# Share of campaign emails that start a new campaign instead of copying an earlier one
+NEW_CAMPAIGN_SHARE = 0.05
+
+
+def _text(rng: random.Random, words, length: int) -> str:
+    vocabulary = words + COMMON_WORDS
+    return ' '.join(rng.choice(vocabulary) for _ in range(length))
+
+
+def generate_message(rng: random.Random, index: int, spam: bool, multipart_ratio: float = 0.4,
+                     attachment_ratio: float = 0.1, html_ratio: float = 0.2, body_words: int = 120) -> bytes:
+    """Builds one synthetic email; the RNG decides its structure, charset and length."""
+    words = SPAM_WORDS if spam else HAM_WORDS
+    message = EmailMessage()
+    message['From'] = f"sender{rng.randrange(1000)}@{rng.choice(DOMAINS)}"
+    message['To'] = "user@example.com"
+    message['Subject'] = _text(rng, words, rng.randint(3, 8)).capitalize()
+    message['Date'] = format_datetime(datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=index))
+    message['Message-ID'] = f"<{index}.{rng.getrandbits(32):08x}@synthetic>"
+
+    charset = rng.choice(CHARSETS)
+    body = _text(rng, words, max(1, int(rng.expovariate(1 / body_words))))
+    if charset != 'utf-8':
+        body += " café naïve"  # Something the charset has to encode
+    html = f"<html><body><p>{body}</p><img src='cid:logo'></body></html>"
+    if rng.random() < multipart_ratio:
+        message.set_content(body, charset=charset)
+        message.add_alternative(html, subtype='html', charset=charset)
+    elif rng.random() < html_ratio:
+        message.set_content(html, subtype='html', charset=charset)
+    else:
+        message.set_content(body, charset=charset)
+    if rng.random() < attachment_ratio:
+        size = rng.choice((1_000, 10_000, 50_000))
+        message.add_attachment(rng.randbytes(size), maintype='application', subtype='octet-stream',
+                               filename=f"attachment{index}.bin")
+    return message.as_bytes()
+
+
+def generate_campaign_message(rng: random.Random, index: int, subject: str, body: str) -> bytes:
+    """
+    Builds one copy of a spam campaign: the same subject and text, personalized with a name, a tracking link
+    and an order number, like the copies a real campaign sends to each recipient.
+    """
+    message = EmailMessage()
+    message['From'] = f"offers{rng.randrange(1000)}@{rng.choice(DOMAINS)}"
+    message['To'] = "user@example.com"
+    message['Subject'] = f"{subject} #{rng.randrange(100000)}"
+    message['Date'] = format_datetime(datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=index))
+    message['Message-ID'] = f"<{index}.{rng.getrandbits(32):08x}@synthetic>"
+    message.set_content(f"Dear {rng.choice(NAMES)},\n\n{body}\n\nClaim it at https://track.example.biz/"
+                        f"{rng.getrandbits(64):016x} before order {rng.randrange(10 ** 6)} expires.\n")
+    return message.as_bytes()
+
+
+def generate_corpus(count: int, spam_ratio: float = 0.3, multipart_ratio: float = 0.4,
+                    attachment_ratio: float = 0.1, html_ratio: float = 0.2, campaign_ratio: float = 0.0,
+                    seed: int = 0) -> Iterator[Tuple[bytes, bool]]:
+    """
+    Yields `count` synthetic emails as (raw message, is spam). The same arguments always produce the same corpus.
+
+    Args:
+        count (int): Number of emails.
+        spam_ratio (float): Share of spam.
+        multipart_ratio (float): Share of multipart/alternative (text + HTML) emails.
+        attachment_ratio (float): Share of emails with a binary attachment of 1 KB to 50 KB.
+        html_ratio (float): Share of the remaining single-part emails that are HTML only.
+        campaign_ratio (float): Share of spam sent as personalized copies of a few campaigns.
+        seed (int): Random seed.
+    """
+    rng = random.Random(seed)
+    campaigns = []
+    for index in range(count):
+        spam = rng.random() < spam_ratio
+        if spam and campaign_ratio and rng.random() < campaign_ratio:
+            if not campaigns or rng.random() < NEW_CAMPAIGN_SHARE:
+                campaigns.append((_text(rng, SPAM_WORDS, rng.randint(3, 8)).capitalize(),
+                                  _text(rng, SPAM_WORDS, rng.randint(40, 200))))
+            yield generate_campaign_message(rng, index, *rng.choice(campaigns)), True
+            continue
+        yield generate_message(rng, index, spam, multipart_ratio, attachment_ratio, html_ratio), spam
+
+
+def write_mbox(path: Union[str, Path], count: int, **options) -> int:
+    """Writes a synthetic corpus as an mbox file. Returns the number of spam emails in it."""
+    spam_count = 0
+    with open(path, 'wb') as file:
+        for raw, spam in generate_corpus(count, **options):
+            spam_count += spam
+            file.write(b"From synthetic@example.com Mon Jan  1 00:00:00 2024\n")
+            file.write(raw.replace(b"\nFrom ", b"\n>From ").rstrip(b"\n") + b"\n\n")
+    return spam_count
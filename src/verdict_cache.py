@@ -0,0 +1,203 @@
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple, Union
+
+from metrics import METRICS
+
+DEFAULT_CACHE_PATH = Path("../data/verdict_cache.sqlite3")
+# Verdicts kept in memory; an entry costs roughly 150 bytes
+DEFAULT_MAX_ENTRIES = 100_000
+# Verdicts kept on disk; the oldest tenth is dropped whenever there are more
+DEFAULT_MAX_DISK_ENTRIES = 2_000_000
+
+Verdict = Tuple[bool, float]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS verdicts (
+    digest BLOB PRIMARY KEY,
+    model_version TEXT NOT NULL,
+    is_spam INTEGER NOT NULL,
+    score REAL NOT NULL
+);
+"""
+
+# Attribute holding a model's version. Kept on the model itself, so the version goes away with the model object
+_VERSION_ATTRIBUTE = 'verdict_cache_version'
+
+
+def set_model_version(model, version: str) -> None:
+    """
+    Records which version of a model an object holds, e.g. the path and file stamp it was loaded from. Verdicts
+    are only cached for models with a version, and only reused while the version stays the same.
+    """
+    setattr(model, _VERSION_ATTRIBUTE, version)
+
+
+def model_version(model) -> Optional[str]:
+    """Returns the version recorded for a model, or None if verdicts of this model must not be cached."""
+    return getattr(model, _VERSION_ATTRIBUTE, None)
+
+
+def input_digest(text: str) -> bytes:
+    """
+    Digest of a model input with runs of whitespace collapsed. The model's tokenizer ignores whitespace, so
+    messages differing only in line wrapping share one verdict.
+    """
+    normalized = ' '.join(text.split())
+    return hashlib.blake2b(normalized.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+class VerdictCache:
+    """
+    Remembers the model's verdict for every model input it has classified, so identical emails, such as the
+    copies of a spam campaign or emails seen again by a rescan, skip vectorizing and inference. Entries are
+    keyed by a digest of the input (see build_model_input) and belong to one model version: as soon as a model
+    with another version is used, everything cached for the old one is dropped.
+
+    Args:
+        max_entries (int): Verdicts kept in the in-memory LRU tier.
+        path (Optional[Path]): SQLite database for a second, persistent tier; None keeps the cache in memory.
+        max_disk_entries (int): Verdicts kept in the database.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, path: Optional[Union[str, Path]] = None,
+                 max_disk_entries: int = DEFAULT_MAX_DISK_ENTRIES):
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.version: Optional[str] = None
+        self.hits = {'memory': 0, 'disk': 0}
+        self.misses = 0
+        self._memory: "OrderedDict[bytes, Verdict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.path = Path(path) if path is not None else None
+        self.connection = None
+        self._disk_entries = 0
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            # Scans of several accounts share the cache from their own threads; _lock serializes access
+            self.connection = sqlite3.connect(str(self.path), check_same_thread=False)
+            self.connection.executescript(_SCHEMA)
+            self._disk_entries = self.connection.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+
+    def close(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def __enter__(self) -> "VerdictCache":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def lookup(self, digests: Sequence[bytes], version: str) -> List[Optional[Verdict]]:
+        """Returns the cached (is_spam, score) of each digest for this model version, or None where unknown."""
+        with self._lock:
+            self._use_version(version)
+            found: List[Optional[Verdict]] = []
+            missing = []
+            for index, digest in enumerate(digests):
+                verdict = self._memory.get(digest)
+                if verdict is not None:
+                    self._memory.move_to_end(digest)
+                else:
+                    missing.append(index)
+                found.append(verdict)
+            memory_hits = len(digests) - len(missing)
+
+            if missing and self.connection is not None:
+                rows = self._select([digests[index] for index in missing])
+                still_missing = []
+                for index in missing:
+                    verdict = rows.get(digests[index])
+                    if verdict is None:
+                        still_missing.append(index)
+                        continue
+                    found[index] = verdict
+                    self._remember(digests[index], verdict)
+                missing = still_missing
+            disk_hits = len(digests) - memory_hits - len(missing)
+            self.hits['memory'] += memory_hits
+            self.hits['disk'] += disk_hits
+            self.misses += len(missing)
+
+        METRICS.inc('verdict_cache_hits_total', memory_hits, tier='memory')
+        METRICS.inc('verdict_cache_hits_total', disk_hits, tier='disk')
+        METRICS.inc('verdict_cache_misses_total', len(missing))
+        return found
+
+    def store(self, digests: Sequence[bytes], verdicts: Sequence[Verdict], version: str) -> None:
+        """Caches the (is_spam, score) of freshly classified inputs."""
+        with self._lock:
+            self._use_version(version)
+            for digest, (spam, score) in zip(digests, verdicts):
+                self._remember(digest, (bool(spam), float(score)))
+            if self.connection is None or not digests:
+                return
+            with self.connection:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO verdicts (digest, model_version, is_spam, score) VALUES (?, ?, ?, ?)",
+                    [(digest, version, int(bool(spam)), float(score))
+                     for digest, (spam, score) in zip(digests, verdicts)])
+            self._disk_entries += len(digests)
+            if self._disk_entries > self.max_disk_entries:
+                self._prune()
+
+    def clear(self) -> None:
+        """Drops every cached verdict, in memory and on disk."""
+        with self._lock:
+            self._memory.clear()
+            if self.connection is not None:
+                with self.connection:
+                    self.connection.execute("DELETE FROM verdicts")
+                self._disk_entries = 0
+
+    def stats(self) -> Dict[str, object]:
+        """Hits per tier, misses, hit rate and the number of cached verdicts."""
+        with self._lock:
+            hits = sum(self.hits.values())
+            lookups = hits + self.misses
+            return {'model_version': self.version, 'memory_hits': self.hits['memory'],
+                    'disk_hits': self.hits['disk'], 'misses': self.misses,
+                    'hit_rate': round(hits / lookups, 4) if lookups else None,
+                    'memory_entries': len(self._memory), 'disk_entries': self._disk_entries}
+
+    def _use_version(self, version: str) -> None:
+        """Invalidates everything cached for another model version. Call with _lock held."""
+        if version == self.version:
+            return
+        self._memory.clear()
+        if self.connection is not None:
+            with self.connection:
+                self.connection.execute("DELETE FROM verdicts WHERE model_version != ?", (version,))
+            self._disk_entries = self.connection.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+        self.version = version
+
+    def _remember(self, digest: bytes, verdict: Verdict) -> None:
+        self._memory[digest] = verdict
+        self._memory.move_to_end(digest)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _select(self, digests: List[bytes]) -> Dict[bytes, Verdict]:
+        rows = {}
+        # SQLite limits the number of parameters of a statement
+        for start in range(0, len(digests), 500):
+            chunk = digests[start:start + 500]
+            query = ("SELECT digest, is_spam, score FROM verdicts WHERE model_version = ? AND digest IN ("
+                     + ','.join('?' * len(chunk)) + ")")
+            for digest, spam, score in self.connection.execute(query, (self.version, *chunk)):
+                rows[bytes(digest)] = (bool(spam), score)
+        return rows
+
+    def _prune(self) -> None:
+        """Deletes the oldest tenth of the database, by insertion order."""
+        with self.connection:
+            self.connection.execute(
+                "DELETE FROM verdicts WHERE rowid IN (SELECT rowid FROM verdicts ORDER BY rowid LIMIT ?)",
+                (max(1, self.max_disk_entries // 10) + self._disk_entries - self.max_disk_entries,))
+        self._disk_entries = self.connection.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
@@ -0,0 +1,280 @@
+import argparse
+import imaplib
+import re
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Optional, Union
+
+from campaigns import CampaignIndex
+from imap_fetch import get_uidvalidity, search_uids
+from keep_list import KeepListMatcher, compile_keep_list
+from message_parser import DEFAULT_MAX_BODY_BYTES
+from metrics import METRICS
+from scan_state import ScanStateStore
+from spam_detector import DEFAULT_BATCH_SIZE, connect_model, get_mail_server, load_json_file, print_separator, scan_uids
+from verdict_cache import DEFAULT_CACHE_PATH, VerdictCache
+
+if TYPE_CHECKING:  # Only the GUI passes DataFrames; the watcher itself does not need pandas
+    import pandas as pd
+
+# Servers drop IDLE connections after 30 minutes (RFC 2177), so IDLE is re-issued a little before that
+IDLE_TIMEOUT = 29 * 60
+# Seconds between NOOP checks on servers without IDLE
+POLL_INTERVAL = 30
+# Upper bound of the reconnect delay, which doubles after every failed attempt
+MAX_BACKOFF = 300
+
+_EXISTS = re.compile(rb'^\* \d+ EXISTS', re.IGNORECASE)
+
+
+class MailboxWatcher:
+    """
+    Keeps a logged-in connection to one folder open and classifies new emails as soon as the server announces
+    them, using IMAP IDLE when the server supports it and NOOP polling otherwise. Lost connections are
+    re-established with exponential backoff.
+
+    Args:
+        connect (Callable[[], imaplib.IMAP4]): Opens a new, not yet logged-in, connection to the server.
+        usr (str): The account's user name.
+        pw (str): The account's password.
+        model: The pre-trained spam detection model.
+        keep_df: DataFrame housing any keyword arguments that force the model NOT to classify as spam
+        log_func (Callable[[str], None]): Receives progress messages.
+        add_to_list_func (Callable[[str, str, str, str], None]): Receives (uid, sender, subject, body) of every spam.
+        folder (str): The folder to watch.
+        state_path (Optional[Path]): ScanStateStore database; when given, the watcher resumes from the folder's
+            checkpoint and records its verdicts. Without a checkpoint, only emails delivered after the watcher
+            started are classified.
+        cache (Optional[VerdictCache]): Verdicts of emails already classified by the same model.
+        group_campaigns (bool): Whether near-identical emails share the verdict of the first one the watcher saw,
+            instead of each being classified (see CampaignIndex).
+    """
+
+    def __init__(self, connect: Callable[[], imaplib.IMAP4], usr: str, pw: str, model,
+                 keep_df: Union["pd.DataFrame", KeepListMatcher], log_func: Callable[[str], None],
+                 add_to_list_func: Callable[[str, str, str, str], None], folder: str = 'inbox',
+                 state_path: Optional[Path] = None, idle_timeout: float = IDLE_TIMEOUT,
+                 poll_interval: float = POLL_INTERVAL, max_backoff: float = MAX_BACKOFF,
+                 batch_size: int = DEFAULT_BATCH_SIZE, max_body_bytes: Optional[int] = DEFAULT_MAX_BODY_BYTES,
+                 cache: Optional[VerdictCache] = None, group_campaigns: bool = False):
+        self.connect = connect
+        self.usr = usr
+        self.pw = pw
+        self.model = model
+        self.keep_matcher = compile_keep_list(keep_df)
+        self.log_func = log_func
+        self.add_to_list_func = add_to_list_func
+        self.folder = folder
+        self.state_path = state_path
+        self.idle_timeout = idle_timeout
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self.batch_size = batch_size
+        self.max_body_bytes = max_body_bytes
+        self.cache = cache
+        self.campaigns = CampaignIndex() if group_campaigns else None
+
+        self.mail: Optional[imaplib.IMAP4] = None
+        self.backoff = 1.0
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._idle_tag = 0
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self) -> threading.Thread:
+        """Runs the watcher on a background thread."""
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self.run, daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        """Asks the watcher to finish; it notices within about a second, even while idling."""
+        self._stop_event.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    def run(self) -> None:
+        """Watches the folder until stop() is called."""
+        state_store = ScanStateStore(self.state_path) if self.state_path else None
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    self._watch(state_store)
+                except (OSError, imaplib.IMAP4.error) as e:
+                    if self._stop_event.is_set():
+                        break
+                    self.log_func(f"Watcher connection lost: {e}. Reconnecting in {self.backoff:.0f}s...")
+                    self._stop_event.wait(self.backoff)
+                    self.backoff = min(self.backoff * 2, self.max_backoff)
+                finally:
+                    self._disconnect()
+        finally:
+            if state_store is not None:
+                state_store.close()
+        self.log_func("Watcher stopped.")
+
+    def _disconnect(self) -> None:
+        if self.mail is None:
+            return
+        try:
+            self.mail.logout()
+        except (OSError, imaplib.IMAP4.error):
+            pass
+        self.mail = None
+
+    def _watch(self, state_store: Optional[ScanStateStore]) -> None:
+        self.mail = mail = self.connect()
+        mail.login(self.usr, self.pw)
+        mail.select(self.folder)
+        self.backoff = 1.0
+
+        uidvalidity = get_uidvalidity(mail, self.folder)
+        last_uid = 0
+        if state_store is not None and uidvalidity is not None:
+            last_uid = state_store.get_checkpoint(self.usr, self.folder, uidvalidity)
+        # Without a checkpoint only emails delivered from now on are classified
+        last_uid = last_uid or self._newest_uid(mail)
+        mail.response('EXISTS')  # Discard the count reported by SELECT
+
+        use_idle = 'IDLE' in mail.capabilities
+        print_separator(self.log_func)
+        self.log_func(f"Watching {self.folder} for new emails ({'IDLE' if use_idle else 'polling'})...")
+
+        while not self._stop_event.is_set():
+            # Also catches up on anything delivered while disconnected
+            for verdicts in scan_uids(mail, search_uids(mail, last_uid + 1), self.model, self.keep_matcher,
+                                      self.log_func, self.add_to_list_func, self.batch_size, self.max_body_bytes,
+                                      cache=self.cache, campaigns=self.campaigns):
+                last_uid = max([last_uid] + [uid for uid, _, _ in verdicts])
+                if state_store is not None and uidvalidity is not None:
+                    state_store.record_verdicts(self.usr, self.folder, uidvalidity, verdicts)
+            while not self._stop_event.is_set():
+                if self._idle(mail) if use_idle else self._poll(mail):
+                    break
+
+    def _newest_uid(self, mail: imaplib.IMAP4) -> int:
+        typ, data = mail.response('UIDNEXT')
+        if data and data[-1]:
+            return int(data[-1]) - 1
+        uids = search_uids(mail)
+        return uids[-1] if uids else 0
+
+    def _poll(self, mail: imaplib.IMAP4) -> bool:
+        """Waits one poll interval, then returns True if the server reports a changed message count."""
+        self._stop_event.wait(self.poll_interval)
+        mail.noop()
+        typ, data = mail.response('EXISTS')
+        return bool(data and data[-1] is not None)
+
+    def _idle(self, mail: imaplib.IMAP4) -> bool:
+        """
+        Issues IDLE and waits until the server announces new mail, the IDLE timeout expires or the watcher is
+        stopped. Returns True if new mail was announced.
+        """
+        # imaplib (before Python 3.14) has no IDLE support, so the exchange is done on the raw connection
+        self._idle_tag += 1
+        tag = f"IDLE{self._idle_tag}".encode()
+        mail.send(tag + b' IDLE\r\n')
+        changed = False
+        line = mail.readline()
+        while line.startswith(b'*'):
+            changed = changed or bool(_EXISTS.match(line))
+            line = mail.readline()
+        if not line.startswith(b'+'):
+            raise imaplib.IMAP4.error(f"IDLE rejected: {line!r}")
+
+        # Every response is read with mail.readline(), which also sees lines imaplib has already buffered (e.g. an
+        # EXISTS that came with the continuation). A helper thread ends IDLE on stop() or at the IDLE timeout.
+        send_lock = threading.Lock()
+        ended = threading.Event()
+        answered = threading.Event()
+
+        def end_idle() -> None:
+            with send_lock:
+                if not ended.is_set():
+                    ended.set()
+                    mail.send(b'DONE\r\n')
+
+        def end_idle_when_due() -> None:
+            deadline = time.monotonic() + self.idle_timeout
+            while not answered.wait(min(1.0, max(deadline - time.monotonic(), 0.0))):
+                if self._stop_event.is_set() or time.monotonic() >= deadline:
+                    try:
+                        end_idle()
+                    except OSError:
+                        pass  # The reading side notices the lost connection
+                    return
+
+        if changed:
+            end_idle()
+        else:
+            threading.Thread(target=end_idle_when_due, daemon=True).start()
+        try:
+            while True:
+                line = mail.readline()
+                if not line:
+                    raise imaplib.IMAP4.abort("connection closed during IDLE")
+                if line.startswith(tag):
+                    break
+                if _EXISTS.match(line):
+                    changed = True
+                    end_idle()
+        finally:
+            answered.set()
+        return changed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Watch a mailbox and flag spam as it arrives.")
+    parser.add_argument('--account', help="Name of the saved credentials in email_data.json (default: the first)")
+    parser.add_argument('--folder', default='inbox')
+    parser.add_argument('--credentials', type=Path, default=Path("../data/email_data.json"))
+    parser.add_argument('--model', default='../models/spam_classifier.joblib')
+    parser.add_argument('--keep-data', type=Path, default=Path("../data/keep_data.csv"))
+    parser.add_argument('--state', type=Path, default=None, help="ScanStateStore database to resume from")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="Serve Prometheus metrics at http://127.0.0.1:PORT/metrics")
+    parser.add_argument('--cache', type=Path, default=DEFAULT_CACHE_PATH,
+                        help="Database of cached verdicts (default: ../data/verdict_cache.sqlite3)")
+    parser.add_argument('--no-cache', action='store_true', help="Classify every email, even ones seen before")
+    parser.add_argument('--service', default=None,
+                        help="URL of a running classify_service.py to share its model, e.g. http://127.0.0.1:8765")
+    args = parser.parse_args()
+
+    email_info = load_json_file(args.credentials, print)
+    if not email_info:
+        return
+    credentials = email_info.get(args.account or next(iter(email_info)), {})
+    user, password = credentials.get("user"), credentials.get("pass")
+    server = get_mail_server(user or "")
+    if not (user and password and server):
+        print("Email credentials are missing or the mail server is not supported.")
+        return
+
+    keep_matcher = KeepListMatcher.from_csv(args.keep_data)
+    model = connect_model(args.model, print, args.service)
+    if args.metrics_port:
+        METRICS.serve_prometheus(args.metrics_port)
+
+    def report_spam(uid: str, from_: str, subject: str, body: str) -> None:
+        print(f"Spam UID {uid}: {from_}: {subject}")
+
+    cache = None if args.no_cache else VerdictCache(path=args.cache)
+    watcher = MailboxWatcher(lambda: imaplib.IMAP4_SSL(server), user, password, model, keep_matcher, print,
+                             report_spam, folder=args.folder, state_path=args.state, cache=cache)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        watcher.stop()
+    finally:
+        if cache is not None:
+            cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,28 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# The modules in src import each other directly, as they do when run from that folder
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'src'))
+
+from imap_standin import StandInIMAPServer  # noqa: E402
+from standin_mail import PASSWORD, USER  # noqa: E402
+
+
+@pytest.fixture
+def model():
+    """A small TF-IDF + NB pipeline, trained on a handful of texts."""
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.naive_bayes import MultinomialNB
+    from sklearn.pipeline import make_pipeline
+
+    return make_pipeline(TfidfVectorizer(), MultinomialNB()).fit(
+        ["free prize click now", "cheap pills offer", "project meeting notes", "lunch tomorrow"], [1, 1, 0, 0])
+
+
+@pytest.fixture
+def server():
+    """A running stand-in IMAP server with one account, USER."""
+    with StandInIMAPServer({USER: PASSWORD}) as server:
+        yield server
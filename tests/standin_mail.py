@@ -0,0 +1,12 @@
+from email.message import EmailMessage
+
+USER, PASSWORD = "user@example.com", "secret"
+
+
+def make_message(number: int) -> bytes:
+    """A plain, harmless email; `number` tells the emails apart."""
+    message = EmailMessage()
+    message['From'] = f"sender{number}@example.com"
+    message['Subject'] = f"Notes {number}"
+    message.set_content("Here are the notes from today's project meeting.")
+    return message.as_bytes()
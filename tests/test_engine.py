@@ -0,0 +1,27 @@
+import imaplib
+
+import pandas as pd
+
+from engine import ScanEngine
+from standin_mail import PASSWORD, USER, make_message
+from scan_state import ScanStateStore
+
+KEEP_DF = pd.DataFrame(columns=["Keywords", "Sender", "Subject"])
+
+
+def test_configure_applies_to_the_next_scan(server, model, tmp_path):
+    for number in range(30):
+        server.add_message(make_message(number))
+    engine = ScanEngine({'work': {'user': USER, 'pass': PASSWORD}}, model, KEEP_DF, lambda message: None,
+                        lambda *email: None, connect=lambda usr: imaplib.IMAP4(*server.address), limit=5)
+    state_path = tmp_path / "state.sqlite3"
+    try:
+        assert engine.scan() == {'work': 0}
+        assert not state_path.exists()
+
+        engine.configure(model, KEEP_DF, state_path, 10, False)
+        assert engine.scan() == {'work': 0}
+    finally:
+        engine.close()
+    with ScanStateStore(state_path) as state_store:
+        assert set(state_store.get_verdicts(USER, 'inbox')) == set(range(21, 31))
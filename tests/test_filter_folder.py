@@ -0,0 +1,77 @@
+import imaplib
+
+import pandas as pd
+
+from standin_mail import PASSWORD, USER, make_message
+from imap_fetch import parse_uid_set
+from scan_state import ScanStateStore
+from spam_detector import filter_folder
+
+KEEP_DF = pd.DataFrame(columns=["Keywords", "Sender", "Subject"])
+
+
+def scan(server, model, state_store, limit):
+    mail = imaplib.IMAP4(*server.address)
+    mail.login(USER, PASSWORD)
+    try:
+        filter_folder(mail, USER, KEEP_DF, model, lambda message: None, lambda *email: None,
+                      state_store=state_store, limit=limit)
+    finally:
+        mail.logout()
+    return set(state_store.get_verdicts(USER, 'inbox'))
+
+
+def test_first_scan_with_state_checks_the_newest_emails(server, model, tmp_path):
+    for number in range(250):
+        server.add_message(make_message(number))
+    with ScanStateStore(tmp_path / "state.sqlite3") as state_store:
+        assert scan(server, model, state_store, 100) == set(range(151, 251))
+
+        for number in range(250, 280):
+            server.add_message(make_message(number))
+        assert scan(server, model, state_store, 100) == set(range(151, 281))
+
+
+def test_later_scans_with_state_page_through_new_emails(server, model, tmp_path):
+    for number in range(10):
+        server.add_message(make_message(number))
+    with ScanStateStore(tmp_path / "state.sqlite3") as state_store:
+        assert scan(server, model, state_store, 100) == set(range(1, 11))
+
+        for number in range(10, 160):
+            server.add_message(make_message(number))
+        # More new emails than the limit: the rest are checked by the next scan, none are skipped
+        assert scan(server, model, state_store, 100) == set(range(1, 111))
+        assert scan(server, model, state_store, 100) == set(range(1, 161))
+
+
+class RecordingIMAP4(imaplib.IMAP4):
+    """Records the arguments of every UID SEARCH and the UIDs of every UID FETCH."""
+
+    def __init__(self, host, port):
+        self.searches, self.fetched = [], set()
+        super().__init__(host, port)
+
+    def uid(self, command, *args):
+        if command.upper() == 'SEARCH':
+            self.searches.append(' '.join(str(arg) for arg in args if arg))
+        elif command.upper() == 'FETCH':
+            self.fetched.update(parse_uid_set(args[0]))
+        return super().uid(command, *args)
+
+
+def test_keep_search_covers_only_the_scanned_uids(server, model):
+    for number in range(50):
+        server.add_message(make_message(number))
+    # make_message(48) is delivered with UID 49
+    keep_df = pd.DataFrame({"Keywords": [None], "Sender": ["sender48@example.com"], "Subject": [None]})
+    mail = RecordingIMAP4(*server.address)
+    mail.login(USER, PASSWORD)
+    try:
+        filter_folder(mail, USER, keep_df, model, lambda message: None, lambda *email: None, limit=5)
+    finally:
+        mail.logout()
+
+    keep_searches = [search for search in mail.searches if 'FROM' in search]
+    assert keep_searches and all(search.startswith('UID 46:50 ') for search in keep_searches)
+    assert mail.fetched == {46, 47, 48, 50}
@@ -0,0 +1,54 @@
+import joblib
+import pytest
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.naive_bayes import MultinomialNB
+from sklearn.pipeline import make_pipeline
+
+from model_store import CompactSpamModel, compact_path_for, load_compact_model
+from online_model import CLASSES, OnlineLearner, create_online_model
+from spam_detector import build_model_input, load_model
+
+MESSAGES = [
+    ("offers@deals.example", "You won a free prize", "Claim your free prize now, click the link"),
+    ("promo@cheap.example", "Cheap pills", "Buy cheap pills online, limited offer, free shipping"),
+    ("alice@example.com", "Meeting notes", "Here are the notes from today's project meeting"),
+    ("bob@example.com", "Lunch tomorrow?", "Are we still on for lunch tomorrow at noon"),
+]
+LABELS = [1, 1, 0, 0]
+TEXTS = [build_model_input(*message) for message in MESSAGES]
+
+
+@pytest.fixture
+def model_path(tmp_path):
+    """A saved TF-IDF + NB model whose compact export has been written, as load_model leaves it."""
+    path = tmp_path / "spam_classifier.joblib"
+    joblib.dump(make_pipeline(TfidfVectorizer(), MultinomialNB()).fit(TEXTS, LABELS), path)
+    load_model(str(path), lambda message: None)
+    assert isinstance(load_compact_model(compact_path_for(path)), CompactSpamModel)
+    return path
+
+
+def test_learner_is_seeded_from_a_model_with_a_compact_export(model_path, tmp_path):
+    learner = OnlineLearner.load(lambda: load_model(str(model_path), lambda message: None, compact=False),
+                                 lambda message: None, tmp_path / "online")
+
+    assert learner.model.predict(TEXTS).tolist() == LABELS
+
+
+def test_compact_model_cannot_seed_a_learner(model_path):
+    with pytest.raises(TypeError):
+        create_online_model(load_compact_model(compact_path_for(model_path)))
+
+
+def test_hashed_model_loads_without_a_compact_export(tmp_path):
+    model_path = tmp_path / "online.joblib"
+    model = create_online_model()
+    model.steps[-1][1].partial_fit(model.steps[0][1].transform(TEXTS), LABELS, classes=CLASSES)
+    joblib.dump(model, model_path)
+    messages = []
+
+    model = load_model(str(model_path), messages.append)
+
+    assert model.predict(TEXTS).tolist() == LABELS
+    assert not compact_path_for(model_path).exists()
+    assert not any("not exported" in message for message in messages)